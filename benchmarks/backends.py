@@ -0,0 +1,360 @@
+"""
+In-process fakes of the Spotify and Tidal clients, serving a catalogue fixture with injected latency,
+errors and rate limiting, so the real music services can be benchmarked offline.
+
+Only the parts of `spotipy.Spotify` and `tidalapi.Session` the music services use are faked.
+"""
+
+import datetime
+import random
+import re
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, Optional
+
+from music_services.music_service import MusicService
+from music_services.spotify import SpotifyMusicService
+from music_services.things import normalize
+from music_services.tidal import TIDAL_SEARCH_CANDIDATES, TidalMusicService
+
+# Page sizes the services use for album tracklists
+SPOTIFY_ALBUM_PAGE_SIZE = 50
+TIDAL_ALBUM_PAGE_SIZE = 100
+
+# Lifetime of fake access tokens, in seconds
+TOKEN_LIFETIME = 60 * 60
+
+SPOTIFY_QUERY_REGEX = re.compile(r"track:(.*) artist:(.*)")
+
+
+class SpotifyError(Exception):
+    """
+    Shaped like `spotipy.SpotifyException`.
+    """
+
+    def __init__(self, http_status: int, headers: Optional[Dict[str, str]] = None):
+        super().__init__(f"http status: {http_status}")
+        self.http_status = http_status
+        self.headers = headers
+
+
+class TidalError(Exception):
+    """
+    Shaped like the `requests.HTTPError` raised through tidalapi.
+    """
+
+    def __init__(self, status_code: int, headers: Optional[Dict[str, str]] = None):
+        super().__init__(f"{status_code} error")
+        self.response = Response(status_code, headers or {})
+
+
+class Response:
+    def __init__(self, status_code: int, headers: Dict[str, str]):
+        self.status_code = status_code
+        self.headers = headers
+
+
+class FakeBackend:
+    """
+    A music service's API, serving the tracks and albums of a catalogue that it has an ID for.
+
+    Every call waits `latency` seconds, then fails with a 429 asking to retry after `retry_after`
+    seconds with probability `rate_limit_rate`, or with a 503 with probability `error_rate`.
+    Calls are counted by method.
+    """
+
+    service_id = None
+
+    def __init__(
+        self,
+        catalogue: Dict,
+        latency: float = 0.05,
+        error_rate: float = 0.0,
+        rate_limit_rate: float = 0.0,
+        retry_after: float = 1.0,
+        seed: int = 0,
+    ):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = Counter()
+
+        id_key = f"{self.service_id}_id"
+        self.tracks_by_id = {t[id_key]: t for t in catalogue["tracks"] if t.get(id_key) is not None}
+        self.tracks_by_isrc = {t["isrc"]: t for t in self.tracks_by_id.values()}
+        self.albums_by_id = {a[id_key]: a for a in catalogue["albums"] if a.get(id_key) is not None}
+        self.titles: Dict[str, List[Dict]] = {}
+        for track in self.tracks_by_id.values():
+            self.titles.setdefault(normalize(track["name"]), []).append(track)
+        self.playlists: Dict[str, List[str]] = {}
+
+    def create_playlist(self, playlist_id: str):
+        self.playlists.setdefault(playlist_id, [])
+
+    def error(self, status: int, headers: Optional[Dict[str, str]] = None) -> Exception:
+        pass
+
+    def _call(self, method: str):
+        with self.lock:
+            self.calls[method] += 1
+            roll = self.random.random()
+        time.sleep(self.latency)
+        if roll < self.rate_limit_rate:
+            raise self.error(429, {"Retry-After": str(self.retry_after)})
+        if roll < self.rate_limit_rate + self.error_rate:
+            raise self.error(503)
+
+    def _album_tracks(self, album: Dict) -> List[Dict]:
+        return [self.tracks_by_isrc[isrc] for isrc in album["tracks"] if isrc in self.tracks_by_isrc]
+
+    def _search(self, title: str, limit: int) -> List[Dict]:
+        return self.titles.get(normalize(title), [])[:limit]
+
+
+class FakeSpotify(FakeBackend):
+    service_id = "spotify"
+
+    def error(self, status: int, headers: Optional[Dict[str, str]] = None) -> Exception:
+        return SpotifyError(status, headers)
+
+    def set_auth(self, token: str):
+        pass
+
+    def track(self, track_id: str) -> Dict:
+        self._call("track")
+        if track_id not in self.tracks_by_id:
+            raise self.error(404)
+        return self._track(self.tracks_by_id[track_id])
+
+    def tracks(self, track_ids: List[str]) -> Dict:
+        self._call("tracks")
+        return {"tracks": [self._track(self.tracks_by_id[i]) if i in self.tracks_by_id else None for i in track_ids]}
+
+    def album(self, album_id: str) -> Dict:
+        self._call("album")
+        if album_id not in self.albums_by_id:
+            raise self.error(404)
+        return self._album(self.albums_by_id[album_id])
+
+    def albums(self, album_ids: List[str]) -> Dict:
+        self._call("albums")
+        return {"albums": [self._album(self.albums_by_id[i]) if i in self.albums_by_id else None for i in album_ids]}
+
+    def search(self, q: str, type: str = "track", limit: int = 10) -> Dict:
+        self._call("search")
+        if q.startswith("isrc:"):
+            track = self.tracks_by_isrc.get(q[len("isrc:") :])
+            results = [track] if track is not None else []
+        else:
+            match = SPOTIFY_QUERY_REGEX.match(q)
+            results = self._search(match.group(1), limit) if match else []
+        return {"tracks": {"items": [self._track(t) for t in results]}}
+
+    def playlist(self, playlist_id: str, fields: Optional[str] = None) -> Dict:
+        self._call("playlist")
+        if playlist_id not in self.playlists:
+            raise self.error(404)
+        return {
+            "id": playlist_id,
+            "name": f"Playlist {playlist_id}",
+            "external_urls": {"spotify": f"https://open.spotify.com/playlist/{playlist_id}"},
+            "snapshot_id": str(len(self.playlists[playlist_id])),
+        }
+
+    def playlist_items(self, playlist_id: str, fields: Optional[str] = None, limit: int = 100) -> Dict:
+        self._call("playlist_items")
+        if playlist_id not in self.playlists:
+            raise self.error(404)
+        return self._playlist_page(playlist_id, 0, limit)
+
+    def playlist_add_items(self, playlist_id: str, track_ids: List[str]) -> Dict:
+        self._call("playlist_add_items")
+        if playlist_id not in self.playlists:
+            raise self.error(404)
+        self.playlists[playlist_id].extend(track_ids)
+        return {"snapshot_id": str(len(self.playlists[playlist_id]))}
+
+    def next(self, page: Dict) -> Optional[Dict]:
+        self._call("next")
+        kind, id, offset, limit = page["next"].split(":")
+        if kind == "album":
+            return self._album_page(self.albums_by_id[id], int(offset))
+        return self._playlist_page(id, int(offset), int(limit))
+
+    def _track(self, track: Dict, full: bool = True) -> Dict:
+        service_track = {
+            "id": track["spotify_id"],
+            "name": track["name"],
+            "artists": [{"name": track["artist"]}],
+            "duration_ms": track["duration_ms"],
+        }
+        # Album tracklists give simplified tracks, without ISRCs or popularity
+        if full:
+            service_track["external_ids"] = {"isrc": track["isrc"]}
+            service_track["popularity"] = track["popularity"]
+        return service_track
+
+    def _album(self, album: Dict) -> Dict:
+        return {"id": album["spotify_id"], "name": album["name"], "tracks": self._album_page(album, 0)}
+
+    def _album_page(self, album: Dict, offset: int) -> Dict:
+        tracks = self._album_tracks(album)
+        end = offset + SPOTIFY_ALBUM_PAGE_SIZE
+        return {
+            "items": [self._track(t, full=False) for t in tracks[offset:end]],
+            "next": f"album:{album['spotify_id']}:{end}:{SPOTIFY_ALBUM_PAGE_SIZE}" if end < len(tracks) else None,
+        }
+
+    def _playlist_page(self, playlist_id: str, offset: int, limit: int) -> Dict:
+        track_ids = self.playlists[playlist_id]
+        end = offset + limit
+        return {
+            "items": [{"track": self._track(self.tracks_by_id[i])} for i in track_ids[offset:end]],
+            "next": f"playlist:{playlist_id}:{end}:{limit}" if end < len(track_ids) else None,
+        }
+
+
+class FakeSpotifyOAuth:
+    def refresh_access_token(self, refresh_token: str) -> Dict:
+        return {"access_token": f"token-{refresh_token}", "expires_at": time.time() + TOKEN_LIFETIME}
+
+
+class TidalArtist:
+    def __init__(self, name: str):
+        self.name = name
+
+
+class TidalTrack:
+    def __init__(self, track: Dict):
+        self.id = int(track["tidal_id"])
+        self.name = track["name"]
+        self.artists = [TidalArtist(track["artist"])]
+        self.isrc = track["isrc"]
+        self.duration = track["duration_ms"] // 1000
+        self.popularity = track["popularity"]
+
+
+class TidalAlbum:
+    def __init__(self, backend: "FakeTidalSession", album: Dict):
+        self.backend = backend
+        self.id = int(album["tidal_id"])
+        self.name = album["name"]
+        self.album = album
+
+    def tracks(self, limit: Optional[int] = None, offset: int = 0) -> List[TidalTrack]:
+        self.backend._call("album.tracks")
+        tracks = self.backend._album_tracks(self.album)
+        end = offset + (limit if limit is not None else TIDAL_ALBUM_PAGE_SIZE)
+        return [TidalTrack(t) for t in tracks[offset:end]]
+
+
+class TidalPlaylist:
+    def __init__(self, backend: "FakeTidalSession", playlist_id: str):
+        self.backend = backend
+        self.id = playlist_id
+        self.name = f"Playlist {playlist_id}"
+        self.track_ids = backend.playlists[playlist_id]
+        self.num_tracks = len(self.track_ids)
+        self.last_updated = self.num_tracks
+
+    def tracks(self, limit: int = 100, offset: int = 0) -> List[TidalTrack]:
+        self.backend._call("playlist.tracks")
+        return [TidalTrack(self.backend.tracks_by_id[i]) for i in self.track_ids[offset : offset + limit]]
+
+    def add(self, track_ids: List[str]):
+        self.backend._call("playlist.add")
+        self.track_ids.extend(str(i) for i in track_ids)
+        self.num_tracks = self.last_updated = len(self.track_ids)
+
+
+class FakeTidalSession(FakeBackend):
+    service_id = "tidal"
+
+    def __init__(self, catalogue: Dict, **kwargs):
+        super().__init__(catalogue, **kwargs)
+        self.access_token = None
+        self.expiry_time = None
+        self.request_session = None
+
+    def error(self, status: int, headers: Optional[Dict[str, str]] = None) -> Exception:
+        return TidalError(status, headers)
+
+    def load_oauth_session(self, token_type: str, access_token: str, refresh_token: str):
+        self.access_token = access_token
+        self.expiry_time = datetime.datetime.now() + datetime.timedelta(seconds=TOKEN_LIFETIME)
+
+    def token_refresh(self, refresh_token: str):
+        self.expiry_time = datetime.datetime.now() + datetime.timedelta(seconds=TOKEN_LIFETIME)
+
+    def track(self, track_id) -> TidalTrack:
+        self._call("track")
+        if str(track_id) not in self.tracks_by_id:
+            raise self.error(404)
+        return TidalTrack(self.tracks_by_id[str(track_id)])
+
+    def album(self, album_id) -> TidalAlbum:
+        self._call("album")
+        if str(album_id) not in self.albums_by_id:
+            raise self.error(404)
+        return TidalAlbum(self, self.albums_by_id[str(album_id)])
+
+    def get_tracks_by_isrc(self, isrc: str) -> List[TidalTrack]:
+        self._call("get_tracks_by_isrc")
+        if isrc not in self.tracks_by_isrc:
+            raise self.error(404)
+        return [TidalTrack(self.tracks_by_isrc[isrc])]
+
+    def search(self, query: str, models=None, limit: int = 10) -> Dict:
+        self._call("search")
+        # Queries are the title then the artist, so take the longest run of leading words that is a title
+        words = normalize(query).split()
+        for end in range(len(words), 0, -1):
+            results = self._search(" ".join(words[:end]), limit)
+            if len(results) > 0:
+                return {"tracks": [TidalTrack(t) for t in results]}
+        return {"tracks": []}
+
+    def playlist(self, playlist_id) -> TidalPlaylist:
+        self._call("playlist")
+        if str(playlist_id) not in self.playlists:
+            raise self.error(404)
+        return TidalPlaylist(self, str(playlist_id))
+
+
+class BenchSpotifyMusicService(SpotifyMusicService):
+    """
+    The Spotify music service, talking to a fake backend instead of spotipy.
+    """
+
+    def __init__(self, credentials: Dict[str, str], backend: FakeSpotify):
+        self.credentials = credentials
+        self.session = backend
+        self.oauth = FakeSpotifyOAuth()
+        MusicService.__init__(self)
+
+
+class BenchTidalMusicService(TidalMusicService):
+    """
+    The Tidal music service, talking to a fake backend instead of tidalapi.
+    """
+
+    def __init__(self, credentials: Dict[str, str], backend: FakeTidalSession):
+        self.credentials = credentials
+        self.session = backend
+        MusicService.__init__(self)
+
+    # The calls that name tidalapi's models, so that the benchmarks run without tidalapi installed
+
+    def search_tracks(self, query: str) -> List[TidalTrack]:
+        return self.request(self.session.search, query, limit=TIDAL_SEARCH_CANDIDATES)["tracks"]
+
+    def lookup_service_playlist(self, playlist_id) -> TidalPlaylist:
+        # tidalapi's UserPlaylist is constructed directly rather than through the session, so can't be faked
+        try:
+            return self.request(self.session.playlist, playlist_id)
+        except TidalError:
+            return None
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+"""
+Replay a corpus of Telegram updates through the bot's message handler, end to end, against the real
+Spotify and Tidal music services talking to fake backends with injected latency, errors and 429s.
+
+Reports messages handled per second, handler and end to end latency percentiles, API calls per
+message and peak RSS. Runs offline; generate the fixtures with `generate_fixtures.py` first.
+
+Usage:
+python benchmarks/bench_e2e.py [--latency 0.05] [--error-rate 0] [--rate-limit-rate 0] [--album-mode first]
+"""
+
+import argparse
+import json
+import logging
+import os
+import resource
+import sys
+import tempfile
+import time
+from collections import Counter
+from functools import partial
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+os.chdir(tempfile.mkdtemp())
+
+import jobs
+import main
+from backends import BenchSpotifyMusicService, BenchTidalMusicService, FakeSpotify, FakeTidalSession
+from generate_fixtures import CATALOGUE_PATH, CORPUS_PATH
+from music_services.albums import parse_album_mode
+from music_services.links import LinkExtractor
+from music_services.match_cache import MatchCache
+from music_services.registry import ServiceRegistry
+from music_services.scheduler import schedulers
+from music_services.things import Playlist
+
+# How long failed jobs wait before they are retried, shortened so that runs finish
+BENCH_RETRY_BASE_DELAY = 0.5
+
+
+def percentile(values: List[float], p: float) -> float:
+    if len(values) < 1:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+def load_updates(path: str) -> List[SimpleNamespace]:
+    """
+    Load recorded updates, with just the attributes the message handler reads.
+    """
+    updates = []
+    with open(path) as f:
+        for line in f:
+            message = json.loads(line)["message"]
+            chat = SimpleNamespace(id=message["chat"]["id"], title=message["chat"].get("title"), type="group")
+            updates.append(
+                SimpleNamespace(
+                    message=SimpleNamespace(
+                        message_id=message["message_id"], chat=chat, from_user=message["from"], text=message["text"]
+                    )
+                )
+            )
+    return updates
+
+
+def setup(args, catalogue: Dict, updates: List[SimpleNamespace]) -> List:
+    backend_options = {
+        "latency": args.latency,
+        "error_rate": args.error_rate,
+        "rate_limit_rate": args.rate_limit_rate,
+        "retry_after": args.retry_after,
+        "seed": args.seed,
+    }
+    backends = [FakeSpotify(catalogue, **backend_options), FakeTidalSession(catalogue, **backend_options)]
+    service_classes = [BenchSpotifyMusicService, BenchTidalMusicService]
+    if args.rate is not None:
+        for service_class in service_classes:
+            service_class.requests_per_second = args.rate
+            service_class.request_burst = int(args.rate * 2)
+
+    main.configure_db()
+    main.match_cache = MatchCache()
+    factories = {
+        service_class.id: partial(service_class, backend=backend)
+        for service_class, backend in zip(service_classes, backends)
+    }
+    main.service_registry = ServiceRegistry(main.credential_store, factories)
+    main.link_extractor = LinkExtractor(service_classes)
+    main.notify = lambda chat_id, message_id, text: None
+    jobs.RETRY_BASE_DELAY = BENCH_RETRY_BASE_DELAY
+
+    # Each chat belongs to the first user seen in it, with a playlist on both services
+    album_mode = parse_album_mode(args.album_mode) if getattr(args, "album_mode", None) else None
+    chats = {}
+    for update in updates:
+        chats.setdefault(str(update.message.chat.id), str(update.message.from_user["id"]))
+    for chat_id, tenant_id in chats.items():
+        main.initialise_chat(chat_id)
+        if album_mode is not None:
+            main.chat_repository.set_album_mode(chat_id, album_mode)
+        for service_class, backend in zip(service_classes, backends):
+            credentials = {name: "bench" for name in service_class.credential_names}
+            main.register_tenant(tenant_id, service_class.id, credentials)
+            backend.create_playlist(chat_id)
+            service = main.service_registry.get(tenant_id, service_class.id)
+            main.set_chat_playlist(service, Playlist(chat_id, [], "", chat_id, service.id), chat_id, tenant_id)
+
+    # Setup calls aren't part of the benchmark
+    for backend in backends:
+        backend.calls.clear()
+    return backends
+
+
+def run(args):
+    with open(args.catalogue) as f:
+        catalogue = json.load(f)
+    updates = load_updates(args.corpus)[: args.messages]
+    backends = setup(args, catalogue, updates)
+
+    handled_at = {}
+    handler_latencies = []
+    start = time.perf_counter()
+    main.job_workers.start()
+    for update in updates:
+        handled_at[(str(update.message.chat.id), str(update.message.message_id))] = time.time()
+        handler_start = time.perf_counter()
+        main.parse_track_links(update, None)
+        handler_latencies.append(time.perf_counter() - handler_start)
+
+    while any(main.job_queue.counts().get(status, 0) > 0 for status in [jobs.PENDING, jobs.RUNNING]):
+        time.sleep(0.01)
+    main.job_workers.stop()
+    main.write_queue.close()
+    elapsed = time.perf_counter() - start
+
+    # A message is done once the last of its jobs finished
+    rows = main.job_queue.database.execute(
+        "SELECT chat_id, message_id, MAX(updated_at), MAX(attempts) FROM jobs GROUP BY chat_id, message_id"
+    )
+    latencies = [finished_at - handled_at[(chat_id, message_id)] for chat_id, message_id, finished_at, _ in rows]
+    retried = sum(1 for row in rows if row[3] > 1)
+
+    calls = Counter()
+    for backend in backends:
+        calls.update({f"{backend.service_id}.{method}": count for method, count in backend.calls.items()})
+    total_calls = sum(calls.values())
+    statuses = main.job_queue.counts()
+
+    print(f"{len(updates)} messages, {len(rows)} with links, {sum(statuses.values())} jobs: {dict(statuses)}")
+    print(f"Elapsed: {elapsed:.2f}s ({len(updates) / elapsed:.1f} messages/s, {len(rows) / elapsed:.1f} with links/s)")
+    print(
+        f"Handler latency: p50 {percentile(handler_latencies, 50) * 1000:.2f}ms, "
+        f"p99 {percentile(handler_latencies, 99) * 1000:.2f}ms"
+    )
+    print(
+        f"End to end latency: p50 {percentile(latencies, 50) * 1000:.0f}ms, "
+        f"p99 {percentile(latencies, 99) * 1000:.0f}ms ({retried} messages retried)"
+    )
+    print(f"API calls: {total_calls} ({total_calls / max(len(rows), 1):.1f} per message with links)")
+    for method, count in calls.most_common():
+        print(f"  {method}: {count}")
+    for service_id, scheduler in schedulers.items():
+        print(f"{service_id} scheduler: {scheduler.stats()}")
+    # Linux reports peak RSS in kilobytes
+    print(f"Peak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f}MB")
+    main.pipeline.shutdown()
+
+
+def add_backend_arguments(parser: argparse.ArgumentParser, rate: Optional[float] = None):
+    """
+    Add the options of the fake backends and the services talking to them, which `setup` reads.
+    """
+    parser.add_argument("--catalogue", default=CATALOGUE_PATH, help="catalogue the fake backends serve")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds each API call takes")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of API calls failing with a 503")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="share of API calls failing with a 429")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="seconds 429s ask to wait")
+    parser.add_argument("--rate", type=float, default=rate, help="override the services' requests per second")
+    parser.add_argument("--seed", type=int, default=0, help="seed for generated data and injected errors")
+    parser.add_argument("--verbose", action="store_true", help="log as the bot would")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    add_backend_arguments(parser)
+    parser.add_argument("--corpus", default=CORPUS_PATH, help="Telegram updates to replay, one per line")
+    parser.add_argument("--messages", type=int, default=None, help="replay only this many updates")
+    parser.add_argument("--album-mode", default="first", help="album mode of every chat, e.g. 'top 3'")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+    run(args)
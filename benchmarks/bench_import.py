@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+"""
+Import a generated Telegram Desktop export of a chat's history into its playlists, against the real
+Spotify and Tidal music services talking to fake backends, as `python main.py import` would.
+
+Reports how fast the export is read and its links queued, how long they take to be added, API calls
+and peak RSS, then imports the export again to check that it resumes from the checkpoint.
+
+Usage:
+python benchmarks/bench_import.py [--messages 5000] [--latency 0.05] [--rate 50]
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import time
+from collections import Counter
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import jobs
+import main
+from bench_e2e import add_backend_arguments, setup
+from generate_fixtures import generate_corpus
+
+# Chat the export is of
+CHAT_ID = -1000
+
+# Share of exported messages that are service messages, e.g. members joining
+SERVICE_MESSAGE_RATIO = 0.05
+
+
+def write_export(path: str, updates, seed: int):
+    """
+    Write updates as a Telegram Desktop export of the chat, with links as text entities like Telegram's.
+    """
+    rng = random.Random(seed)
+    messages = []
+    for update in updates:
+        message = update["message"]
+        if rng.random() < SERVICE_MESSAGE_RATIO:
+            messages.append({"id": message["message_id"], "type": "service", "action": "join_group_by_link"})
+            continue
+
+        words = message["text"].split(" ")
+        text = [{"type": "link", "text": w} if ":" in w else w for w in words]
+        messages.append(
+            {
+                "id": message["message_id"],
+                "type": "message",
+                "date_unixtime": str(message["date"]),
+                "from": message["from"]["first_name"],
+                "from_id": f"user{message['from']['id']}",
+                "text": text if any(isinstance(part, dict) for part in text) else message["text"],
+            }
+        )
+
+    export = {"name": f"Chat {CHAT_ID}", "type": "private_supergroup", "id": -CHAT_ID, "messages": messages}
+    with open(path, "w") as f:
+        json.dump(export, f, indent=1)
+
+
+def wait_for_jobs(chat_id: str):
+    while main.job_queue.counts(chat_id).get(jobs.RUNNING, 0) > 0 or main.job_queue.due(chat_id) > 0:
+        time.sleep(0.05)
+
+
+def run(args):
+    with open(args.catalogue) as f:
+        catalogue = json.load(f)
+    updates = generate_corpus(random.Random(args.seed), catalogue, args.messages, 1)
+    # The working directory is a temporary one, see bench_e2e
+    path = os.path.abspath("result.json")
+    write_export(path, updates, args.seed)
+
+    # The chat's tenant is its first member, as in the corpus
+    member = SimpleNamespace(message=SimpleNamespace(chat=SimpleNamespace(id=CHAT_ID), from_user={"id": -CHAT_ID}))
+    backends = setup(args, catalogue, [member])
+
+    main.job_workers.start()
+    start = time.perf_counter()
+    with open(path, encoding="utf-8") as f:
+        progress = main.import_history(str(CHAT_ID), f)
+    queued_in = time.perf_counter() - start
+    wait_for_jobs(str(CHAT_ID))
+    elapsed = time.perf_counter() - start
+
+    with open(path, encoding="utf-8") as f:
+        resumed = main.import_history(str(CHAT_ID), f)
+    main.job_workers.stop()
+    main.write_queue.close()
+
+    calls = Counter()
+    for backend in backends:
+        calls.update({f"{backend.service_id}.{method}": count for method, count in backend.calls.items()})
+    playlists = {backend.service_id: len(backend.playlists[str(CHAT_ID)]) for backend in backends}
+
+    print(f"Export of {args.messages} messages: {os.path.getsize(path) / 1024 / 1024:.1f}MB")
+    print(f"Read and queued in {queued_in:.2f}s ({progress.messages / queued_in:.0f} messages/s): {progress}")
+    print(f"Added in {elapsed:.2f}s, jobs {dict(main.job_queue.counts(str(CHAT_ID)))}, playlist tracks {playlists}")
+    new_messages, new_jobs = resumed.messages - progress.messages, resumed.queued - progress.queued
+    print(f"Resumed import: {new_messages} new messages, {new_jobs} jobs")
+    print(f"API calls: {sum(calls.values())}")
+    for method, count in calls.most_common():
+        print(f"  {method}: {count}")
+    # Linux reports peak RSS in kilobytes
+    print(f"Peak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f}MB")
+    main.pipeline.shutdown()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    add_backend_arguments(parser, rate=50)
+    parser.add_argument("--messages", type=int, default=5000, help="messages in the export")
+    parser.add_argument("--album-mode", default="first", help="album mode of the chat, e.g. 'top 3'")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+    run(args)
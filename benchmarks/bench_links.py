@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+"""
+Compare the single-pass link extractor with running each service's regexes separately.
+
+Usage:
+python benchmarks/bench_links.py [messages]
+"""
+
+import argparse
+import os
+import random
+import re
+import sys
+import timeit
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from music_services.links import LinkExtractor
+from music_services.spotify import SPOTIFY_ALBUM_REGEX, SPOTIFY_LINK_MARKERS, SPOTIFY_TRACK_REGEX
+from music_services.tidal import TIDAL_ALBUM_REGEX, TIDAL_LINK_MARKERS, TIDAL_TRACK_REGEX
+
+CHAT = [
+    "anyone up for the pub later?",
+    "lol",
+    "that gig last night was unreal",
+    "has anyone seen my charger",
+    "https://www.youtube.com/watch?v=dQw4w9WgXcQ",
+    "new album from them is out friday, can't wait",
+    "ok see you at 8",
+]
+
+ALPHABET = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
+
+
+def spotify_id() -> str:
+    return "".join(random.choice(ALPHABET) for _ in range(22))
+
+
+def music_link() -> str:
+    return random.choice(
+        [
+            lambda: f"https://open.spotify.com/track/{spotify_id()}?si={spotify_id()[:16]}",
+            lambda: f"https://open.spotify.com/intl-de/album/{spotify_id()}",
+            lambda: f"spotify:track:{spotify_id()}",
+            lambda: f"https://tidal.com/browse/track/{random.randint(1, 10**9)}",
+            lambda: f"https://listen.tidal.com/album/{random.randint(1, 10**9)}",
+        ]
+    )()
+
+
+def generate_corpus(messages: int, link_ratio: float = 0.2):
+    """
+    Chat messages where roughly `link_ratio` of them share between one and three music links.
+    """
+    corpus = []
+    for _ in range(messages):
+        text = random.choice(CHAT)
+        if random.random() < link_ratio:
+            links = [music_link() for _ in range(random.randint(1, 3))]
+            text = " ".join([random.choice(["check this out", "tune", ""])] + links)
+        corpus.append(text)
+    return corpus
+
+
+def main(messages: int):
+    random.seed(0)
+    corpus = generate_corpus(messages)
+
+    spotify = SimpleNamespace(
+        id="spotify",
+        name="Spotify",
+        track_regex=SPOTIFY_TRACK_REGEX,
+        album_regex=SPOTIFY_ALBUM_REGEX,
+        link_markers=SPOTIFY_LINK_MARKERS,
+    )
+    tidal = SimpleNamespace(
+        id="tidal",
+        name="Tidal",
+        track_regex=TIDAL_TRACK_REGEX,
+        album_regex=TIDAL_ALBUM_REGEX,
+        link_markers=TIDAL_LINK_MARKERS,
+    )
+    services = [spotify, tidal]
+    extractor = LinkExtractor(services)
+
+    def per_service():
+        for text in corpus:
+            for service in services:
+                re.findall(service.track_regex, text)
+                re.findall(service.album_regex, text)
+
+    def single_pass():
+        for text in corpus:
+            extractor.extract(text)
+
+    for name, fn in [("per-service findall", per_service), ("single pass", single_pass)]:
+        seconds = min(timeit.repeat(fn, number=1, repeat=5))
+        print(f"{name:>20}: {seconds * 1000:.1f}ms for {messages} messages ({seconds / messages * 1e6:.2f}us each)")
+
+    links = sum(len(extractor.extract(text)) for text in corpus)
+    print(f"{links} links found")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("messages", type=int, nargs="?", default=10000, help="messages to extract links from")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main(parse_args().messages)
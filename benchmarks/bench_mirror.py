@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""
+Sync a chat's Spotify and Tidal playlists that have drifted apart, against the real music services
+talking to fake backends, then sync them again while unchanged and after a track is added outside the bot.
+
+Reports the tracks added and the API calls made by each sync.
+
+Usage:
+python benchmarks/bench_mirror.py [--tracks 400] [--drift 0.2] [--latency 0.05] [--rate 50]
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from collections import Counter
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import main
+from bench_e2e import add_backend_arguments, setup
+
+# Chat whose playlists are synced
+CHAT_ID = "-1000"
+
+
+def sync(name: str, backends):
+    for backend in backends:
+        backend.calls.clear()
+    start = time.perf_counter()
+    added = main.playlist_mirror.sync(CHAT_ID)
+    elapsed = time.perf_counter() - start
+
+    calls = Counter()
+    for backend in backends:
+        calls.update({f"{backend.service_id}.{method}": count for method, count in backend.calls.items()})
+    sizes = {backend.service_id: len(backend.playlists[CHAT_ID]) for backend in backends}
+    print(f"{name}: added {added} in {elapsed:.2f}s, playlist tracks {sizes}")
+    print(f"  API calls: {sum(calls.values())} {dict(calls.most_common())}")
+
+
+def run(args):
+    with open(args.catalogue) as f:
+        catalogue = json.load(f)
+
+    member = SimpleNamespace(message=SimpleNamespace(chat=SimpleNamespace(id=CHAT_ID), from_user={"id": 1000}))
+    spotify, tidal = backends = setup(args, catalogue, [member])
+
+    # Each playlist is missing a different share of the tracks, some of which the other service doesn't have
+    drift = int(1 / args.drift)
+    for i, track in enumerate(catalogue["tracks"][: args.tracks]):
+        if track["spotify_id"] is not None and i % drift != 0:
+            spotify.playlists[CHAT_ID].append(track["spotify_id"])
+        if track["tidal_id"] is not None and i % drift != 1:
+            tidal.playlists[CHAT_ID].append(track["tidal_id"])
+
+    sync("Drifted", backends)
+    sync("After sync", backends)
+    sync("Unchanged", backends)
+    extra = next(t for t in catalogue["tracks"][args.tracks :] if t["spotify_id"] and t["tidal_id"])
+    spotify.playlists[CHAT_ID].append(extra["spotify_id"])
+    sync("Track added outside the bot", backends)
+
+    main.write_queue.close()
+    main.pipeline.shutdown()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    add_backend_arguments(parser, rate=50)
+    parser.add_argument("--tracks", type=int, default=400, help="tracks in the playlists")
+    parser.add_argument("--drift", type=float, default=0.2, help="share of tracks each playlist is missing")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+    run(args)
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+"""
+Measure how quickly queued links are processed against fake music services with injected latency.
+
+Usage:
+python benchmarks/bench_pipeline.py [latency_seconds] [messages]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from functools import partial
+from typing import Dict, Iterator, List
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+os.chdir(tempfile.mkdtemp())
+
+import jobs
+import main
+from music_services.albums import FIRST, FULL, TOP, AlbumMode
+from music_services.links import LinkExtractor
+from music_services.match_cache import MatchCache
+from music_services.music_service import MusicService
+from music_services.registry import ServiceRegistry
+from music_services.things import Playlist, Track
+
+# Number of tracks on each fake album, and how many come in each page of its tracklist
+ALBUM_TRACKS = 12
+ALBUM_PAGE_SIZE = 5
+
+# Album mode of each chat, in turn
+ALBUM_MODES = [AlbumMode(FIRST), AlbumMode(TOP, 3), AlbumMode(FULL), AlbumMode(FIRST)]
+
+
+class FakeMusicService(MusicService):
+    def __init__(self, id: str, latency: float):
+        self.name = f"Fake {id}"
+        self.id = id
+        self.track_regex = rf"{id}\.com/track/(\w+)"
+        self.album_regex = rf"{id}\.com/album/(\w+)"
+        self.link_markers = [id]
+        self.max_playlist_batch = 100
+        self.requests_per_second = 1000
+        self.request_burst = 1000
+        self.latency = latency
+        self.calls = 0
+        self.playlist_tracks: Dict[str, List[str]] = {}
+        super().__init__()
+
+    def _call(self):
+        self.request(self._respond)
+
+    def _respond(self):
+        self.calls += 1
+        time.sleep(self.latency)
+
+    def refresh_auth(self):
+        pass
+
+    def lookup_service_album(self, album_id: str) -> Dict:
+        self._call()
+        tracks = [
+            {"id": f"{album_id}-{i}", "name": f"Track {album_id}-{i}", "popularity": i % 4} for i in range(ALBUM_TRACKS)
+        ]
+        return {"id": album_id, "tracks": tracks}
+
+    def get_service_track_from_album(self, service_album: Dict) -> Dict:
+        return service_album["tracks"][0]
+
+    def iter_album_pages(self, service_album: Dict) -> Iterator[List[Dict]]:
+        # The first page comes with the album, as it does from Spotify
+        tracks = service_album["tracks"]
+        for i in range(0, len(tracks), ALBUM_PAGE_SIZE):
+            if i > 0:
+                self._call()
+            yield tracks[i : i + ALBUM_PAGE_SIZE]
+
+    def get_track_popularity(self, service_track: Dict) -> float:
+        return service_track["popularity"]
+
+    def lookup_service_track(self, track_id: str) -> Dict:
+        self._call()
+        return {"id": track_id, "name": f"Track {track_id}"}
+
+    def lookup_service_playlist(self, playlist_id: str) -> Dict:
+        self._call()
+        return {"id": playlist_id, "name": f"Playlist {playlist_id}"}
+
+    def convert_tracks(self, tracks: List[Dict]) -> List[Track]:
+        return [Track(track["name"], "Artist", service_id=self.id, id=track["id"]) for track in tracks]
+
+    def convert_playlist(self, playlist: Dict) -> Playlist:
+        return Playlist(playlist["name"], [], "", playlist["id"])
+
+    def add_tracks_to_playlist(self, playlist_id: str, track_ids: List[str]) -> str:
+        self._call()
+        self.playlist_tracks.setdefault(playlist_id, []).extend(track_ids)
+        return self.get_playlist_snapshot_id(playlist_id)
+
+    def search_track_by_isrc(self, isrc: str) -> Dict:
+        return None
+
+    def search_track_candidates(self, track: Track) -> List[Dict]:
+        self._call()
+        return [{"id": track.name.split(" ", 1)[1], "name": track.name}]
+
+    def get_service_track_id(self, service_track: Dict) -> str:
+        return service_track["id"]
+
+    def iter_playlist_pages(self, playlist_id: str) -> Iterator[List[Dict]]:
+        self._call()
+        yield [{"id": track_id, "name": f"Track {track_id}"} for track_id in self.playlist_tracks.get(playlist_id, [])]
+
+    def get_playlist_track_ids(self, playlist_id: str) -> List[str]:
+        self._call()
+        return list(self.playlist_tracks.get(playlist_id, []))
+
+    def get_playlist_snapshot_id(self, playlist_id: str) -> str:
+        return str(len(self.playlist_tracks.get(playlist_id, [])))
+
+
+def run(latency: float, messages: int):
+    main.configure_db()
+    main.match_cache = MatchCache()
+    services = []
+
+    def create(service_id: str, credentials: Dict[str, str]) -> FakeMusicService:
+        services.append(FakeMusicService(service_id, latency))
+        return services[-1]
+
+    service_ids = ["spotify", "tidal"]
+    factories = {service_id: partial(create, service_id) for service_id in service_ids}
+    main.service_registry = ServiceRegistry(main.credential_store, factories)
+    main.link_extractor = LinkExtractor([FakeMusicService(service_id, latency) for service_id in service_ids])
+
+    # Two tenants, each with two chats
+    tenants = ["tenant-0", "tenant-1"]
+    for tenant_id in tenants:
+        for service_id in service_ids:
+            main.register_tenant(tenant_id, service_id, {})
+
+    chats = [f"chat-{i}" for i in range(4)]
+    for i, chat_id in enumerate(chats):
+        tenant_id = tenants[i % len(tenants)]
+        main.initialise_chat(chat_id)
+        main.chat_repository.set_album_mode(chat_id, ALBUM_MODES[i % len(ALBUM_MODES)])
+        for service in main.service_registry.get_services(tenant_id):
+            playlist = Playlist(chat_id, [], "", f"{chat_id}-{service.id}")
+            main.set_chat_playlist(service, playlist, chat_id, tenant_id)
+
+    texts = []
+    for i in range(messages):
+        links = [f"https://spotify.com/track/a{i}x{j}" for j in range(3)]
+        links += [f"https://tidal.com/track/b{i}x{j}" for j in range(3)]
+        links += [f"https://spotify.com/album/al{i}"]
+        texts.append(" ".join(links))
+
+    start = time.perf_counter()
+    main.job_workers.start()
+    for i, text in enumerate(texts):
+        main.queue_track_links(main.link_extractor.extract(text), chats[i % len(chats)], str(i))
+        main.job_workers.wake()
+    while any(main.job_queue.counts().get(status, 0) > 0 for status in [jobs.PENDING, jobs.RUNNING]):
+        time.sleep(0.01)
+    main.job_workers.stop()
+    main.write_queue.close()
+    elapsed = time.perf_counter() - start
+
+    calls = sum(s.calls for s in services)
+    added = sum(len(track_ids) for s in services for track_ids in s.playlist_tracks.values())
+    print(f"{messages} messages, {calls} service calls at {latency * 1000:.0f}ms latency, {added} tracks added")
+    print(f"Elapsed: {elapsed:.2f}s ({messages / elapsed:.1f} messages/s)")
+    print(f"Serial estimate: {calls * latency:.2f}s")
+    main.pipeline.shutdown()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("latency", type=float, nargs="?", default=0.05, help="seconds each API call takes")
+    parser.add_argument("messages", type=int, nargs="?", default=20, help="messages to process")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    run(args.latency, args.messages)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""
+Route fake Telegram updates through the sharded runtime, crash a worker part way through,
+and check every chat's updates were still handled in order.
+
+Usage:
+python benchmarks/bench_shards.py [shards] [chats] [updates_per_chat]
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from typing import Dict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from sharding import ShardedRuntime, serve_shard
+
+# Time each fake update takes to handle, in seconds
+HANDLE_LATENCY = 0.001
+
+
+def handle_shard(shard: int, updates):
+    path = os.path.join(os.environ["BENCH_SHARDS_DIR"], f"shard-{shard}.jsonl")
+    with open(path, "a") as results:
+
+        def handle(update: Dict):
+            if update.get("crash"):
+                os._exit(1)
+            time.sleep(HANDLE_LATENCY)
+            message = update["message"]
+            results.write(json.dumps({"chat": message["chat"]["id"], "seq": message["message_id"], "pid": os.getpid()}))
+            results.write("\n")
+            results.flush()
+
+        serve_shard(shard, updates, handle)
+
+
+def fake_update(update_id: int, chat_id: int, message_id: int) -> Dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": message_id,
+            "date": 0,
+            "chat": {"id": chat_id, "type": "group"},
+            "text": f"https://spotify.com/track/{update_id}",
+        },
+    }
+
+
+def run(shards: int, chats: int, updates_per_chat: int):
+    os.environ["BENCH_SHARDS_DIR"] = tempfile.mkdtemp()
+    runtime = ShardedRuntime(shards, handle_shard)
+    runtime.start()
+
+    total = chats * updates_per_chat
+    start = time.perf_counter()
+    for i in range(total):
+        runtime.route(fake_update(i, i % chats, i // chats))
+        if i == total // 2:
+            # Goes to the shard of chat 0, which must carry on in order once that shard restarts
+            runtime.route({"update_id": -1, "crash": True, "message": {"chat": {"id": 0}}})
+    runtime.stop()
+    elapsed = time.perf_counter() - start
+
+    handled = {}
+    pids = set()
+    for name in os.listdir(os.environ["BENCH_SHARDS_DIR"]):
+        with open(os.path.join(os.environ["BENCH_SHARDS_DIR"], name)) as f:
+            for line in f:
+                result = json.loads(line)
+                handled.setdefault(result["chat"], []).append(result["seq"])
+                pids.add(result["pid"])
+
+    in_order = all(seqs == sorted(seqs) for seqs in handled.values())
+    count = sum(len(seqs) for seqs in handled.values())
+    print(f"{count}/{total} updates handled across {shards} shards by {len(pids)} processes")
+    print(f"Elapsed: {elapsed:.2f}s ({count / elapsed:.0f} updates/s)")
+    print(f"Restarts: {runtime.restarts}, chats in order: {in_order}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("shards", type=int, nargs="?", default=4, help="worker processes")
+    parser.add_argument("chats", type=int, nargs="?", default=100, help="chats sending updates")
+    parser.add_argument("updates_per_chat", type=int, nargs="?", default=50, help="updates sent in each chat")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    run(args.shards, args.chats, args.updates_per_chat)
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+"""
+Start the bot in fresh processes, with the admin user's Spotify and Tidal services talking to fake backends
+that take a while to authenticate, and time how long it takes to be ready for updates.
+
+Reports the time to import the bot, set it up and start taking updates, to handle the first update and to
+add its link to the chat's playlists, and when the admin's services are ready. Also reports which slow to
+import dependencies were imported while starting, and how long they take to import when first needed.
+With --eager, the bot waits for the admin's services before taking updates, as it used to.
+
+Usage:
+python benchmarks/bench_startup.py [--runs 5] [--auth-latency 0.5] [--eager]
+"""
+
+import argparse
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+from typing import Dict, List
+
+started_at = time.perf_counter()
+
+from generate_fixtures import CATALOGUE_PATH
+
+# Dependencies the bot only imports once they're needed
+DEFERRED_MODULES = ["telegram", "telegram.ext", "spotipy", "tidalapi", "requests"]
+
+# Chat the first update is sent in, and the admin user who owns its playlists
+CHAT_ID = "-1000"
+ADMIN_ID = "1000"
+
+# Stages of startup, in the order they are reached
+STAGES = ["import", "setup", "ready", "first_update", "first_added", "services_ready"]
+
+
+def elapsed() -> float:
+    return time.perf_counter() - started_at
+
+
+def wait_for(condition, timeout: float = 60) -> float:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError("Timed out waiting for the bot")
+        time.sleep(0.001)
+    return elapsed()
+
+
+def start(args) -> Dict:
+    """
+    Start the bot in this process, returning when each stage was reached in seconds since the process started.
+    """
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+    os.chdir(tempfile.mkdtemp())
+    os.environ["SPOTELEGRAMIFY_ADMIN_USER_TELEGRAM_ID"] = ADMIN_ID
+
+    import main
+
+    times = {"import": elapsed()}
+    imported = [name for name in DEFERRED_MODULES if name in sys.modules]
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    from backends import BenchSpotifyMusicService, BenchTidalMusicService, FakeSpotify, FakeTidalSession
+
+    with open(args.catalogue) as f:
+        catalogue = json.load(f)
+    backends = [FakeSpotify(catalogue, latency=args.latency), FakeTidalSession(catalogue, latency=args.latency)]
+
+    def startup_service(service_class, backend):
+        class StartupMusicService(service_class):
+            """
+            The service, with the admin's credentials in the environment and authentication that takes a while.
+            """
+
+            def __init__(self, credentials: Dict[str, str]):
+                super().__init__(credentials, backend)
+
+            @classmethod
+            def env_credentials(cls) -> Dict[str, str]:
+                return {name: "bench" for name in cls.credential_names}
+
+            def refresh_auth(self) -> float:
+                time.sleep(args.auth_latency)
+                return super().refresh_auth()
+
+        return StartupMusicService
+
+    service_classes = [
+        startup_service(service_class, backend)
+        for service_class, backend in zip([BenchSpotifyMusicService, BenchTidalMusicService], backends)
+    ]
+    main.get_all_music_services = lambda: service_classes
+    main.notify = lambda chat_id, message_id, text: None
+
+    main.setup()
+    times["setup"] = elapsed()
+    if args.eager:
+        main.service_registry.get_services(ADMIN_ID)
+    main.job_workers.start()
+    times["ready"] = elapsed()
+
+    # The chat's playlists were set before the bot started
+    main.initialise_chat(CHAT_ID)
+    for backend in backends:
+        backend.create_playlist(CHAT_ID)
+        main.chat_repository.set_playlist_id(CHAT_ID, backend.service_id, CHAT_ID, ADMIN_ID)
+
+    track = next(t for t in catalogue["tracks"] if t["spotify_id"] is not None and t["tidal_id"] is not None)
+    text = f"Listen to this https://open.spotify.com/track/{track['spotify_id']}"
+    message = SimpleNamespace(message_id=1, chat=SimpleNamespace(id=CHAT_ID, type="group"), text=text)
+    main.parse_track_links(SimpleNamespace(message=message), None)
+    times["first_update"] = elapsed()
+
+    times["first_added"] = wait_for(lambda: all(len(backend.playlists[CHAT_ID]) > 0 for backend in backends))
+    times["services_ready"] = wait_for(lambda: main.service_registry.stats()["created"] >= len(service_classes))
+    main.job_workers.stop()
+    main.write_queue.close()
+
+    # What deferring the imports saves, paid when they are first needed instead
+    import_times = {}
+    for name in DEFERRED_MODULES:
+        if name not in sys.modules:
+            import_start = time.perf_counter()
+            try:
+                __import__(name)
+            except ImportError:
+                continue
+            import_times[name] = time.perf_counter() - import_start
+
+    return {"times": times, "imported": imported, "import_times": import_times}
+
+
+def run(args):
+    command = [sys.executable, os.path.abspath(__file__), "--child"] + sys.argv[1:]
+    results: List[Dict] = []
+    for _ in range(args.runs):
+        process_start = time.perf_counter()
+        output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+        result = json.loads(output.splitlines()[-1])
+        result["process"] = time.perf_counter() - process_start
+        results.append(result)
+
+    mode = "eager" if args.eager else "lazy"
+    print(f"Startup with {mode} services, {args.auth_latency}s to authenticate, median of {args.runs} runs:")
+    for stage in STAGES:
+        print(f"  {stage}: {statistics.median(r['times'][stage] for r in results) * 1000:.0f}ms")
+    print(f"  whole process: {statistics.median(r['process'] for r in results) * 1000:.0f}ms")
+    print(f"Deferred modules imported while starting: {results[0]['imported']}")
+    for name, seconds in results[0]["import_times"].items():
+        print(f"  importing {name} when needed: {seconds * 1000:.0f}ms")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--catalogue", default=CATALOGUE_PATH, help="catalogue the fake backends serve")
+    parser.add_argument("--runs", type=int, default=5, help="processes to start")
+    parser.add_argument("--auth-latency", type=float, default=0.5, help="seconds each service takes to authenticate")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds each API call takes")
+    parser.add_argument("--eager", action="store_true", help="wait for the admin's services before taking updates")
+    parser.add_argument("--verbose", action="store_true", help="log as the bot would")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.child:
+        print(json.dumps(start(args)))
+    else:
+        run(args)
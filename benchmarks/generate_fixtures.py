@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+"""
+Generate a catalogue of tracks and albums for the fake music service backends, and a corpus of
+Telegram updates from group chats sharing links to them, for `bench_e2e.py` to replay.
+
+The same seed always generates the same fixtures.
+
+Usage:
+python benchmarks/generate_fixtures.py [tracks] [messages] [chats] [seed]
+"""
+
+import argparse
+import json
+import os
+import random
+from typing import Dict, List
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+CATALOGUE_PATH = os.path.join(FIXTURES_DIR, "catalogue.json")
+CORPUS_PATH = os.path.join(FIXTURES_DIR, "corpus.jsonl")
+
+WORDS = (
+    "love night city dream fire heart summer rain gold river light shadow wild blue electric midnight ocean glass "
+    "paper silver echo velvet neon stone morning ghost honey thunder satellite garden highway mirror"
+).split()
+
+CHAT = [
+    "anyone up for the pub later?",
+    "lol",
+    "that gig last night was unreal",
+    "has anyone seen my charger",
+    "https://www.youtube.com/watch?v=dQw4w9WgXcQ",
+    "new album from them is out friday, can't wait",
+    "ok see you at 8",
+]
+
+ALPHABET = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
+
+# Share of tracks only on one of the services, and of links to things on neither
+SINGLE_SERVICE_RATIO = 0.05
+BROKEN_LINK_RATIO = 0.02
+
+# Share of messages with links, and of links that are to albums
+LINK_RATIO = 0.3
+ALBUM_LINK_RATIO = 0.1
+
+
+def title(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(words)).title()
+
+
+def spotify_id(rng: random.Random) -> str:
+    return "".join(rng.choice(ALPHABET) for _ in range(22))
+
+
+def tidal_id(rng: random.Random) -> str:
+    return str(rng.randint(10**7, 10**9))
+
+
+def generate_catalogue(rng: random.Random, tracks: int) -> Dict:
+    catalogue = {"tracks": [], "albums": []}
+    while len(catalogue["tracks"]) < tracks:
+        artist = title(rng, rng.randint(1, 2))
+        album = {"name": title(rng, rng.randint(1, 3)), "spotify_id": spotify_id(rng), "tidal_id": tidal_id(rng)}
+        album["tracks"] = []
+        for _ in range(rng.randint(6, 16)):
+            track = {
+                "isrc": f"GBBEN24{len(catalogue['tracks']):05d}",
+                "name": title(rng, rng.randint(1, 4)),
+                "artist": artist,
+                "duration_ms": rng.randint(120, 360) * 1000,
+                "popularity": rng.randint(0, 100),
+                "spotify_id": spotify_id(rng),
+                "tidal_id": tidal_id(rng),
+            }
+            if rng.random() < SINGLE_SERVICE_RATIO:
+                track[rng.choice(["spotify_id", "tidal_id"])] = None
+            album["tracks"].append(track["isrc"])
+            catalogue["tracks"].append(track)
+        catalogue["albums"].append(album)
+
+    return catalogue
+
+
+def link(rng: random.Random, catalogue: Dict) -> str:
+    service_id = rng.choice(["spotify", "tidal"])
+    if rng.random() < ALBUM_LINK_RATIO:
+        kind, things = "album", catalogue["albums"]
+    else:
+        kind, things = "track", catalogue["tracks"]
+
+    id = rng.choice(things)[f"{service_id}_id"]
+    if id is None or rng.random() < BROKEN_LINK_RATIO:
+        id = spotify_id(rng) if service_id == "spotify" else tidal_id(rng)
+
+    if service_id == "spotify":
+        return rng.choice([f"https://open.spotify.com/{kind}/{id}?si={spotify_id(rng)[:16]}", f"spotify:{kind}:{id}"])
+    return rng.choice([f"https://tidal.com/browse/{kind}/{id}", f"https://listen.tidal.com/{kind}/{id}"])
+
+
+def generate_corpus(rng: random.Random, catalogue: Dict, messages: int, chats: int) -> List[Dict]:
+    updates = []
+    for i in range(messages):
+        chat_id = -1000 - rng.randrange(chats)
+        text = rng.choice(CHAT)
+        if rng.random() < LINK_RATIO:
+            links = [link(rng, catalogue) for _ in range(rng.randint(1, 3))]
+            text = " ".join([rng.choice(["check this out", "tune", ""])] + links).strip()
+        updates.append(
+            {
+                "update_id": 200000 + i,
+                "message": {
+                    "message_id": i + 1,
+                    "date": 1700000000 + i,
+                    "chat": {"id": chat_id, "type": "group", "title": f"Chat {chat_id}"},
+                    # Each chat's tenant is its first member, who is also the one who set its playlists
+                    "from": {"id": -chat_id, "is_bot": False, "first_name": "Member", "username": f"member{-chat_id}"},
+                    "text": text,
+                },
+            }
+        )
+    return updates
+
+
+def main(tracks: int, messages: int, chats: int, seed: int):
+    rng = random.Random(seed)
+    catalogue = generate_catalogue(rng, tracks)
+    with open(CATALOGUE_PATH, "w") as f:
+        json.dump(catalogue, f, separators=(",", ":"))
+
+    with open(CORPUS_PATH, "w") as f:
+        for update in generate_corpus(rng, catalogue, messages, chats):
+            f.write(json.dumps(update))
+            f.write("\n")
+
+    print(f"Wrote {len(catalogue['tracks'])} tracks in {len(catalogue['albums'])} albums to {CATALOGUE_PATH}")
+    print(f"Wrote {messages} updates from {chats} chats to {CORPUS_PATH}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("tracks", type=int, nargs="?", default=500, help="tracks in the catalogue")
+    parser.add_argument("messages", type=int, nargs="?", default=300, help="updates in the corpus")
+    parser.add_argument("chats", type=int, nargs="?", default=8, help="chats the updates are sent in")
+    parser.add_argument("seed", type=int, nargs="?", default=0, help="seed for the fixtures")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args.tracks, args.messages, args.chats, args.seed)
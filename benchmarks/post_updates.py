@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+"""
+Post recorded Telegram updates to a running webhook server, as Telegram would.
+
+Usage:
+SPOTELEGRAMIFY_WEBHOOK_SECRET=<secret> python benchmarks/post_updates.py <updates.jsonl> [url]
+
+Updates are sent with the bot's webhook secret, and the URL defaults to http://127.0.0.1:8443/<secret>,
+matching the webhook defaults.
+"""
+
+import argparse
+import os
+import sys
+import time
+import urllib.error
+import urllib.request
+from collections import Counter
+
+
+def post(url: str, secret: str, body: bytes) -> int:
+    headers = {"Content-Type": "application/json", "X-Telegram-Bot-Api-Secret-Token": secret}
+    request = urllib.request.Request(url, data=body, headers=headers, method="POST")
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def main(path: str, url: str, secret: str):
+    statuses = Counter()
+    start = time.perf_counter()
+    with open(path, "rb") as updates:
+        for line in updates:
+            if line.strip():
+                statuses[post(url, secret, line.strip())] += 1
+    elapsed = time.perf_counter() - start
+
+    total = sum(statuses.values())
+    print(f"Posted {total} updates in {elapsed:.2f}s ({total / elapsed:.0f}/s)")
+    for status, count in sorted(statuses.items()):
+        print(f"  {status}: {count}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("updates", help="Telegram updates to post, one per line")
+    parser.add_argument("url", nargs="?", default=None, help="webhook URL, http://127.0.0.1:8443/<secret> by default")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    secret = os.environ.get("SPOTELEGRAMIFY_WEBHOOK_SECRET")
+    if not secret:
+        sys.exit("SPOTELEGRAMIFY_WEBHOOK_SECRET must be set to the bot's webhook secret")
+    main(args.updates, args.url or f"http://127.0.0.1:8443/{secret}", secret)
@@ -0,0 +1,112 @@
+import asyncio
+import logging
+from collections import defaultdict
+from typing import Awaitable, Callable, Dict, List
+
+from music_services.aio import run_sync
+
+logger = logging.getLogger(__name__)
+
+# How long each long-poll for updates waits for something to arrive, in seconds
+POLL_TIMEOUT = 30
+
+Handler = Callable[..., Awaitable[None]]
+
+
+class CommandContext:
+    """
+    The parts of python-telegram-bot's CallbackContext our handlers use.
+    """
+
+    def __init__(self, bot, args: List[str], error: Exception = None):
+        self.bot = bot
+        self.args = args
+        self.error = error
+
+
+class AsyncRuntime:
+    """
+    Runs the bot on an asyncio event loop instead of the Updater's threads.
+
+    Updates are fetched with a long poll and each is handled in its own task, so a slow
+    music service only holds up the chat it is working for.
+    Updates from the same chat are handled one at a time, in the order they arrived.
+    """
+
+    def __init__(
+        self,
+        bot,
+        commands: Dict[str, Handler],
+        message_handler: Handler,
+        error_handler: Callable,
+        background: List[Callable[[], Awaitable[None]]] = [],
+    ):
+        self.bot = bot
+        self.background = background
+        self.commands = commands
+        self.message_handler = message_handler
+        self.error_handler = error_handler
+        self.chat_locks: Dict[str, asyncio.Lock] = {}
+        self.chat_users: Dict[str, int] = defaultdict(int)
+        self.tasks = set()
+        self.background_tasks = set()
+
+    def run(self):
+        asyncio.run(self.poll())
+
+    async def poll(self):
+        for coroutine in self.background:
+            self.background_tasks.add(asyncio.create_task(coroutine()))
+
+        offset = None
+        while True:
+            try:
+                updates = await run_sync(self.bot.get_updates, offset=offset, timeout=POLL_TIMEOUT)
+            except Exception as e:
+                logger.warning("Failed to fetch updates: %s", e)
+                await asyncio.sleep(1)
+                continue
+
+            for update in updates:
+                offset = update.update_id + 1
+                self.submit(update)
+
+    def submit(self, update) -> asyncio.Task:
+        """
+        Handle the update in the background, after any earlier updates from the same chat.
+        """
+        task = asyncio.create_task(self.dispatch(update))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def dispatch(self, update):
+        message = update.message
+        if message is None:
+            return
+
+        chat_id = str(message.chat.id)
+        self.chat_users[chat_id] += 1
+        lock = self.chat_locks.setdefault(chat_id, asyncio.Lock())
+        try:
+            async with lock:
+                await self.handle(update)
+        except Exception as e:
+            self.error_handler(update, CommandContext(self.bot, [], error=e))
+        finally:
+            self.chat_users[chat_id] -= 1
+            if self.chat_users[chat_id] < 1:
+                del self.chat_users[chat_id]
+                del self.chat_locks[chat_id]
+
+    async def handle(self, update):
+        text = update.message.text or ""
+        if text.startswith("/"):
+            words = text.split()
+            command = words[0][1:].split("@")[0]
+            handler = self.commands.get(command)
+            if handler is not None:
+                await handler(update, CommandContext(self.bot, words[1:]))
+                return
+
+        await self.message_handler(update, CommandContext(self.bot, []))
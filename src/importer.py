@@ -0,0 +1,226 @@
+import json
+import logging
+import time
+from typing import Callable, Dict, Iterator, List, NamedTuple, Set, TextIO
+
+from music_services.database import Database
+from music_services.links import Link, LinkExtractor
+
+logger = logging.getLogger(__name__)
+
+# Characters of the export read at a time
+READ_SIZE = 64 * 1024
+
+# Messages imported between checkpoints
+IMPORT_BATCH_SIZE = 1000
+
+
+class ImportProgress(NamedTuple):
+    # ID of the last message imported, later messages are imported when resuming
+    position: int = 0
+    messages: int = 0
+    links: int = 0
+    queued: int = 0
+
+
+class ExportReader:
+    """
+    Streams the messages of a Telegram Desktop chat export (result.json) one at a time,
+    so that the export is never read into memory whole.
+
+    Other fields of the export are skipped, as are exports of all chats at once.
+    """
+
+    def __init__(self, f: TextIO):
+        self.f = f
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def messages(self) -> Iterator[Dict]:
+        self._expect("{")
+        while self._next_member("}"):
+            key = self._decode()
+            self._expect(":")
+            if key != "messages":
+                self._decode()
+                continue
+
+            self._expect("[")
+            while self._next_member("]"):
+                yield self._decode()
+            return
+
+        raise ValueError("Not a Telegram chat export, it has no messages")
+
+    def _next_member(self, end: str) -> bool:
+        """
+        Move past the separator before the next member of an object or array, giving False at its end.
+        """
+        char = self._peek()
+        if char == end:
+            self.pos += 1
+            return False
+        if char == ",":
+            self.pos += 1
+        return True
+
+    def _expect(self, char: str):
+        if self._peek() != char:
+            raise ValueError(f"Expected '{char}' at character {self.pos} of the export")
+        self.pos += 1
+
+    def _peek(self) -> str:
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._read():
+                raise ValueError("Telegram export ended early")
+
+    def _decode(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # A value at the very end of the buffer may have been cut off, e.g. a number
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._read()
+
+    def _read(self) -> bool:
+        chunk = self.f.read(READ_SIZE)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos :] + chunk
+        self.pos = 0
+        return True
+
+
+def message_text(message: Dict) -> str:
+    """
+    Get the text of an exported message, including the targets of any links hidden behind other text.
+    """
+    text = message.get("text", "")
+    if isinstance(text, str):
+        return text
+
+    parts = []
+    for part in text:
+        if isinstance(part, str):
+            parts.append(part)
+        else:
+            parts.append(part.get("text", ""))
+            if "href" in part:
+                parts.append(f" {part['href']} ")
+    return "".join(parts)
+
+
+class ImportCheckpoints:
+    """
+    Stores how far each chat's history has been imported, so that an import can pick up where it stopped.
+    """
+
+    def __init__(self, database: Database):
+        self.database = database
+
+    def configure(self):
+        self.database.execute(
+            """
+            CREATE TABLE IF NOT EXISTS imports (
+                chat_id TEXT PRIMARY KEY,
+                position INTEGER,
+                messages INTEGER,
+                links INTEGER,
+                queued INTEGER,
+                updated_at REAL
+            )
+        """
+        )
+
+    def get(self, chat_id: str) -> ImportProgress:
+        rows = self.database.execute(
+            "SELECT position, messages, links, queued FROM imports WHERE chat_id = ?",
+            (chat_id,),
+        )
+        return ImportProgress(*rows[0]) if len(rows) > 0 else ImportProgress()
+
+    def save(self, chat_id: str, progress: ImportProgress):
+        self.database.execute(
+            """
+            INSERT OR REPLACE INTO imports (chat_id, position, messages, links, queued, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            (chat_id, *progress, time.time()),
+        )
+
+
+class HistoryImporter:
+    """
+    Queues the links in a chat's exported history to be added to its playlists.
+
+    The export is streamed, and links already seen earlier in it are skipped.
+    After every `batch_size` messages the position is checkpointed and the job workers woken,
+    so that links are looked up and written in batches while the rest of the export is read.
+    Messages up to the checkpoint are skipped when an import is run again, e.g. after a restart
+    or with a newer export of the same chat.
+    """
+
+    def __init__(
+        self,
+        checkpoints: ImportCheckpoints,
+        link_extractor: LinkExtractor,
+        queue_links: Callable[[List[Link], str, str], int],
+        wake: Callable[[], None],
+        batch_size: int = IMPORT_BATCH_SIZE,
+    ):
+        self.checkpoints = checkpoints
+        self.link_extractor = link_extractor
+        self.queue_links = queue_links
+        self.wake = wake
+        self.batch_size = batch_size
+
+    def run(self, chat_id: str, f: TextIO) -> ImportProgress:
+        position, messages, links, queued = self.checkpoints.get(chat_id)
+        seen: Set[Link] = set()
+        batch = 0
+
+        for message in ExportReader(f).messages():
+            if message.get("type") != "message" or message["id"] <= position:
+                continue
+
+            message_links = list(dict.fromkeys(self.link_extractor.extract(message_text(message))))
+            message_links = [link for link in message_links if link not in seen]
+            seen.update(message_links)
+            if len(message_links) > 0:
+                links += len(message_links)
+                queued += self.queue_links(message_links, chat_id, str(message["id"]))
+
+            position = message["id"]
+            messages += 1
+            batch += 1
+            if batch >= self.batch_size:
+                self._checkpoint(chat_id, ImportProgress(position, messages, links, queued))
+                batch = 0
+
+        return self._checkpoint(chat_id, ImportProgress(position, messages, links, queued))
+
+    def _checkpoint(self, chat_id: str, progress: ImportProgress) -> ImportProgress:
+        self.checkpoints.save(chat_id, progress)
+        self.wake()
+        logger.info(
+            "Imported %s messages of chat %s up to %s, queued %s jobs for %s links",
+            progress.messages,
+            chat_id,
+            progress.position,
+            progress.queued,
+            progress.links,
+        )
+        return progress
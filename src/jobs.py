@@ -0,0 +1,353 @@
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+from music_services.database import Database, get_database
+from music_services.links import Link
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# Retry delays double from the base up to the maximum, in seconds
+RETRY_BASE_DELAY = 30
+RETRY_MAX_DELAY = 60 * 60
+
+# How long finished jobs are kept before being deleted, in seconds
+FINISHED_JOB_TTL = 7 * 24 * 60 * 60
+
+# How long a claimed job is held for its process, in seconds. Leases are renewed while jobs run,
+# so a job whose lease ran out was left running by a process that died, and is run again.
+JOB_LEASE = 60
+
+
+class Job(NamedTuple):
+    id: int
+    chat_id: str
+    message_id: str
+    service_id: str
+    playlist_id: str
+    link: Link
+    attempts: int
+    # Whether the chat is told how the job went, which it isn't for links imported from its history
+    notify: bool = True
+
+
+class JobQueue:
+    """
+    Durable queue of links waiting to be added to a chat's playlist on a service.
+
+    There is one job per (message, target service, link), identified by an idempotency key
+    so that the same message is never queued twice.
+    Jobs that fail are retried with exponential backoff until they run out of attempts.
+    A chat's jobs are never claimed while another of its jobs is running, so playlist
+    additions for a chat happen in the order the links were shared.
+    When chats are sharded across processes, each queue only claims the jobs of its own `shard`,
+    and a queue given a `chat_id` only claims that chat's jobs.
+
+    Claimed jobs are leased to the claiming process for `lease` seconds, and the lease is renewed
+    while they run, see `start_renewing`. Several processes can share the queue, e.g. the bot and
+    an import on the command line, and only jobs whose lease ran out are claimed again.
+    """
+
+    def __init__(
+        self, database: Database = None, max_attempts: int = 8, shard: Optional[int] = None, lease: float = JOB_LEASE
+    ):
+        self.database = database if database is not None else get_database()
+        self.max_attempts = max_attempts
+        self.shard = shard
+        self.chat_id: Optional[str] = None
+        self.lease = lease
+        self.lock = threading.Lock()
+        # Jobs claimed by this process that haven't finished, whose leases are renewed
+        self.running: Dict[int, Job] = {}
+        self.renewer = None
+
+    def configure(self):
+        """
+        Create the jobs table, and delete jobs that finished long ago.
+        """
+        with self.database.connection() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    idempotency_key TEXT UNIQUE,
+                    chat_id TEXT,
+                    message_id TEXT,
+                    service_id TEXT,
+                    playlist_id TEXT,
+                    source_service_id TEXT,
+                    kind TEXT,
+                    source_id TEXT,
+                    status TEXT,
+                    attempts INTEGER DEFAULT 0,
+                    next_run_at REAL,
+                    last_error TEXT,
+                    updated_at REAL,
+                    shard INTEGER,
+                    notify INTEGER DEFAULT 1,
+                    lease_expires_at REAL
+                )
+            """
+            )
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(jobs)")]
+            if "shard" not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN shard INTEGER")
+            if "notify" not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN notify INTEGER DEFAULT 1")
+            if "lease_expires_at" not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN lease_expires_at REAL")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, next_run_at)")
+            conn.execute(
+                "DELETE FROM jobs WHERE status IN (?, ?) AND updated_at < ?",
+                (DONE, FAILED, time.time() - FINISHED_JOB_TTL),
+            )
+
+    def assign_shards(self, shard_for: Callable[[str], Optional[int]]):
+        """
+        Move unfinished jobs to the shard now handling their chat, e.g. after the number of shards changed.
+        """
+        with self.database.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute("SELECT DISTINCT chat_id FROM jobs WHERE status IN (?, ?)", (PENDING, RUNNING))
+            chat_ids = [row[0] for row in rows.fetchall()]
+            conn.executemany(
+                "UPDATE jobs SET shard = ? WHERE chat_id = ? AND status IN (?, ?)",
+                [(shard_for(chat_id), chat_id, PENDING, RUNNING) for chat_id in chat_ids],
+            )
+
+    def enqueue(
+        self, chat_id: str, message_id: str, playlist_ids: Dict[str, str], links: List[Link], notify: bool = True
+    ) -> int:
+        """
+        Queue a job for every link and every service with a playlist, returning how many were new.
+        """
+        now = time.time()
+        rows = [
+            (
+                f"{chat_id}:{message_id}:{service_id}:{link.service_id}:{link.kind}:{link.id}",
+                chat_id,
+                message_id,
+                service_id,
+                playlist_id,
+                link.service_id,
+                link.kind,
+                link.id,
+                PENDING,
+                now,
+                now,
+                self.shard,
+                notify,
+            )
+            for service_id, playlist_id in playlist_ids.items()
+            for link in links
+        ]
+        with self.database.connection() as conn:
+            before = conn.total_changes
+            conn.executemany(
+                """
+                INSERT OR IGNORE INTO jobs (
+                    idempotency_key, chat_id, message_id, service_id, playlist_id,
+                    source_service_id, kind, source_id, status, next_run_at, updated_at, shard, notify
+                )
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                rows,
+            )
+            return conn.total_changes - before
+
+    def claim(self, limit: int) -> List[Job]:
+        """
+        Mark up to `limit` due jobs as running and return them, oldest first.
+        Jobs whose lease ran out, e.g. because the process running them died, are due again.
+        """
+        now = time.time()
+        with self.lock, self.database.connection() as conn:
+            # Take the write lock up front so that other processes can't claim the same jobs
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                """
+                UPDATE jobs SET status = ?
+                WHERE status = ? AND shard IS ? AND (lease_expires_at IS NULL OR lease_expires_at < ?)
+                """,
+                (PENDING, RUNNING, self.shard, now),
+            )
+            rows = conn.execute(
+                """
+                SELECT id, chat_id, message_id, service_id, playlist_id, source_service_id, kind, source_id,
+                    attempts, notify
+                FROM jobs
+                WHERE status = ? AND next_run_at <= ? AND shard IS ? AND (? IS NULL OR chat_id = ?)
+                AND chat_id NOT IN (SELECT chat_id FROM jobs WHERE status = ?)
+                ORDER BY id
+                LIMIT ?
+                """,
+                (PENDING, now, self.shard, self.chat_id, self.chat_id, RUNNING, limit),
+            ).fetchall()
+            conn.executemany(
+                "UPDATE jobs SET status = ?, updated_at = ?, lease_expires_at = ? WHERE id = ?",
+                [(RUNNING, now, now + self.lease, row[0]) for row in rows],
+            )
+
+            jobs = [
+                Job(row[0], row[1], row[2], row[3], row[4], Link(row[5], row[6], row[7]), row[8], bool(row[9]))
+                for row in rows
+            ]
+            self.running.update((job.id, job) for job in jobs)
+        return jobs
+
+    def complete(self, job: Job, error: Optional[str] = None):
+        """
+        Finish the job. An error here is final, e.g. the track doesn't exist, and is only recorded.
+        """
+        self._update(job, DONE, job.attempts + 1, time.time(), error)
+
+    def retry(self, job: Job, error: str) -> bool:
+        """
+        Put the job back to run again later, or fail it if it is out of attempts.
+        Returns whether it will be retried.
+        """
+        attempts = job.attempts + 1
+        if attempts >= self.max_attempts:
+            logger.warning("Job %s failed after %s attempts: %s", job.id, attempts, error)
+            self._update(job, FAILED, attempts, time.time(), error)
+            return False
+
+        delay = min(RETRY_BASE_DELAY * 2 ** (attempts - 1), RETRY_MAX_DELAY)
+        logger.info("Job %s failed, retrying in %ss: %s", job.id, delay, error)
+        self._update(job, PENDING, attempts, time.time() + delay, error)
+        return True
+
+    def renew(self):
+        """
+        Extend the leases of the jobs this process is running.
+        """
+        with self.lock:
+            job_ids = list(self.running)
+        if len(job_ids) < 1:
+            return
+        lease_expires_at = time.time() + self.lease
+        self.database.executemany(
+            "UPDATE jobs SET lease_expires_at = ? WHERE id = ? AND status = ?",
+            [(lease_expires_at, job_id, RUNNING) for job_id in job_ids],
+        )
+
+    def start_renewing(self):
+        """
+        Renew the leases of running jobs on a background thread, well before they run out.
+        """
+        if self.renewer is not None:
+            return
+
+        stopped = threading.Event()
+
+        def run():
+            while not stopped.wait(self.lease / 3):
+                try:
+                    self.renew()
+                except Exception as e:
+                    logger.warning("Failed to renew job leases: %s", e)
+
+        self.renewer = threading.Thread(target=run, name="job-leases", daemon=True)
+        self.renewer.stop = stopped
+        self.renewer.start()
+
+    def stop_renewing(self):
+        if self.renewer is not None:
+            self.renewer.stop.set()
+            self.renewer = None
+
+    def counts(self, chat_id: Optional[str] = None) -> Dict[str, int]:
+        """
+        Count jobs by status, of every chat or just the given one.
+        """
+        if chat_id is None:
+            return dict(self.database.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status"))
+        rows = self.database.execute("SELECT status, COUNT(*) FROM jobs WHERE chat_id = ? GROUP BY status", (chat_id,))
+        return dict(rows)
+
+    def due(self, chat_id: str) -> int:
+        """
+        Count the chat's pending jobs that are due to run, rather than waiting to be retried.
+        """
+        rows = self.database.execute(
+            "SELECT COUNT(*) FROM jobs WHERE chat_id = ? AND status = ? AND next_run_at <= ?",
+            (chat_id, PENDING, time.time()),
+        )
+        return rows[0][0]
+
+    def _update(self, job: Job, status: str, attempts: int, next_run_at: float, error: Optional[str]):
+        self.database.execute(
+            """
+            UPDATE jobs SET status = ?, attempts = ?, next_run_at = ?, last_error = ?, updated_at = ?
+            WHERE id = ?
+            """,
+            (status, attempts, next_run_at, error, time.time(), job.id),
+        )
+        with self.lock:
+            self.running.pop(job.id, None)
+
+
+class JobWorkers:
+    """
+    Threads that claim batches of due jobs and hand them to `process`.
+
+    `process` must complete or retry every job it is given; if it raises, they are all retried.
+    """
+
+    def __init__(
+        self,
+        jobs: JobQueue,
+        process: Callable[[List[Job]], None],
+        workers: int = 2,
+        batch_size: int = 50,
+        poll_interval: float = 1.0,
+    ):
+        self.jobs = jobs
+        self.process = process
+        self.workers = workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.threads: List[threading.Thread] = []
+
+    def start(self):
+        self.jobs.start_renewing()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"job-worker-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def wake(self):
+        """
+        Tell idle workers there are new jobs, rather than waiting for them to poll.
+        """
+        self.wakeup.set()
+
+    def stop(self):
+        self.stopped.set()
+        self.wakeup.set()
+        for thread in self.threads:
+            thread.join()
+        self.jobs.stop_renewing()
+
+    def _work(self):
+        while not self.stopped.is_set():
+            batch = self.jobs.claim(self.batch_size)
+            if len(batch) < 1:
+                self.wakeup.wait(self.poll_interval)
+                self.wakeup.clear()
+                continue
+
+            try:
+                self.process(batch)
+            except Exception as e:
+                logger.exception("Failed to process jobs")
+                for job in batch:
+                    self.jobs.retry(job, str(e))
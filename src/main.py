@@ -4,25 +4,59 @@ Bot to build playlists.
 
 Usage:
 Press Ctrl-C on the command line or send a signal to the process to stop the bot.
+
+To add the links in a chat's history to its playlists from a Telegram Desktop export of the chat:
+python main.py import <chat ID> <path to result.json>
 """
 
+from __future__ import annotations
+
+import asyncio
+import json
 import logging
 import os
 import re
-import sqlite3
+import signal
 import sys
-import urllib.parse
-from typing import List
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import Future
+from functools import partial
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple, Union
 
-from telegram import Update
-from telegram.ext import CommandHandler, Filters, MessageHandler, Updater
-from music_services.music_service import MusicService, get_all_music_services, get_music_service_by_id
+from music_services.aio import run_sync
+from music_services.albums import DEFAULT_TOP_TRACKS, AlbumMode, parse_album_mode
+from music_services.credentials import CredentialStore
+from music_services.database import get_database
+from music_services.links import ALBUM, TRACK, Link, LinkExtractor
+from music_services.match_cache import MatchCache
+from music_services.metrics import COUNT_BUCKETS, Trace, enable_traces, metrics, observe, timer, trace
+from music_services.music_service import MusicService, get_all_music_services
+from music_services.registry import ServiceRegistry
+from music_services.scheduler import schedulers
 from music_services.things import Playlist, Track
 
 # Import these so that subclasses call works
 from music_services.spotify import SpotifyMusicService
 from music_services.things import Playlist, Track
 from music_services.tidal import TidalMusicService
+from async_runtime import POLL_TIMEOUT, AsyncRuntime
+from importer import HistoryImporter, ImportCheckpoints, ImportProgress
+from jobs import RUNNING, Job, JobQueue, JobWorkers
+from metrics_server import MetricsServer
+from mirror import ChatPlaylists, PlaylistMirror
+from pipeline import Pipeline
+from repository import ChatRepository
+from sharding import HashRing, ShardedRuntime, serve_shard
+from webhook import WebhookServer
+from write_queue import PlaylistWriteQueue
+
+# python-telegram-bot takes a while to import, so it is only imported by the runtimes that talk to Telegram
+if TYPE_CHECKING:
+    from telegram import Bot, Update
+    from telegram.ext import Updater
 
 # Enable logging
 logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
@@ -30,76 +64,245 @@ logger = logging.getLogger(__name__)
 
 # Get configuration from environment
 SPOTELEGRAMIFY_TELEGRAM_TOKEN = (
-    os.getenv("SPOTELEGRAMIFY_KEY") if sys.argv[1] != "test" else os.getenv("SPOTELEGRAMIFY_TEST_KEY")
+    os.getenv("SPOTELEGRAMIFY_TEST_KEY") if sys.argv[1:2] == ["test"] else os.getenv("SPOTELEGRAMIFY_KEY")
 )
 SPOTELEGRAMIFY_ADMIN_USER_TELEGRAM_ID = os.getenv("SPOTELEGRAMIFY_ADMIN_USER_TELEGRAM_ID")
 
-available_services: List[MusicService] = []
+# Tenant of chats set up before there were tenants, whose credentials come from the environment
+DEFAULT_TENANT_ID = SPOTELEGRAMIFY_ADMIN_USER_TELEGRAM_ID
+
+# Most tenant service instances to keep open at once, and how long an unused one is kept, in seconds
+MAX_TENANT_SERVICES = int(os.getenv("SPOTELEGRAMIFY_MAX_TENANT_SERVICES", 64))
+TENANT_IDLE_TIMEOUT = int(os.getenv("SPOTELEGRAMIFY_TENANT_IDLE_TIMEOUT", 60 * 60))
+
+# How often to check playlists for changes made outside the bot, in seconds
+PLAYLIST_INDEX_RECONCILE_INTERVAL = int(os.getenv("SPOTELEGRAMIFY_PLAYLIST_INDEX_RECONCILE_INTERVAL", 600))
+
+# How often to sync chats' playlists on different services with each other, in seconds, or 0 not to
+MIRROR_INTERVAL = int(os.getenv("SPOTELEGRAMIFY_MIRROR_INTERVAL", 60 * 60))
+
+# One of "polling", using python-telegram-bot's Updater, "asyncio", "webhook" or "sharded"
+RUNTIME = os.getenv("SPOTELEGRAMIFY_RUNTIME", "polling")
+
+# Number of worker processes chats are spread across by the sharded runtime
+SHARDS = int(os.getenv("SPOTELEGRAMIFY_SHARDS", 4))
+
+# File of recorded updates for the sharded runtime to handle instead of receiving them from Telegram
+REPLAY_UPDATES = os.getenv("SPOTELEGRAMIFY_REPLAY_UPDATES")
+
+# Where the webhook server listens, the public URL Telegram should send updates to, and a secret
+# that Telegram sends with every update and is also the path it posts to
+WEBHOOK_HOST = os.getenv("SPOTELEGRAMIFY_WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("SPOTELEGRAMIFY_WEBHOOK_PORT", 8443))
+WEBHOOK_URL = os.getenv("SPOTELEGRAMIFY_WEBHOOK_URL")
+WEBHOOK_SECRET = os.getenv("SPOTELEGRAMIFY_WEBHOOK_SECRET")
+
+# Characters Telegram allows in a webhook's secret token
+WEBHOOK_SECRET_REGEX = r"[A-Za-z0-9_-]{1,256}"
+
+# Where the metrics server listens, if a port is set. In the sharded runtime, the ingress process listens
+# on the port and each shard on the ports after it
+METRICS_HOST = os.getenv("SPOTELEGRAMIFY_METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("SPOTELEGRAMIFY_METRICS_PORT")) if os.getenv("SPOTELEGRAMIFY_METRICS_PORT") else None
+
+# File to append a JSON trace of every update and batch of jobs to, if set
+TRACE_FILE = os.getenv("SPOTELEGRAMIFY_TRACE_FILE")
+
+# Maximum number of concurrent calls against a single music service
+SERVICE_CONCURRENCY = int(os.getenv("SPOTELEGRAMIFY_SERVICE_CONCURRENCY", 4))
+
+# How long to hold playlist additions so they can be written together, in seconds, and the most to write at once
+WRITE_WINDOW = float(os.getenv("SPOTELEGRAMIFY_WRITE_WINDOW", 1.0))
+WRITE_BATCH_SIZE = int(os.getenv("SPOTELEGRAMIFY_WRITE_BATCH_SIZE", 100))
+
+# Number of workers processing queued links, how many jobs each takes at once, and how often idle workers check
+# for jobs due for retry, in seconds
+JOB_WORKERS = int(os.getenv("SPOTELEGRAMIFY_JOB_WORKERS", 2))
+JOB_BATCH_SIZE = 50
+JOB_POLL_INTERVAL = 1.0
+
+# Largest file the Telegram Bot API lets bots download, bigger exports have to be imported on the command line
+TELEGRAM_MAX_DOWNLOAD_SIZE = 20 * 1024 * 1024
+
+# How often the command line import reports how many of the chat's jobs are left, in seconds
+IMPORT_REPORT_INTERVAL = 10
+
+service_registry: ServiceRegistry = None
+pipeline = Pipeline(per_service_limit=SERVICE_CONCURRENCY)
+write_queue = PlaylistWriteQueue(window=WRITE_WINDOW, max_batch=WRITE_BATCH_SIZE)
+match_cache: MatchCache = None
+link_extractor: LinkExtractor = None
+service_semaphores: Dict[str, asyncio.Semaphore] = {}
+chat_repository = ChatRepository(get_database())
+credential_store = CredentialStore(get_database())
+job_queue = JobQueue(get_database())
+import_checkpoints = ImportCheckpoints(get_database())
+job_workers = JobWorkers(
+    job_queue,
+    lambda jobs: process_jobs(jobs),
+    workers=JOB_WORKERS,
+    batch_size=JOB_BATCH_SIZE,
+    poll_interval=JOB_POLL_INTERVAL,
+)
+playlist_mirror = PlaylistMirror(
+    get_database(),
+    lambda: get_mirrored_chat_ids(),
+    lambda chat_id: get_chat_playlists(chat_id),
+    lambda service, track: resolve_track_id(service, track),
+    pipeline,
+    write_queue,
+)
+async_job_wakeup: asyncio.Event = None
+
+# Sends a reply to a message, given the chat ID, message ID and text
+notify: Callable[[str, str, str], None] = None
 
 
 def configure_db():
     """
     Set up a local database to track the playlist associated with each Telegram chat.
     """
-    conn = sqlite3.connect("spotelegramify")
-    cursor = conn.cursor()
-    cursor.execute(
-        """
-        CREATE TABLE IF NOT EXISTS chats (
-            chat_id TEXT PRIMARY KEY,
-            spotify_playlist_id TEXT,
-            tidal_playlist_id TEXT
-        )
-    """
-    )
-    conn.commit()
+    chat_repository.configure()
+    credential_store.configure()
+    job_queue.configure()
+    import_checkpoints.configure()
+    playlist_mirror.configure()
 
 
 def set_chat_playlist_guard(update: Update, context):
 
     chat_id = update.message.chat.id
-    user_name = update.message.from_user["username"]
-    user_id = update.message.from_user["id"]
-    chat_name = update.message.chat.title if update.message.chat.title is not None else user_name
-
-    # Only admin user can update playlist ID
-    if str(user_id) != str(SPOTELEGRAMIFY_ADMIN_USER_TELEGRAM_ID):
-        logger.warning(f"User with id {user_id} doesn't match admin user {SPOTELEGRAMIFY_ADMIN_USER_TELEGRAM_ID} !")
-        update.message.reply_text("Only the admin user can change the playlist ID!")
+    tenant_id = get_user_tenant_id(update)
+    if tenant_id is None:
         return
 
     if len(context.args) < 2:
-        logger.info(f"Invalid use of set_playlist.")
+        logger.info("Invalid use of set_playlist.")
         update.message.reply_text(f"Invalid use of set_playlist!")
         return
 
     music_service_id = context.args[0]
     playlist_id = context.args[1]
 
-    service = get_music_service_by_id(available_services, music_service_id)
+    service = service_registry.get(tenant_id, music_service_id.lower())
 
     if service is None:
-        all_service_ids = [s.id for s in available_services]
+        all_service_ids = credential_store.service_ids(tenant_id)
         update.message.reply_text(f"Unknown music service '{music_service_id}'")
         update.message.reply_text(f"Try one of these: '{all_service_ids}'")
         return None
 
-    service_playlist = service.lookup_service_playlist(playlist_id)
+    # Always fetch the playlist fresh when it is being set, in case it was renamed
+    service.playlist_cache.invalidate(playlist_id)
+    try:
+        service_playlist = service.get_playlist(playlist_id)
+    except Exception as e:
+        logger.warning("Failed to look up %s playlist %s: %s", service.name, playlist_id, e)
+        update.message.reply_text(f"Couldn't reach {service.name} to check the playlist, try again later!")
+        return
     if service_playlist is None:
-        logger.info(f"Playlist ID '{playlist_id}' is not valid for {service.name}.")
+        logger.info("Playlist ID '%s' is not valid for %s.", playlist_id, service.name)
         update.message.reply_text(f"Playlist ID '{playlist_id}' is not valid for {service.name}!")
         return
 
     playlist = service.convert_playlist(service_playlist)
 
-    set_chat_playlist(service, playlist, chat_id)
+    set_chat_playlist(service, playlist, chat_id, tenant_id)
 
     update.message.reply_text(
         f"Songs in this chat will be added to {service.name} playlist '{playlist.name}'.\nLink to playlist:\n{playlist.link}"
     )
 
 
-def set_chat_playlist(service: MusicService, playlist: Playlist, chat_id) -> bool:
+def get_user_tenant_id(update: Update) -> Optional[str]:
+    """
+    Get the tenant ID of the user changing the chat's settings, replying and giving None if they aren't allowed to.
+    Only the chat's tenant can change its settings. Chats without one are the default tenant's.
+    """
+    chat_id = update.message.chat.id
+    user_id = update.message.from_user["id"]
+
+    tenant_id = str(user_id)
+    if not credential_store.is_tenant(tenant_id):
+        logger.warning("User with id %s has no music service credentials!", user_id)
+        update.message.reply_text("Only users who have registered their music service credentials can set a playlist!")
+        return None
+
+    chat_tenant_id = get_tenant_id(chat_id)
+    if chat_tenant_id != tenant_id:
+        logger.warning("User with id %s doesn't match chat tenant %s !", user_id, chat_tenant_id)
+        update.message.reply_text("Only this chat's tenant can change its settings, /init makes a new chat yours!")
+        return None
+
+    return tenant_id
+
+
+def set_album_mode_guard(update: Update, context):
+    """
+    Choose which tracks of albums shared in the chat are added: the first, the N most popular, or all of them.
+    """
+    if get_user_tenant_id(update) is None:
+        return
+
+    try:
+        album_mode = parse_album_mode(" ".join(context.args))
+    except ValueError:
+        usage = ["/album_mode first", f"/album_mode top {DEFAULT_TOP_TRACKS}", "/album_mode full"]
+        update.message.reply_text("Invalid use of album_mode! Try one of these:\n" + "\n".join(usage))
+        return
+
+    chat_repository.set_album_mode(str(update.message.chat.id), album_mode)
+    update.message.reply_text(f"Albums shared in this chat will add tracks in '{album_mode}' mode.")
+
+
+def import_history_guard(update: Update, context):
+    """
+    Add the links in the chat's history to its playlists, from the Telegram export of the chat the command replies to.
+    The export is imported in the background, without replying to each old message.
+    """
+    if get_user_tenant_id(update) is None:
+        return
+    if not any(get_chat_playlist_ids(update.message.chat.id).values()):
+        update.message.reply_text("Set a playlist with /set_playlist before importing!")
+        return
+
+    replied = update.message.reply_to_message
+    document = replied.document if replied is not None else None
+    if document is None:
+        update.message.reply_text("Reply /import to a Telegram export of this chat, its result.json file!")
+        return
+    if document.file_size is not None and document.file_size > TELEGRAM_MAX_DOWNLOAD_SIZE:
+        update.message.reply_text("That export is too big to download, ask the bot's admin to import it instead!")
+        return
+
+    update.message.reply_text("Importing links from this chat's history...")
+    threading.Thread(
+        target=import_history_document,
+        args=(context.bot, update.message, document.file_id),
+        name=f"import-{update.message.chat.id}",
+        daemon=True,
+    ).start()
+
+
+def import_history_document(bot: Bot, message, file_id: str):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "result.json")
+        try:
+            bot.get_file(file_id).download(custom_path=path)
+            with open(path, encoding="utf-8") as f:
+                progress = import_history(message.chat.id, f)
+        except Exception as e:
+            logger.warning("Failed to import history of chat %s: %s", message.chat.id, e)
+            message.reply_text("Unable to import that export, running /import again will carry on where it stopped")
+            return
+
+    message.reply_text(
+        f"Found {progress.links} links in {progress.messages} messages, "
+        f"tracks will be added to this chat's playlists shortly."
+    )
+
+
+def set_chat_playlist(service: MusicService, playlist: Playlist, chat_id, tenant_id: str) -> bool:
     """
     To function, the bot needs a playlist to add tracks to.
     If playlist has not been set, the bot should respond with instructions on how to do so.
@@ -109,40 +312,61 @@ def set_chat_playlist(service: MusicService, playlist: Playlist, chat_id) -> boo
     so that future messages in the chat can be associated with the playlist.
     """
 
-    logging.info(f"Setting {service.name} playlist to {playlist.name}")
+    logging.info("Setting %s playlist to %s", service.name, playlist.name)
 
-    conn = sqlite3.connect("spotelegramify")
-    cursor = conn.cursor()
-    cursor.execute(
-        f"""
-        UPDATE chats 
-        SET {service.id}_playlist_id = ?
-        WHERE chat_id = ?
-        """,
-        (playlist.id, chat_id),
-    )
-    conn.commit()
-    conn.close()
+    chat_repository.set_playlist_id(str(chat_id), service.id, playlist.id, tenant_id)
 
 
-def get_chat_playlist_id(service: MusicService, chat_id):
+def register_tenant_guard(update: Update, context):
     """
-    Get the stored playlist associated with the given chat.
+    Store the user's credentials for a music service, making them a tenant who can set playlists.
+    Credentials are only accepted in a private chat with the bot.
     """
-    conn = sqlite3.connect("spotelegramify")
-    cursor = conn.cursor()
-    cursor.execute(
-        f"""
-        SELECT {service.id}_playlist_id FROM chats WHERE chat_id = ?
-        """,
-        (chat_id,),
-    )
 
-    result = cursor.fetchone()
-    conn.commit()
-    conn.close()
+    user_id = str(update.message.from_user["id"])
+    if update.message.chat.type != "private":
+        update.message.reply_text("Credentials can only be registered in a private chat with the bot!")
+        return
+
+    service_class = next((s for s in get_all_music_services() if context.args[:1] == [s.id]), None)
+    if service_class is None or len(context.args) != len(service_class.credential_names) + 1:
+        usage = [f"/register {s.id} {' '.join(s.credential_names)}" for s in get_all_music_services()]
+        update.message.reply_text("Invalid use of register! Try one of these:\n" + "\n".join(usage))
+        return
+
+    # Credentials are only stored once they work, so that bogus ones don't make the user a tenant
+    credentials = dict(zip(service_class.credential_names, context.args[1:]))
+    if service_registry.check(service_class.id, credentials):
+        register_tenant(user_id, service_class.id, credentials)
+        update.message.reply_text(f"Registered your {service_class.name} account, you can now set playlists in chats.")
+    else:
+        update.message.reply_text(f"Unable to connect to {service_class.name} with those credentials!")
+
+    # Don't leave the credentials lying around in the chat
+    try:
+        update.message.delete()
+    except Exception as e:
+        logger.info("Unable to delete credentials message: %s", e)
+
+
+def register_tenant(tenant_id: str, service_id: str, credentials: Dict[str, str]):
+    credential_store.set(tenant_id, service_id, credentials)
+    service_registry.invalidate(tenant_id, service_id)
+
+
+def get_tenant_id(chat_id) -> Optional[str]:
+    """
+    Get the tenant whose playlists the chat adds to.
+    """
+    tenant_id = chat_repository.get_tenant_id(str(chat_id))
+    return tenant_id if tenant_id is not None else DEFAULT_TENANT_ID
+
 
-    return result[0] if result is not None else None
+def get_chat_playlist_ids(chat_id) -> Dict[str, Optional[str]]:
+    """
+    Get the stored playlists associated with the given chat, by service ID.
+    """
+    return chat_repository.get_playlist_ids(str(chat_id))
 
 
 def parse_track_links(update: Update, _):
@@ -150,52 +374,486 @@ def parse_track_links(update: Update, _):
     This is the main event handler for this bot.
     It will read all messages in the chat, looking for music links.
     It will then add these links to a previously configured playlist.
+
+    Links are queued as jobs rather than handled here, so the dispatcher is never blocked
+    on music service calls and no link is lost if a service is down or the bot restarts.
     """
 
-    text = update.message.text
-    chat_id = str(update.message.chat.id)
-    user_name = update.message.from_user["username"]
-    chat_name = update.message.chat.title if update.message.chat.title is not None else user_name
+    chat_id, message_id = str(update.message.chat.id), str(update.message.message_id)
+    with trace("update", message=f"{chat_id}:{message_id}"):
+        with timer("handler_stage_seconds", stage="extract"):
+            links = link_extractor.extract(update.message.text)
+        if len(links) < 1:
+            return
+
+        with timer("handler_stage_seconds", stage="queue"):
+            queued = queue_track_links(links, chat_id, message_id)
+        if queued > 0:
+            job_workers.wake()
+
+
+def queue_track_links(links: List[Link], chat_id: str, message_id: str, imported: bool = False) -> int:
+    """
+    Queue a job to add each link to each of the chat's playlists, returning the number of new jobs.
+    The chat isn't told how jobs for links imported from its history went.
+    """
+    # Only the tenant's services can be used, both to look up links and to add to playlists
+    tenant_id = get_tenant_id(chat_id)
+    service_ids = credential_store.service_ids(tenant_id)
+    playlist_ids = {
+        service_id: playlist_id
+        for service_id, playlist_id in get_chat_playlist_ids(chat_id).items()
+        if playlist_id is not None and service_id in service_ids
+    }
+    if len(playlist_ids) < 1:
+        logging.info("No playlists configured for chat %s", chat_id)
+        return 0
+
+    links = [link for link in links if link.service_id in service_ids]
+    if not imported:
+        return job_queue.enqueue(chat_id, message_id, playlist_ids, links)
+
+    # Old tracks are likely to be in the playlist already, which needs no lookup when they're on its own service
+    queued = 0
+    for service_id, playlist_id in playlist_ids.items():
+        service = service_registry.get(tenant_id, service_id)
+        new_links = [
+            link
+            for link in links
+            if service is None
+            or link.service_id != service_id
+            or link.kind != TRACK
+            or not service.playlist_index.contains(playlist_id, link.id)
+        ]
+        queued += job_queue.enqueue(chat_id, message_id, {service_id: playlist_id}, new_links, notify=False)
+    return queued
+
+
+def import_history(chat_id: str, f) -> ImportProgress:
+    """
+    Queue the links in a Telegram export of the chat's history, see `HistoryImporter`.
+    """
+    importer = HistoryImporter(
+        import_checkpoints, link_extractor, partial(queue_track_links, imported=True), job_workers.wake
+    )
+    return importer.run(str(chat_id), f)
 
-    tracks: List[Track] = []
-    for service in available_services:
-        track_ids = service.find_track_ids(text)
-        album_ids = service.find_album_ids(text)
-        service_tracks = []
 
-        # Scrape track ids and add these tracks
-        if len(track_ids) > 0:
-            service_tracks += [service.lookup_service_track(track_id) for track_id in track_ids]
+# A link to look up, and for albums which of their tracks to take
+Lookup = Tuple[Link, Optional[AlbumMode]]
+
+
+def get_job_services(jobs: List[Job]) -> Tuple[Dict[int, MusicService], Dict[int, Lookup], Dict[Lookup, MusicService]]:
+    """
+    Get the service instances, belonging to the tenant of each job's chat, that each job adds to by job ID,
+    what each job looks up, and the instance each lookup is made with.
+    A link shared in several tenants' chats is looked up once.
+    """
+    targets = {}
+    lookups = {}
+    sources = {}
+    for job in jobs:
+        tenant_id = get_tenant_id(job.chat_id)
+        targets[job.id] = service_registry.get(tenant_id, job.service_id)
+        album_mode = chat_repository.get_album_mode(job.chat_id) if job.link.kind == ALBUM else None
+        lookups[job.id] = (job.link, album_mode)
+        if lookups[job.id] not in sources:
+            sources[lookups[job.id]] = service_registry.get(tenant_id, job.link.service_id)
+    return targets, lookups, sources
+
+
+def process_jobs(jobs: List[Job]):
+    """
+    Add the tracks linked by a batch of jobs to their playlists.
+    Lookups and searches are fanned out through the pipeline, and additions batched by the write queue.
+    """
+    messages = dict.fromkeys(f"{job.chat_id}:{job.message_id}" for job in jobs)
+    with trace("jobs", messages=list(messages)) as jobs_trace:
+        with timer("job_stage_seconds", stage="lookup"):
+            services, lookups, sources = get_job_services(jobs)
+            tracks = find_tracks(sources)
+
+        with timer("job_stage_seconds", stage="search"):
+            # Start every search before waiting on any of them, including one for each track of an album
+            searches = []
+            for job in jobs:
+                service = services[job.id]
+                job_tracks = tracks.get(lookups[job.id], RuntimeError(f"{job.link.service_id} is not available"))
+                if service is None:
+                    job_tracks = RuntimeError(f"{job.service_id} is not available")
+                if isinstance(job_tracks, Exception):
+                    searches.append((job, service, job_tracks, []))
+                else:
+                    job_searches = [pipeline.call(service, resolve_track_id, service, track) for track in job_tracks]
+                    searches.append((job, service, job_tracks, job_searches))
+
+            # Queue additions in link order, the write queue batches them per playlist
+            additions = []
+            for job, service, job_tracks, job_searches in searches:
+                job_additions = [queue_addition(job, service, t, s) for t, s in zip(job_tracks, job_searches)]
+                additions.append((job, service, job_tracks, job_additions))
+
+        with timer("job_stage_seconds", stage="write"):
+            # The batch is all that's coming for now, so write it straight away rather than waiting out the window
+            written = [job for job, _, _, adds in additions if any(isinstance(a, Future) for a in adds)]
+            for key in dict.fromkeys((job.service_id, job.playlist_id) for job in written):
+                write_queue.flush(key)
+
+            outcomes = []
+            for job, service, job_tracks, job_additions in additions:
+                results = []
+                for addition in job_additions:
+                    if isinstance(addition, Future):
+                        try:
+                            addition = addition.result()
+                        except Exception as e:
+                            addition = e
+                    results.append(addition)
+                outcomes.append((job, service, job_tracks, results))
+
+        with timer("job_stage_seconds", stage="finish"):
+            finish_jobs(outcomes)
+
+    observe_message_requests(jobs_trace, len(messages))
+
+
+def observe_message_requests(jobs_trace: Trace, messages: int):
+    """
+    Record how many service requests each message in a batch of jobs took, on average.
+    """
+    requests = jobs_trace.count("music_service_requests_total")
+    observe("music_service_requests_per_message", requests / messages, COUNT_BUCKETS)
+
 
-        # Scrape album ids and add a single track from these albums
-        if len(album_ids) > 0:
-            service_albums = [service.lookup_service_album(album_id) for album_id in album_ids]
-            service_tracks += [service.get_service_track_from_album(service_album) for service_album in service_albums]
+def queue_addition(job: Job, service: MusicService, track: Track, search: Future):
+    """
+    Queue the searched for track to be added to the job's playlist, once the search is done.
+    Gives the write queue's future, None if the track wasn't found, or the error if the search failed.
+    """
+    try:
+        service_track_id = search.result()
+    except Exception as e:
+        return e
+    if service_track_id is None:
+        logger.info("%s returned no results for track '%s - %s'", service.name, track.name, track.artist_name)
+        return None
+    return write_queue.add(service, job.playlist_id, service_track_id)
+
+
+def find_tracks(sources: Dict[Lookup, MusicService]) -> Dict[Lookup, Union[List[Track], Exception]]:
+    """
+    Look up every track and album linked, each with the given service instance, concurrently.
+    Gives the tracks for each lookup, none if the link doesn't exist, or the error if the lookup failed.
+    Albums are expanded to the tracks their mode takes once they have been found, each album in parallel.
+    """
+
+    lookups = []
+    for service in dict.fromkeys(s for s in sources.values() if s is not None):
+        for kind, lookup in [(TRACK, service.lookup_service_tracks), (ALBUM, service.lookup_service_albums)]:
+            kind_lookups = [key for key, s in sources.items() if s is service and key[0].kind == kind]
+            if len(kind_lookups) > 0:
+                future = pipeline.call(service, lookup, [link.id for link, _ in kind_lookups])
+                lookups.append((service, kind_lookups, future))
+
+    tracks = {}
+    expansions = []
+    for service, kind_lookups, future in lookups:
+        try:
+            results = future.result()
+        except Exception as e:
+            logger.warning("%s lookup failed: %s", service.name, e)
+            tracks.update({key: e for key in kind_lookups})
+            continue
+
+        for key, result in zip(kind_lookups, results):
+            link, album_mode = key
+            if result is None:
+                tracks[key] = []
+            elif link.kind == TRACK:
+                tracks[key] = service.convert_tracks([result])
+            else:
+                expansions.append((service, key, pipeline.call(service, service.get_album_tracks, result, album_mode)))
+
+    for service, key, future in expansions:
+        try:
+            tracks[key] = service.convert_tracks(future.result())
+        except Exception as e:
+            logger.warning("%s album lookup failed: %s", service.name, e)
+            tracks[key] = e
+
+    return tracks
+
+
+def get_mirrored_chat_ids() -> List[str]:
+    """
+    Get the chats with playlists on more than one service, of this process's shard when sharded.
+    """
+    chat_ids = chat_repository.get_mirrored_chat_ids()
+    if job_queue.shard is None:
+        return chat_ids
+    ring = HashRing(SHARDS)
+    return [chat_id for chat_id in chat_ids if ring.shard_for(chat_id) == job_queue.shard]
+
+
+def get_chat_playlists(chat_id: str) -> ChatPlaylists:
+    """
+    Get the chat's playlists with the instance of each service, belonging to the chat's tenant, that can write to them.
+    """
+    tenant_id = get_tenant_id(chat_id)
+    playlists = {}
+    for service_id, playlist_id in get_chat_playlist_ids(chat_id).items():
+        service = service_registry.get(tenant_id, service_id) if playlist_id is not None else None
+        if service is not None:
+            playlists[service_id] = (service, playlist_id)
+    return playlists
+
+
+def resolve_track_id(service: MusicService, track: Track) -> Optional[str]:
+    """
+    Find the ID of the track on the given service, searching only if it hasn't been matched before.
+    """
+    if track.service_id == service.id:
+        return track.id
+
+    matched, service_track_id = match_cache.get(service.id, track)
+    if matched:
+        return service_track_id
+
+    service_track = service.search_track(track)
+    service_track_id = service.get_service_track_id(service_track) if service_track is not None else None
+    match_cache.set(service.id, track, service_track_id)
+    return service_track_id
+
+
+def finish_jobs(outcomes: List):
+    """
+    Record how each job went, and tell each chat which tracks made it into which playlists.
+
+    Each outcome is the job, target service, the tracks the link gave, or the error that stopped
+    them being looked up, and the result for each track: True if it was added, False if it was
+    already in the playlist, None if it couldn't be found, or the error that stopped it.
+    A job with any error is retried, tracks already added are skipped when it runs again.
+    """
+    replies = defaultdict(list)
+    for job, service, tracks, results in outcomes:
+        service_name = service.name if service is not None else job.service_id
+        link_name = f"{job.link.kind} {job.link.id}"
+        if job.link.kind == TRACK and isinstance(tracks, list) and len(tracks) > 0:
+            link_name = f"'{tracks[0].name} - {tracks[0].artist_name}'"
+
+        lines = replies[(job.chat_id, job.message_id)] if job.notify else []
+        errors = [tracks] if isinstance(tracks, Exception) else [r for r in results if isinstance(r, Exception)]
+        if len(errors) > 0:
+            if not job_queue.retry(job, str(errors[0])):
+                lines.append(f"Failed to add {link_name} to {service_name} playlist")
+            continue
 
-        # Fitler out any None entries due to error
-        service_tracks = [st for st in service_tracks if st]
+        added = sum(1 for result in results if result is True)
+        missing = sum(1 for result in results if result is None)
+        if len(results) == missing:
+            job_queue.complete(job, "not found")
+            lines.append(f"Couldn't find {link_name} on {service_name}")
+            continue
 
-        tracks += service.convert_tracks(service_tracks)
+        job_queue.complete(job)
+        if job.link.kind == TRACK:
+            if added > 0:
+                lines.append(f"Added {link_name} to {service_name} playlist")
+            continue
+        if added > 0:
+            lines.append(f"Added {added} tracks from {link_name} to {service_name} playlist")
+        if missing > 0:
+            lines.append(f"Couldn't find {missing} tracks from {link_name} on {service_name}")
 
-    if len(tracks) < 1:
-        logger.debug("No tracks in message")
+    if notify is None:
         return
 
-    for service in available_services:
-        playlist_id = get_chat_playlist_id(service, chat_id)
-        if playlist_id is None:
-            logging.info(f"{service.name} playlist not configured for chat {chat_name}")
+    for (chat_id, message_id), lines in replies.items():
+        if len(lines) < 1:
+            continue
+        try:
+            notify(chat_id, message_id, "\n".join(lines))
+        except Exception as e:
+            logger.warning("Unable to reply with results: %s", e)
+
+
+async def parse_track_links_async(update: Update, _):
+    """
+    The asyncio runtime's version of `parse_track_links`.
+    """
+    chat_id, message_id = str(update.message.chat.id), str(update.message.message_id)
+    with trace("update", message=f"{chat_id}:{message_id}"):
+        with timer("handler_stage_seconds", stage="extract"):
+            links = link_extractor.extract(update.message.text)
+        if len(links) < 1:
+            return
+
+        with timer("handler_stage_seconds", stage="queue"):
+            queued = await run_sync(queue_track_links, links, chat_id, message_id)
+        if queued > 0:
+            async_job_wakeup.set()
+
+
+async def run_job_workers_async():
+    global async_job_wakeup
+
+    async_job_wakeup = asyncio.Event()
+    job_queue.start_renewing()
+    await asyncio.gather(*[work_jobs_async() for _ in range(JOB_WORKERS)])
+
+
+async def work_jobs_async():
+    """
+    Claim and process jobs on the event loop, the asyncio runtime's version of `JobWorkers`.
+    """
+    while True:
+        jobs = await run_sync(job_queue.claim, JOB_BATCH_SIZE)
+        if len(jobs) < 1:
+            try:
+                await asyncio.wait_for(async_job_wakeup.wait(), JOB_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            async_job_wakeup.clear()
             continue
-        service_playlist = service.lookup_service_playlist(playlist_id)
 
-        for track in tracks:
-            service_track = service.search_track(track)
-            if service_track is None:
-                logger.info(f"{service.name} returned no results for track '{track.name} - {track.artist_name}'")
-                continue
-            service.add_to_playlist(service_playlist, service_track)
+        try:
+            await process_jobs_async(jobs)
+        except Exception as e:
+            logger.exception("Failed to process jobs")
+            for job in jobs:
+                await run_sync(job_queue.retry, job, str(e))
+
 
-    logger.info(f"Processed {len(tracks)} track")
+async def process_jobs_async(jobs: List[Job]):
+    messages = dict.fromkeys(f"{job.chat_id}:{job.message_id}" for job in jobs)
+    with trace("jobs", messages=list(messages)) as jobs_trace:
+        await add_job_tracks_async(jobs)
+    observe_message_requests(jobs_trace, len(messages))
+
+
+async def add_job_tracks_async(jobs: List[Job]):
+    with timer("job_stage_seconds", stage="lookup"):
+        services, lookups, sources = await run_sync(get_job_services, jobs)
+        tracks = await find_tracks_async(sources)
+
+    async def search(service: MusicService, track: Track):
+        try:
+            service_track_id = await limit_async(service, run_sync(resolve_track_id, service, track))
+        except Exception as e:
+            return e
+        if service_track_id is None:
+            logger.info("%s returned no results for track '%s - %s'", service.name, track.name, track.artist_name)
+        return service_track_id
+
+    async def search_job(job: Job):
+        service = services[job.id]
+        job_tracks = tracks.get(lookups[job.id], RuntimeError(f"{job.link.service_id} is not available"))
+        if service is None:
+            job_tracks = RuntimeError(f"{job.service_id} is not available")
+        if isinstance(job_tracks, Exception):
+            return (job, service, job_tracks, [])
+        return (job, service, job_tracks, await asyncio.gather(*[search(service, track) for track in job_tracks]))
+
+    # Queue additions in link order once every search is done, the write queue batches them per playlist
+    additions = []
+    for job, service, job_tracks, results in await asyncio.gather(*[search_job(job) for job in jobs]):
+        job_additions = [
+            asyncio.wrap_future(write_queue.add(service, job.playlist_id, r)) if isinstance(r, str) else r
+            for r in results
+        ]
+        additions.append((job, service, job_tracks, job_additions))
+
+    written = [
+        job for job, _, _, job_additions in additions if any(isinstance(a, asyncio.Future) for a in job_additions)
+    ]
+    for key in dict.fromkeys((job.service_id, job.playlist_id) for job in written):
+        await run_sync(write_queue.flush, key)
+
+    outcomes = []
+    for job, service, job_tracks, job_additions in additions:
+        results = []
+        for addition in job_additions:
+            if isinstance(addition, asyncio.Future):
+                try:
+                    addition = await addition
+                except Exception as e:
+                    addition = e
+            results.append(addition)
+        outcomes.append((job, service, job_tracks, results))
+
+    await run_sync(finish_jobs, outcomes)
+
+
+async def find_tracks_async(sources: Dict[Lookup, MusicService]) -> Dict[Lookup, Union[List[Track], Exception]]:
+    lookups = []
+    for service in dict.fromkeys(s for s in sources.values() if s is not None):
+        kinds = [(TRACK, service.lookup_service_tracks_async), (ALBUM, service.lookup_service_albums_async)]
+        for kind, lookup in kinds:
+            kind_lookups = [key for key, s in sources.items() if s is service and key[0].kind == kind]
+            if len(kind_lookups) > 0:
+                lookups.append((service, kind_lookups, lookup([link.id for link, _ in kind_lookups])))
+
+    results = await asyncio.gather(
+        *[limit_async(service, lookup) for service, _, lookup in lookups], return_exceptions=True
+    )
+
+    tracks = {}
+    expansions = []
+    for (service, kind_lookups, _), kind_results in zip(lookups, results):
+        if isinstance(kind_results, Exception):
+            logger.warning("%s lookup failed: %s", service.name, kind_results)
+            tracks.update({key: kind_results for key in kind_lookups})
+            continue
+
+        for key, result in zip(kind_lookups, kind_results):
+            link, album_mode = key
+            if result is None:
+                tracks[key] = []
+            elif link.kind == TRACK:
+                tracks[key] = service.convert_tracks([result])
+            else:
+                expansion = limit_async(service, service.get_album_tracks_async(result, album_mode))
+                expansions.append((service, key, expansion))
+
+    album_results = await asyncio.gather(*[expansion for _, _, expansion in expansions], return_exceptions=True)
+    for (service, key, _), result in zip(expansions, album_results):
+        if isinstance(result, Exception):
+            logger.warning("%s album lookup failed: %s", service.name, result)
+            tracks[key] = result
+            continue
+        tracks[key] = service.convert_tracks(result)
+
+    return tracks
+
+
+async def limit_async(service: MusicService, coroutine):
+    """
+    Await the coroutine without exceeding the per-service concurrency limit.
+    """
+    if service.id not in service_semaphores:
+        service_semaphores[service.id] = asyncio.Semaphore(SERVICE_CONCURRENCY)
+    async with service_semaphores[service.id]:
+        return await coroutine
+
+
+async def set_chat_playlist_guard_async(update: Update, context):
+    await run_sync(set_chat_playlist_guard, update, context)
+
+
+async def set_album_mode_guard_async(update: Update, context):
+    await run_sync(set_album_mode_guard, update, context)
+
+
+async def import_history_guard_async(update: Update, context):
+    await run_sync(import_history_guard, update, context)
+
+
+async def initialise_async(update, context):
+    await run_sync(initialise, update, context)
+
+
+async def register_tenant_guard_async(update: Update, context):
+    await run_sync(register_tenant_guard, update, context)
 
 
 def error(update, context):
@@ -207,59 +865,370 @@ def error(update, context):
 
 # TODO test this
 def initialise(update, context):
+    """
+    Set up the chat, clearing its playlists. A chat nobody has set playlists in becomes the user's if they're a tenant,
+    otherwise only the chat's tenant can initialise it again.
+    """
     chat_id = str(update.message.chat.id)
+    user_id = str(update.message.from_user["id"])
     user_name = update.message.from_user["username"]
     chat_name = update.message.chat.title if update.message.chat.title is not None else user_name
-    conn = sqlite3.connect("spotelegramify")
-    cursor = conn.cursor()
-    cursor.execute(
-        """
-        INSERT OR REPLACE INTO chats (chat_id)
-        VALUES (?)
-        """,
-        (chat_id,),
-    )
-    conn.commit()
-    conn.close()
-    logger.info(f"Initialisted DB for chat {chat_name}")
+
+    claimed = chat_repository.get_tenant_id(chat_id) is not None or any(get_chat_playlist_ids(chat_id).values())
+    if claimed and get_tenant_id(chat_id) != user_id:
+        logger.warning("User with id %s doesn't match chat tenant %s !", user_id, get_tenant_id(chat_id))
+        update.message.reply_text("Only this chat's tenant can initialise it again!")
+        return
+
+    initialise_chat(chat_id, user_id if credential_store.is_tenant(user_id) else None)
+    logger.info("Initialisted DB for chat %s", chat_name)
+
+
+def initialise_chat(chat_id: str, tenant_id: Optional[str] = None):
+    chat_repository.initialise_chat(str(chat_id), tenant_id)
 
 
 def main():
     """
     Start the bot.
     """
+    global notify
+
+    if sys.argv[1:2] == ["import"]:
+        run_import(*sys.argv[2:4])
+        return
+
+    if RUNTIME == "sharded":
+        run_sharded()
+        return
+    if RUNTIME == "webhook":
+        check_webhook_settings()
+
+    setup()
+    # Take back any jobs left with shards, in case this was previously run sharded
+    job_queue.assign_shards(lambda _: None)
+    metrics_server = start_metrics_server(METRICS_PORT)
+    start_mirroring()
+
+    if RUNTIME == "asyncio":
+        run_asyncio()
+        playlist_mirror.stop()
+        stop_metrics_server(metrics_server)
+        return
+
+    updater = build_updater()
+    notify = partial(reply_to_message, updater.bot)
+    job_workers.start()
+
+    if RUNTIME == "webhook":
+        run_webhook(updater)
+    else:
+        updater.start_polling()
+        updater.idle()
+
+    playlist_mirror.stop()
+    job_workers.stop()
+    pipeline.shutdown()
+    write_queue.close()
+    service_registry.close()
+    stop_metrics_server(metrics_server)
+
+
+def run_import(chat_id: str, path: str):
+    """
+    Import a chat's history from a Telegram export on the command line, then add its links to the chat's playlists.
+    Stopping part way through is safe, running the import again carries on where it stopped and the bot
+    picks up any links left queued.
+
+    The bot can keep running meanwhile. Only the chat's jobs are run here, and the bot only claims those
+    not already running here. When the bot is sharded, the jobs go to the chat's shard so that it can claim them too.
+    """
+    job_queue.chat_id = chat_id
+    if RUNTIME == "sharded":
+        job_queue.shard = HashRing(SHARDS).shard_for(chat_id)
+    setup()
+    if not any(get_chat_playlist_ids(chat_id).values()):
+        logger.warning("Chat %s has no playlists to import into", chat_id)
+        return
+
+    job_workers.start()
+    try:
+        with open(path, encoding="utf-8") as f:
+            progress = import_history(chat_id, f)
+        logger.info("Found %s links in %s messages, adding them to playlists", progress.links, progress.messages)
+
+        # Retried jobs may take a while to be due, leave them to the bot rather than waiting
+        while True:
+            counts = job_queue.counts(chat_id)
+            if counts.get(RUNNING, 0) < 1 and job_queue.due(chat_id) < 1:
+                break
+            logger.info("Import of chat %s: %s", chat_id, counts)
+            time.sleep(IMPORT_REPORT_INTERVAL)
+    except KeyboardInterrupt:
+        pass
+
+    job_workers.stop()
+    pipeline.shutdown()
+    write_queue.close()
+    service_registry.close()
+    logger.info("Import of chat %s: %s", chat_id, job_queue.counts(chat_id))
+
+
+def setup():
+    """
+    Set up the database, music services and link extraction, for any runtime.
+    """
+    global match_cache, link_extractor, service_registry
+
     # Configure the database
     configure_db()
+    match_cache = MatchCache()
+
+    service_classes = get_all_music_services()
+    service_registry = ServiceRegistry(
+        credential_store,
+        {service_class.id: service_class for service_class in service_classes},
+        max_size=MAX_TENANT_SERVICES,
+        idle_timeout=TENANT_IDLE_TIMEOUT,
+        on_create=lambda service: service.playlist_index.start_reconciling(PLAYLIST_INDEX_RECONCILE_INTERVAL),
+    )
 
-    for service in get_all_music_services():
-        available_service = None
+    # The admin user set in the environment is a tenant like any other
+    if DEFAULT_TENANT_ID is not None:
+        for service_class in service_classes:
+            credentials = service_class.env_credentials()
+            if credentials is not None and credentials != credential_store.get(DEFAULT_TENANT_ID, service_class.id):
+                register_tenant(DEFAULT_TENANT_ID, service_class.id, credentials)
 
-        try:
-            available_service = service()
-        except Exception as e:
-            logger.warning(e)
+        # Authenticating takes a round trip per service, so don't wait for it before taking updates
+        service_registry.warm(DEFAULT_TENANT_ID, check_admin_services)
+
+    link_extractor = LinkExtractor(service_classes)
+
+    enable_traces(TRACE_FILE)
+    metrics.add_collector(collect_metrics)
 
-        if available_service is None:
-            logger.warning(f"Unable to initialise service {service.__name__}")
-        else:
-            available_services.append(available_service)
 
-    if len(available_services) < 1:
-        logger.error(f"Unable to initialise any music services, shutting down")
-        logger.error(f"Fix environment settings and retry")
-        raise exit(1)
+def check_admin_services(services: List[MusicService]):
+    if len(services) < 1:
+        logger.warning("Unable to initialise any music services for the admin user")
+        logger.warning("Fix environment settings, or register credentials with the bot")
+    else:
+        logger.info("Music services ready for the admin user: %s", ", ".join(s.name for s in services))
+
+
+def collect_metrics() -> List[Tuple[str, Dict[str, str], float]]:
+    """
+    Sample the current state of the job queue, tenant services, their access tokens and request schedulers.
+    """
+    samples = [("jobs", {"status": status}, count) for status, count in job_queue.counts().items()]
+    samples += [(f"tenant_services_{name}", {}, value) for name, value in service_registry.stats().items()]
+    for service_id, stats in service_registry.token_stats().items():
+        samples += [(f"token_{name}", {"service": service_id}, value) for name, value in stats.items()]
+    for service_id, scheduler in schedulers.items():
+        samples += [(f"scheduler_{name}", {"service": service_id}, value) for name, value in scheduler.stats().items()]
+    return samples
+
+
+def start_metrics_server(port: Optional[int]) -> Optional[MetricsServer]:
+    if port is None:
+        return None
+    server = MetricsServer(METRICS_HOST, port, metrics)
+    server.start()
+    return server
+
+
+def stop_metrics_server(server: Optional[MetricsServer]):
+    if server is not None:
+        server.stop()
+
+
+def start_mirroring():
+    if MIRROR_INTERVAL > 0:
+        playlist_mirror.start(MIRROR_INTERVAL)
+
+
+def build_updater() -> Updater:
+    from telegram.ext import CommandHandler, Filters, MessageHandler, Updater
 
     updater = Updater(token=SPOTELEGRAMIFY_TELEGRAM_TOKEN, use_context=True)
 
     dp = updater.dispatcher
     dp.add_handler(CommandHandler("init", initialise))
     dp.add_handler(CommandHandler("set_playlist", set_chat_playlist_guard))
+    dp.add_handler(CommandHandler("album_mode", set_album_mode_guard))
+    dp.add_handler(CommandHandler("register", register_tenant_guard))
+    dp.add_handler(CommandHandler("import", import_history_guard))
     dp.add_handler(CommandHandler("help", help))
     dp.add_handler(MessageHandler(Filters.all, parse_track_links))
     dp.add_error_handler(error)
+    return updater
+
+
+def reply_to_message(bot: Bot, chat_id: str, message_id: str, text: str):
+    bot.send_message(chat_id=chat_id, text=text, reply_to_message_id=int(message_id))
 
-    updater.start_polling()
-    updater.idle()
+
+def run_asyncio():
+    """
+    Run the bot on an asyncio event loop rather than the Updater's threads.
+    """
+    from telegram import Bot
+
+    global notify
+
+    bot = Bot(token=SPOTELEGRAMIFY_TELEGRAM_TOKEN)
+    notify = partial(reply_to_message, bot)
+    runtime = AsyncRuntime(
+        bot,
+        {
+            "init": initialise_async,
+            "set_playlist": set_chat_playlist_guard_async,
+            "album_mode": set_album_mode_guard_async,
+            "register": register_tenant_guard_async,
+            "import": import_history_guard_async,
+        },
+        parse_track_links_async,
+        error,
+        background=[run_job_workers_async],
+    )
+    try:
+        runtime.run()
+    except KeyboardInterrupt:
+        pass
+    write_queue.close()
+    service_registry.close()
+
+
+def check_webhook_settings():
+    """
+    Stop with an explanation if the webhook settings are missing, rather than failing part way through starting.
+    """
+    if WEBHOOK_URL is None:
+        sys.exit("Set SPOTELEGRAMIFY_WEBHOOK_URL to the public HTTPS URL Telegram should send updates to")
+    if WEBHOOK_SECRET is None or re.fullmatch(WEBHOOK_SECRET_REGEX, WEBHOOK_SECRET) is None:
+        sys.exit("Set SPOTELEGRAMIFY_WEBHOOK_SECRET to a secret of up to 256 letters, digits, '_' and '-'")
+
+
+def run_webhook(updater: Updater):
+    """
+    Have Telegram push updates to a local HTTP server instead of polling for them.
+    """
+    from telegram import Update
+
+    bot = updater.bot
+    dispatcher = updater.dispatcher
+    server = WebhookServer(
+        WEBHOOK_HOST,
+        WEBHOOK_PORT,
+        f"/{WEBHOOK_SECRET}",
+        WEBHOOK_SECRET,
+        lambda data: dispatcher.process_update(Update.de_json(data, bot)),
+    )
+    server.start()
+    bot.set_webhook(url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_SECRET}", secret_token=WEBHOOK_SECRET)
+
+    stopped = threading.Event()
+    for signum in [signal.SIGINT, signal.SIGTERM]:
+        signal.signal(signum, lambda *_: stopped.set())
+    stopped.wait()
+
+    server.stop()
+
+
+def run_sharded():
+    """
+    Receive updates in this process and hand them to worker processes by chat, see `ShardedRuntime`.
+    Updates come from a webhook if a URL is set, a file of recorded updates if given, or polling otherwise.
+    """
+    from telegram import Bot
+
+    if REPLAY_UPDATES is None and WEBHOOK_URL is not None:
+        check_webhook_settings()
+    configure_db()
+    runtime = ShardedRuntime(SHARDS, run_shard)
+    job_queue.assign_shards(runtime.ring.shard_for)
+    runtime.start()
+    metrics.add_collector(lambda: [(f"shards_{name}", {}, value) for name, value in runtime.stats().items()])
+    metrics_server = start_metrics_server(METRICS_PORT)
+
+    stopped = threading.Event()
+    for signum in [signal.SIGINT, signal.SIGTERM]:
+        signal.signal(signum, lambda *_: stopped.set())
+
+    server = None
+    if REPLAY_UPDATES is not None:
+        replay_updates(REPLAY_UPDATES, runtime.route)
+    elif WEBHOOK_URL is not None:
+        bot = Bot(token=SPOTELEGRAMIFY_TELEGRAM_TOKEN)
+        # A single thread passes updates on, keeping them in the order they arrived
+        server = WebhookServer(
+            WEBHOOK_HOST, WEBHOOK_PORT, f"/{WEBHOOK_SECRET}", WEBHOOK_SECRET, runtime.route, workers=1
+        )
+        server.start()
+        bot.set_webhook(url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_SECRET}", secret_token=WEBHOOK_SECRET)
+    else:
+        bot = Bot(token=SPOTELEGRAMIFY_TELEGRAM_TOKEN)
+        threading.Thread(target=poll_updates, args=(bot, runtime.route, stopped), daemon=True).start()
+
+    stopped.wait()
+
+    if server is not None:
+        server.stop()
+    runtime.stop()
+    stop_metrics_server(metrics_server)
+
+
+def run_shard(shard: int, updates):
+    """
+    Handle the updates for one shard's chats, in a worker process started by `run_sharded`.
+    """
+    from telegram import Update
+
+    global notify
+
+    job_queue.shard = shard
+    setup()
+    metrics_server = start_metrics_server(METRICS_PORT + 1 + shard if METRICS_PORT is not None else None)
+    updater = build_updater()
+    notify = partial(reply_to_message, updater.bot)
+    job_workers.start()
+    start_mirroring()
+
+    serve_shard(shard, updates, lambda data: updater.dispatcher.process_update(Update.de_json(data, updater.bot)))
+
+    playlist_mirror.stop()
+    job_workers.stop()
+    pipeline.shutdown()
+    write_queue.close()
+    service_registry.close()
+    stop_metrics_server(metrics_server)
+
+
+def poll_updates(bot: Bot, handle: Callable[[Dict], None], stopped: threading.Event):
+    offset = None
+    while not stopped.is_set():
+        try:
+            updates = bot.get_updates(offset=offset, timeout=POLL_TIMEOUT)
+        except Exception as e:
+            logger.warning("Failed to fetch updates: %s", e)
+            stopped.wait(1)
+            continue
+
+        for update in updates:
+            offset = update.update_id + 1
+            handle(update.to_dict())
+
+
+def replay_updates(path: str, handle: Callable[[Dict], None]):
+    """
+    Handle updates recorded one per line as JSON, to run the bot locally without Telegram.
+    """
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                handle(json.loads(line))
+    logger.info("Replayed updates from %s", path)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,49 @@
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from music_services.metrics import Metrics
+
+logger = logging.getLogger(__name__)
+
+
+class MetricsServer:
+    """
+    Serves the metrics over HTTP at /metrics, in the Prometheus text format.
+    Meant to be scraped locally, so it should listen on a private address.
+    """
+
+    def __init__(self, host: str, port: int, metrics: Metrics):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def port(self) -> int:
+        return self.httpd.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="metrics-server", daemon=True)
+        self.thread.start()
+        logger.info("Serving metrics on port %s", self.port)
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,223 @@
+import logging
+import threading
+from concurrent.futures import Future
+from typing import Callable, Dict, List, NamedTuple, Optional, Set, Tuple
+
+from music_services.database import Database
+from music_services.metrics import increment
+from music_services.music_service import MusicService
+from music_services.scheduler import PRIORITY_BACKGROUND, priority
+from music_services.things import Track
+from pipeline import Pipeline
+from write_queue import PlaylistWriteQueue
+
+logger = logging.getLogger(__name__)
+
+# A chat's playlists, as the service instance and playlist ID by service ID
+ChatPlaylists = Dict[str, Tuple[MusicService, str]]
+
+
+class PlaylistKeys(NamedTuple):
+    """
+    What a playlist's tracks are matched by: ISRC where both tracks have one, since different recordings
+    can share a title and artist, otherwise normalized title and artist.
+    """
+
+    isrcs: Set[str]
+    # Match keys of every track, and of the tracks without an ISRC
+    names: Set[str]
+    names_without_isrc: Set[str]
+
+    def add(self, track: Track):
+        self.names.add(track.match_key)
+        if track.isrc:
+            self.isrcs.add(track.isrc.upper())
+        else:
+            self.names_without_isrc.add(track.match_key)
+
+    def contains(self, track: Track) -> bool:
+        if track.isrc:
+            return track.isrc.upper() in self.isrcs or track.match_key in self.names_without_isrc
+        return track.match_key in self.names
+
+
+def new_keys() -> PlaylistKeys:
+    return PlaylistKeys(set(), set(), set())
+
+
+class PlaylistMirror:
+    """
+    Keeps the playlists of chats with a playlist on more than one service in sync.
+
+    A track reaches a chat's playlists when it is shared, so a search miss or a crash leaves them
+    different for good. Each sync streams every playlist a page at a time, keeping only its tracks'
+    keys (ISRC, and normalized name and artist) and the tracks themselves. A track is missing from a
+    playlist if it matches none of its tracks, see `PlaylistKeys`. Missing tracks are found on the playlist's service with
+    the same cached matching as shared links, and written in batches by the write queue.
+
+    The playlists' snapshot markers are stored after each sync, and a chat is only synced again once
+    one of them changes, so a chat whose playlists haven't changed costs a request per playlist.
+    Markers are read before syncing, so a playlist the sync added to is checked once more next time.
+    """
+
+    def __init__(
+        self,
+        database: Database,
+        get_chat_ids: Callable[[], List[str]],
+        get_playlists: Callable[[str], ChatPlaylists],
+        resolve: Callable[[MusicService, Track], Optional[str]],
+        pipeline: Pipeline,
+        write_queue: PlaylistWriteQueue,
+    ):
+        self.database = database
+        self.get_chat_ids = get_chat_ids
+        self.get_playlists = get_playlists
+        self.resolve = resolve
+        self.pipeline = pipeline
+        self.write_queue = write_queue
+        self.syncer = None
+
+    def configure(self):
+        self.database.execute(
+            """
+            CREATE TABLE IF NOT EXISTS playlist_mirrors (
+                chat_id TEXT,
+                service_id TEXT,
+                playlist_id TEXT,
+                snapshot_id TEXT,
+                PRIMARY KEY (chat_id, service_id)
+            )
+        """
+        )
+
+    def sync(self, chat_id: str) -> Optional[Dict[str, int]]:
+        """
+        Add the tracks missing from each of the chat's playlists, returning how many were added by service ID,
+        or None if none of the playlists have changed since they were last synced.
+        """
+        playlists = self.get_playlists(chat_id)
+        if len(playlists) < 2:
+            return None
+
+        snapshots = {
+            service_id: (playlist_id, service.get_playlist_snapshot_id(playlist_id))
+            for service_id, (service, playlist_id) in playlists.items()
+        }
+        # Services without a marker are synced every time
+        unknown = any(snapshot_id is None for _, snapshot_id in snapshots.values())
+        if not unknown and snapshots == self._get_snapshots(chat_id):
+            increment("playlist_mirror_syncs_total", result="unchanged")
+            return None
+
+        streams = {
+            service_id: self.pipeline.call(service, read_playlist, service, playlist_id)
+            for service_id, (service, playlist_id) in playlists.items()
+        }
+        contents = {service_id: stream.result() for service_id, stream in streams.items()}
+
+        added = {}
+        for service_id, (service, playlist_id) in playlists.items():
+            others = [tracks for other_id, (tracks, _) in contents.items() if other_id != service_id]
+            missing = find_missing(contents[service_id][1], others)
+            added[service_id] = self._add(service, playlist_id, missing)
+
+        self._store_snapshots(chat_id, snapshots)
+        increment("playlist_mirror_syncs_total", result="synced")
+        logger.info("Synced playlists of chat %s, added %s", chat_id, added)
+        return added
+
+    def sync_all(self):
+        for chat_id in self.get_chat_ids():
+            try:
+                self.sync(chat_id)
+            except Exception as e:
+                increment("playlist_mirror_syncs_total", result="failed")
+                logger.warning("Failed to sync playlists of chat %s: %s", chat_id, e)
+
+    def start(self, interval: float):
+        """
+        Periodically sync every chat's playlists on a background thread.
+        """
+        if self.syncer is not None:
+            return
+
+        stopped = threading.Event()
+
+        def run():
+            with priority(PRIORITY_BACKGROUND):
+                while not stopped.wait(interval):
+                    self.sync_all()
+
+        self.syncer = threading.Thread(target=run, name="playlist-mirror", daemon=True)
+        self.syncer.stop = stopped
+        self.syncer.start()
+
+    def stop(self):
+        if self.syncer is not None:
+            self.syncer.stop.set()
+            self.syncer = None
+
+    def _add(self, service: MusicService, playlist_id: str, missing: List[Track]) -> int:
+        if len(missing) < 1:
+            return 0
+
+        searches = [self.pipeline.call(service, self.resolve, service, track) for track in missing]
+        additions: List[Future] = []
+        for track, search in zip(missing, searches):
+            try:
+                service_track_id = search.result()
+            except Exception as e:
+                logger.info("Failed to find %s - %s on %s: %s", track.name, track.artist_name, service.name, e)
+                continue
+            if service_track_id is not None:
+                additions.append(self.write_queue.add(service, playlist_id, service_track_id))
+
+        if len(additions) > 0:
+            self.write_queue.flush((service.id, playlist_id))
+        added = sum(1 for addition in additions if addition.result())
+        increment("playlist_mirror_tracks_added_total", added, service=service.id)
+        return added
+
+    def _get_snapshots(self, chat_id: str) -> Dict[str, Tuple[str, str]]:
+        rows = self.database.execute(
+            "SELECT service_id, playlist_id, snapshot_id FROM playlist_mirrors WHERE chat_id = ?",
+            (chat_id,),
+        )
+        return {service_id: (playlist_id, snapshot_id) for service_id, playlist_id, snapshot_id in rows}
+
+    def _store_snapshots(self, chat_id: str, snapshots: Dict[str, Tuple[str, str]]):
+        with self.database.connection() as conn:
+            conn.execute("DELETE FROM playlist_mirrors WHERE chat_id = ?", (chat_id,))
+            conn.executemany(
+                """
+                INSERT INTO playlist_mirrors (chat_id, service_id, playlist_id, snapshot_id)
+                VALUES (?, ?, ?, ?)
+                """,
+                [(chat_id, service_id, *snapshot) for service_id, snapshot in snapshots.items()],
+            )
+
+
+def read_playlist(service: MusicService, playlist_id: str) -> Tuple[List[Track], PlaylistKeys]:
+    """
+    Stream the playlist, giving its tracks and the keys of all of them.
+    """
+    tracks = []
+    keys = new_keys()
+    for track in service.iter_playlist_tracks(playlist_id):
+        tracks.append(track)
+        keys.add(track)
+    return tracks, keys
+
+
+def find_missing(keys: PlaylistKeys, others: List[List[Track]]) -> List[Track]:
+    """
+    Get the tracks of the other playlists that match none of the keys, each song once.
+    """
+    missing = []
+    seen = new_keys()
+    for tracks in others:
+        for track in tracks:
+            if not keys.contains(track) and not seen.contains(track):
+                missing.append(track)
+                seen.add(track)
+    return missing
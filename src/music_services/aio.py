@@ -0,0 +1,19 @@
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+# Threads available for running blocking client calls from coroutines
+SYNC_EXECUTOR_WORKERS = 32
+
+sync_executor = ThreadPoolExecutor(max_workers=SYNC_EXECUTOR_WORKERS, thread_name_prefix="sync-adapter")
+
+
+async def run_sync(fn, *args, **kwargs):
+    """
+    Run a blocking call on the shared adapter pool without blocking the event loop.
+    The caller's context is carried over, so request priorities still apply.
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(sync_executor, functools.partial(context.run, fn, *args, **kwargs))
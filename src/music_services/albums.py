@@ -0,0 +1,40 @@
+from typing import NamedTuple, Optional
+
+# Which of an album's tracks are added when an album is shared
+FIRST = "first"
+TOP = "top"
+FULL = "full"
+
+# Number of tracks added by the top tracks mode when no number is given
+DEFAULT_TOP_TRACKS = 5
+
+
+class AlbumMode(NamedTuple):
+    kind: str
+    count: Optional[int] = None
+
+    def __str__(self) -> str:
+        return f"{self.kind} {self.count}" if self.kind == TOP else self.kind
+
+
+DEFAULT_ALBUM_MODE = AlbumMode(FIRST)
+
+
+def parse_album_mode(text: Optional[str]) -> AlbumMode:
+    """
+    Parse an album mode as written by `AlbumMode.__str__`, e.g. "first", "top 5" or "full".
+    Raises ValueError if it isn't one.
+    """
+    if text is None:
+        return DEFAULT_ALBUM_MODE
+
+    parts = text.lower().split()
+    if parts == [FIRST] or parts == [FULL]:
+        return AlbumMode(parts[0])
+    if len(parts) in [1, 2] and parts[0] == TOP:
+        count = int(parts[1]) if len(parts) > 1 else DEFAULT_TOP_TRACKS
+        if count < 1:
+            raise ValueError(f"Album mode '{text}' must add at least one track")
+        return AlbumMode(TOP, count)
+
+    raise ValueError(f"Unknown album mode '{text}'")
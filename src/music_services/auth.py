@@ -0,0 +1,119 @@
+import logging
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+from .errors import get_http_status
+
+logger = logging.getLogger(__name__)
+
+# Lifetime to assume when a service doesn't say when its token expires, in seconds
+DEFAULT_TOKEN_LIFETIME = 60 * 60
+
+# How long before expiry to refresh the token, in seconds
+REFRESH_MARGIN = 5 * 60
+
+# How long to wait before trying again after a background refresh fails, in seconds
+RETRY_INTERVAL = 30
+
+
+class TokenManager:
+    """
+    Keeps a music service's access token fresh.
+
+    `refresh` performs the service's token refresh and returns the new token's expiry as a
+    UNIX timestamp, or None if unknown.
+    The token is refreshed in the background shortly before it expires, and by callers only if
+    it has actually expired; concurrent callers share a single refresh.
+    Calls made through `call` are retried once with a new token if the service rejects the old one.
+    """
+
+    def __init__(self, name: str, refresh: Callable[[], Optional[float]], margin: float = REFRESH_MARGIN):
+        self.name = name
+        self.refresh_token = refresh
+        self.margin = margin
+        self.expires_at = 0.0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.refresher = None
+
+        self.refreshes = 0
+        self.failures = 0
+        self.refresh_seconds = 0.0
+        self.last_refresh_seconds = 0.0
+
+    def refresh(self, expired_before: Optional[float] = None):
+        """
+        Refresh the token, unless another caller already did since `expired_before`.
+        """
+        with self.lock:
+            if expired_before is not None and self.expires_at > expired_before:
+                return
+
+            start = time.perf_counter()
+            try:
+                expires_at = self.refresh_token()
+            except Exception:
+                self.failures += 1
+                raise
+            finally:
+                elapsed = time.perf_counter() - start
+                self.refreshes += 1
+                self.refresh_seconds += elapsed
+                self.last_refresh_seconds = elapsed
+
+            self.expires_at = expires_at if expires_at is not None else time.time() + DEFAULT_TOKEN_LIFETIME
+            logger.info("Refreshed %s access token in %.2fs", self.name, elapsed)
+
+    def ensure_fresh(self):
+        now = time.time()
+        if self.expires_at <= now:
+            self.refresh(expired_before=now)
+
+    def call(self, fn: Callable, *args, **kwargs):
+        """
+        Make an authorised call, refreshing the token and retrying once if it is rejected.
+        """
+        self.ensure_fresh()
+        attempted_at = time.time()
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            if get_http_status(e) != 401:
+                raise
+            logger.info("%s rejected access token, refreshing and retrying", self.name)
+
+        self.refresh(expired_before=attempted_at)
+        return fn(*args, **kwargs)
+
+    def start(self):
+        """
+        Refresh the token on a background thread shortly before each expiry.
+        """
+        if self.refresher is not None:
+            return
+
+        def run():
+            wait = max(self.expires_at - self.margin - time.time(), 1)
+            while not self.stopped.wait(wait):
+                try:
+                    self.refresh(expired_before=time.time() + self.margin)
+                    wait = max(self.expires_at - self.margin - time.time(), 1)
+                except Exception as e:
+                    logger.warning("Failed to refresh %s access token: %s", self.name, e)
+                    wait = RETRY_INTERVAL
+
+        self.refresher = threading.Thread(target=run, name=f"{self.name}-token", daemon=True)
+        self.refresher.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "refreshes": self.refreshes,
+            "failures": self.failures,
+            "refresh_seconds": self.refresh_seconds,
+            "last_refresh_seconds": self.last_refresh_seconds,
+            "expires_in": max(self.expires_at - time.time(), 0),
+        }
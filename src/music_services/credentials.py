@@ -0,0 +1,69 @@
+import json
+import logging
+import time
+from typing import Dict, List, Optional
+
+from .database import Database, get_database
+
+logger = logging.getLogger(__name__)
+
+
+class CredentialStore:
+    """
+    Stores each tenant's credentials for each music service.
+
+    A tenant is an admin user, identified by their Telegram user ID, who owns the playlists
+    their chats add tracks to. Credentials are stored as a JSON object per (tenant, service).
+    """
+
+    def __init__(self, database: Database = None):
+        self.database = database if database is not None else get_database()
+
+    def configure(self):
+        self.database.execute(
+            """
+            CREATE TABLE IF NOT EXISTS service_credentials (
+                tenant_id TEXT,
+                service_id TEXT,
+                credentials TEXT,
+                updated_at REAL,
+                PRIMARY KEY (tenant_id, service_id)
+            )
+        """
+        )
+
+    def get(self, tenant_id: str, service_id: str) -> Optional[Dict[str, str]]:
+        rows = self.database.execute(
+            "SELECT credentials FROM service_credentials WHERE tenant_id = ? AND service_id = ?",
+            (tenant_id, service_id),
+        )
+        return json.loads(rows[0][0]) if len(rows) > 0 else None
+
+    def updated_at(self, tenant_id: str, service_id: str) -> Optional[float]:
+        rows = self.database.execute(
+            "SELECT updated_at FROM service_credentials WHERE tenant_id = ? AND service_id = ?",
+            (tenant_id, service_id),
+        )
+        return rows[0][0] if len(rows) > 0 else None
+
+    def set(self, tenant_id: str, service_id: str, credentials: Dict[str, str]):
+        logger.info("Storing %s credentials for tenant %s", service_id, tenant_id)
+        self.database.execute(
+            """
+            INSERT OR REPLACE INTO service_credentials (tenant_id, service_id, credentials, updated_at)
+            VALUES (?, ?, ?, ?)
+            """,
+            (tenant_id, service_id, json.dumps(credentials), time.time()),
+        )
+
+    def service_ids(self, tenant_id: str) -> List[str]:
+        """
+        Get the IDs of the services the tenant has credentials for.
+        """
+        rows = self.database.execute(
+            "SELECT service_id FROM service_credentials WHERE tenant_id = ? ORDER BY service_id", (tenant_id,)
+        )
+        return [row[0] for row in rows]
+
+    def is_tenant(self, tenant_id: str) -> bool:
+        return len(self.service_ids(tenant_id)) > 0
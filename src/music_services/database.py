@@ -0,0 +1,104 @@
+import logging
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Tuple
+
+from .metrics import timer
+
+logger = logging.getLogger(__name__)
+
+DB_PATH = "spotelegramify"
+
+
+class Database:
+    """
+    Small pool of long-lived SQLite connections shared by every thread.
+
+    Connections are opened on demand, up to the pool size, in WAL mode so readers don't block
+    the writer, and keep a cache of compiled statements so repeated queries skip the parser.
+    """
+
+    def __init__(self, path: str = DB_PATH, pool_size: int = 4):
+        self.path = path
+        self.pool_size = pool_size
+        self.pool: "queue.Queue[sqlite3.Connection]" = queue.Queue()
+        self.opened = 0
+        self.lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, cached_statements=256)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrow a connection, committing when the block finishes or rolling back if it raises.
+        """
+        with timer("db_query_seconds", statement="TRANSACTION"), self._connection() as conn:
+            yield conn
+
+    @contextmanager
+    def _connection(self):
+        conn = self._acquire()
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self.pool.put(conn)
+
+    def _acquire(self) -> sqlite3.Connection:
+        try:
+            return self.pool.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self.lock:
+            open_another = self.opened < self.pool_size
+            if open_another:
+                self.opened += 1
+        if open_another:
+            return self._connect()
+
+        return self.pool.get()
+
+    def execute(self, sql: str, parameters: Tuple = ()) -> List[Tuple]:
+        with timer("db_query_seconds", statement=statement(sql)), self._connection() as conn:
+            return conn.execute(sql, parameters).fetchall()
+
+    def executemany(self, sql: str, parameters: Iterable[Tuple]):
+        with timer("db_query_seconds", statement=statement(sql)), self._connection() as conn:
+            conn.executemany(sql, parameters)
+
+    def close(self):
+        while not self.pool.empty():
+            self.pool.get().close()
+            with self.lock:
+                self.opened -= 1
+
+
+def statement(sql: str) -> str:
+    """
+    Get the kind of statement, e.g. SELECT, to label its timings with.
+    """
+    return sql.split(None, 1)[0].upper()
+
+
+databases: Dict[str, Database] = {}
+databases_lock = threading.Lock()
+
+
+def get_database(path: str = DB_PATH) -> Database:
+    """
+    Get the shared database for the given path, opening it on first use.
+    """
+    with databases_lock:
+        if path not in databases:
+            databases[path] = Database(path)
+        return databases[path]
@@ -0,0 +1,39 @@
+from typing import Optional
+
+# Statuses the services respond with when asked for something that doesn't exist, including malformed IDs
+NOT_FOUND_STATUSES = {400, 404}
+
+
+def get_http_status(error: Exception) -> Optional[int]:
+    """
+    Get the HTTP status code from an error raised by spotipy or by requests (as used by tidalapi).
+    """
+    status = getattr(error, "http_status", None)
+    if status is None:
+        response = getattr(error, "response", None)
+        status = getattr(response, "status_code", None)
+    return status
+
+
+def is_not_found(error: Exception) -> bool:
+    """
+    Whether the error means the thing asked for doesn't exist, rather than that the service couldn't be reached
+    or failed, in which case the request should be tried again later.
+    """
+    return get_http_status(error) in NOT_FOUND_STATUSES
+
+
+def get_retry_after(error: Exception) -> Optional[float]:
+    """
+    Get the number of seconds the service asked us to wait before retrying, if it said.
+    """
+    headers = getattr(error, "headers", None)
+    if headers is None:
+        headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+
+    try:
+        return float(headers.get("Retry-After") or headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,30 @@
+import threading
+from typing import TYPE_CHECKING, Optional
+
+if TYPE_CHECKING:
+    import requests
+
+# Connections kept open per host, shared by every service instance
+HTTP_POOL_SIZE = 32
+
+http_session: Optional["requests.Session"] = None
+http_session_lock = threading.Lock()
+
+
+def get_http_session() -> "requests.Session":
+    """
+    Get the HTTP session shared by every music service client, creating it on first use.
+    Clients send their credentials with each request, so one pool of connections can serve every tenant.
+    """
+    # requests is imported along with the music service clients, when the first service is created
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    global http_session
+    with http_session_lock:
+        if http_session is None:
+            http_session = requests.Session()
+            adapter = HTTPAdapter(pool_maxsize=HTTP_POOL_SIZE)
+            http_session.mount("https://", adapter)
+            http_session.mount("http://", adapter)
+        return http_session
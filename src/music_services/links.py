@@ -0,0 +1,55 @@
+import logging
+import re
+from typing import Dict, List, NamedTuple, Tuple
+
+logger = logging.getLogger(__name__)
+
+TRACK = "track"
+ALBUM = "album"
+
+
+class Link(NamedTuple):
+    service_id: str
+    kind: str
+    id: str
+
+
+class LinkExtractor:
+    """
+    Finds music links for every service in a message in a single pass.
+
+    The services' track and album patterns are combined into one precompiled regex,
+    with track patterns first so that a link to a track on an album page counts as the track.
+    Messages containing none of the services' link markers are skipped without running the regex.
+    """
+
+    def __init__(self, services):
+        patterns = []
+        self.groups: Dict[int, Tuple[str, str]] = {}
+        self.markers = []
+        for kind in [TRACK, ALBUM]:
+            for service in services:
+                pattern = service.track_regex if kind == TRACK else service.album_regex
+                if re.compile(pattern).groups != 1:
+                    raise ValueError(f"{service.name} {kind} regex must have exactly one group")
+                patterns.append(f"(?:{pattern})")
+                self.groups[len(patterns)] = (service.id, kind)
+
+        for service in services:
+            self.markers += [m for m in service.link_markers if m not in self.markers]
+
+        self.regex = re.compile("|".join(patterns))
+
+    def extract(self, text: str) -> List[Link]:
+        """
+        Get the distinct links in the message, in the order they appear.
+        """
+        if not text or not any(marker in text for marker in self.markers):
+            return []
+
+        links = {}
+        for match in self.regex.finditer(text):
+            service_id, kind = self.groups[match.lastindex]
+            links[Link(service_id, kind, match.group(match.lastindex))] = None
+
+        return list(links)
@@ -0,0 +1,94 @@
+import logging
+import time
+from typing import List, Optional, Tuple
+
+from .cache import MISSING, TTLCache
+from .database import Database, get_database
+from .metrics import increment
+from .things import Track
+
+logger = logging.getLogger(__name__)
+
+# How long to remember a match, and how long to remember that a service had no match, in seconds
+MATCH_TTL = 30 * 24 * 60 * 60
+NO_MATCH_TTL = 24 * 60 * 60
+
+
+class MatchCache:
+    """
+    Remembers which track on each service a shared track was matched to.
+
+    Matches are keyed by the track's ISRC when it has one, and by its normalized name and artist,
+    so the same song shared from different services or different releases still hits.
+    Lookups go through an in-memory LRU before the SQLite table.
+    Misses are cached too, for a shorter time, so a song a service doesn't have isn't searched for
+    every time it is shared.
+    """
+
+    def __init__(self, database: Database = None, max_size: int = 4096):
+        self.database = database if database is not None else get_database()
+        self.memory = TTLCache(max_size=max_size, name="match")
+
+        with self.database.connection() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS track_matches (
+                    service_id TEXT,
+                    match_key TEXT,
+                    service_track_id TEXT,
+                    expires_at REAL,
+                    PRIMARY KEY (service_id, match_key)
+                )
+            """
+            )
+            conn.execute("DELETE FROM track_matches WHERE expires_at <= ?", (time.time(),))
+
+    def get(self, service_id: str, track: Track) -> Tuple[bool, Optional[str]]:
+        """
+        Returns whether the track has a cached match on the service, and the matched track ID,
+        which is None if the service is known not to have the track.
+        """
+        keys = match_keys(track)
+        for key in keys:
+            service_track_id = self.memory.get((service_id, key))
+            if service_track_id is not MISSING:
+                increment("match_cache_requests_total", result="hit")
+                return True, service_track_id
+
+        for key in keys:
+            rows = self.database.execute(
+                """
+                SELECT service_track_id, expires_at FROM track_matches
+                WHERE service_id = ? AND match_key = ? AND expires_at > ?
+                """,
+                (service_id, key, time.time()),
+            )
+            if len(rows) > 0:
+                service_track_id, expires_at = rows[0]
+                self.memory.set((service_id, key), service_track_id, expires_at=expires_at)
+                increment("match_cache_requests_total", result="hit")
+                return True, service_track_id
+
+        increment("match_cache_requests_total", result="miss")
+        return False, None
+
+    def set(self, service_id: str, track: Track, service_track_id: Optional[str]):
+        expires_at = time.time() + (MATCH_TTL if service_track_id is not None else NO_MATCH_TTL)
+        keys = match_keys(track)
+        for key in keys:
+            self.memory.set((service_id, key), service_track_id, expires_at=expires_at)
+
+        self.database.executemany(
+            """
+            INSERT OR REPLACE INTO track_matches (service_id, match_key, service_track_id, expires_at)
+            VALUES (?, ?, ?, ?)
+            """,
+            [(service_id, key, service_track_id, expires_at) for key in keys],
+        )
+
+
+def match_keys(track: Track) -> List[str]:
+    keys = [f"name:{track.match_key}"]
+    if track.isrc:
+        keys.insert(0, f"isrc:{track.isrc.upper()}")
+    return keys
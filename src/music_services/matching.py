@@ -0,0 +1,91 @@
+import re
+from difflib import SequenceMatcher
+from typing import List, Optional
+
+from .things import Track, normalize
+
+# Lowest score a search result must reach to be taken as the same track
+MATCH_THRESHOLD = 0.8
+
+# How much each part counts towards a score, when the durations of both tracks are known
+TITLE_WEIGHT = 0.5
+ARTIST_WEIGHT = 0.35
+DURATION_WEIGHT = 0.15
+
+# Durations this far apart, or further, get no credit, in milliseconds
+MAX_DURATION_DELTA_MS = 30 * 1000
+
+# Bracketed parts and dashed suffixes, e.g. "(feat. Someone)" or "- 2011 Remaster", which services name differently
+TITLE_DECORATION_REGEX = re.compile(r"\s*[\(\[][^\)\]]*[\)\]]|\s+-\s+.*$")
+
+
+def simplify_title(title: str) -> str:
+    return normalize(TITLE_DECORATION_REGEX.sub("", title)).strip()
+
+
+class TrackMatcher:
+    """
+    Scores search results against a track from another service.
+
+    A score, between 0 and 1, combines the similarity of the titles, ignoring decorations
+    like featured artists and remaster notes, the similarity of the artists, and how close
+    the durations are.
+    The track's side of every comparison is prepared once, and candidates whose best possible
+    score can't beat the best so far are skipped before the full comparison is made.
+    """
+
+    def __init__(self, track: Track, threshold: float = MATCH_THRESHOLD):
+        self.track = track
+        self.threshold = threshold
+        # SequenceMatcher caches its analysis of the second sequence, so the track goes there
+        self.title = SequenceMatcher(None, "", simplify_title(track.name), autojunk=False)
+        self.artist = SequenceMatcher(None, "", normalize(track.artist_name), autojunk=False)
+
+    def best(self, candidates: List[Track]) -> Optional[int]:
+        """
+        Get the index of the best scoring candidate, or None if none reach the threshold.
+        """
+        best_index = None
+        best_score = self.threshold
+        for i, candidate in enumerate(candidates):
+            score = self.score(candidate, best_score)
+            # Services list the most relevant results first, so earlier results win ties
+            if score is not None and (score > best_score or (best_index is None and score == best_score)):
+                best_index, best_score = i, score
+
+        return best_index
+
+    def score(self, candidate: Track, at_least: float = 0.0) -> Optional[float]:
+        """
+        Score the candidate, or give None as soon as it's clear it can't score `at_least`.
+        """
+        title_weight, artist_weight, duration_weight = TITLE_WEIGHT, ARTIST_WEIGHT, DURATION_WEIGHT
+        if self.track.duration_ms is None or candidate.duration_ms is None:
+            # Share the duration's weight out between the title and artist
+            title_weight, artist_weight = [w / (TITLE_WEIGHT + ARTIST_WEIGHT) for w in [TITLE_WEIGHT, ARTIST_WEIGHT]]
+            duration = duration_weight = 0.0
+        else:
+            delta = abs(self.track.duration_ms - candidate.duration_ms)
+            duration = 1 - min(delta / MAX_DURATION_DELTA_MS, 1)
+
+        self.title.set_seq1(simplify_title(candidate.name))
+        self.artist.set_seq1(normalize(candidate.artist_name))
+
+        # The quick ratios are upper bounds on the real ones, and much cheaper to work out
+        for ratio in ["real_quick_ratio", "quick_ratio"]:
+            bound = (
+                title_weight * getattr(self.title, ratio)()
+                + artist_weight * getattr(self.artist, ratio)()
+                + duration_weight * duration
+            )
+            if bound < at_least:
+                return None
+
+        return title_weight * self.title.ratio() + artist_weight * self.artist.ratio() + duration_weight * duration
+
+
+def best_match(track: Track, candidates: List[Track], threshold: float = MATCH_THRESHOLD) -> Optional[int]:
+    """
+    Get the index of the candidate most likely to be the same as the track, or None if none are likely enough.
+    """
+    return TrackMatcher(track, threshold).best(candidates)
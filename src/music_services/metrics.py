@@ -0,0 +1,215 @@
+import bisect
+import contextvars
+import json
+import logging
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of histogram buckets, in seconds for timers and plain numbers for counts
+SECONDS_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+COUNT_BUCKETS = [0, 1, 2, 5, 10, 20, 50, 100, 200]
+
+# Labels are kept as sorted tuples of (name, value) pairs, so they can be used in keys
+Labels = Tuple[Tuple[str, str], ...]
+
+# Gives samples of values that are read rather than counted, e.g. queue lengths, as (name, labels, value)
+Collector = Callable[[], List[Tuple[str, Dict[str, str], float]]]
+
+
+class Histogram:
+    def __init__(self, buckets: List[float]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """
+    Counters, histograms and collected gauges, rendered in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self.counters: Dict[Tuple[str, Labels], float] = {}
+        self.histograms: Dict[Tuple[str, Labels], Histogram] = {}
+        self.collectors: List[Collector] = []
+        self.lock = threading.Lock()
+
+    def increment(self, name: str, amount: float = 1, **labels: str):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, buckets: List[float] = SECONDS_BUCKETS, **labels: str):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def add_collector(self, collector: Collector):
+        self.collectors.append(collector)
+
+    def render(self) -> str:
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items(), key=lambda item: item[0])
+            histograms = [(key, list(h.buckets), list(h.counts), h.sum, h.count) for key, h in histograms]
+
+        lines = []
+        typed = set()
+
+        def declare(name: str, kind: str):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in counters:
+            declare(name, "counter")
+            lines.append(f"{name}{format_labels(labels)} {value:g}")
+
+        for (name, labels), buckets, counts, total, count in histograms:
+            declare(name, "histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(buckets + ["+Inf"], counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', str(bound)),))} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {total:g}")
+            lines.append(f"{name}_count{format_labels(labels)} {count}")
+
+        for collector in self.collectors:
+            try:
+                samples = collector()
+            except Exception as e:
+                logger.warning("Metrics collector failed: %s", e)
+                continue
+            for name, labels, value in samples:
+                declare(name, "gauge")
+                lines.append(f"{name}{format_labels(tuple(sorted(labels.items())))} {value:g}")
+
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels: Labels) -> str:
+    if len(labels) < 1:
+        return ""
+    escaped = [(name, str(value).replace("\\", "\\\\").replace('"', '\\"')) for name, value in labels]
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class Trace:
+    """
+    Everything counted and timed while handling one update or batch of jobs, across threads.
+    Spans are only kept when traces are being written out.
+    """
+
+    def __init__(self, name: str, keep_spans: bool, **attributes):
+        self.name = name
+        self.attributes = attributes
+        self.started_at = time.time()
+        self.duration = None
+        self.counts = Counter()
+        self.spans: Optional[List[Tuple[str, Dict[str, str], float]]] = [] if keep_spans else None
+        self.lock = threading.Lock()
+
+    def count(self, name: str) -> float:
+        with self.lock:
+            return self.counts[name]
+
+    def to_dict(self) -> Dict:
+        return {
+            "name": self.name,
+            "attributes": self.attributes,
+            "started_at": self.started_at,
+            "duration": self.duration,
+            "counts": dict(self.counts),
+            "spans": self.spans,
+        }
+
+
+# Metrics for the whole process
+metrics = Metrics()
+
+# Trace of the update or batch of jobs being handled, if any
+current_trace: contextvars.ContextVar[Optional[Trace]] = contextvars.ContextVar("current_trace", default=None)
+
+# File finished traces are appended to as JSON lines, if set
+trace_path: Optional[str] = None
+trace_lock = threading.Lock()
+
+
+def increment(name: str, amount: float = 1, **labels: str):
+    metrics.increment(name, amount, **labels)
+    trace = current_trace.get()
+    if trace is not None:
+        with trace.lock:
+            trace.counts[name] += amount
+
+
+def observe(name: str, value: float, buckets: List[float] = SECONDS_BUCKETS, **labels: str):
+    metrics.observe(name, value, buckets, **labels)
+    trace = current_trace.get()
+    if trace is not None and trace.spans is not None:
+        with trace.lock:
+            trace.spans.append((name, labels, value))
+
+
+@contextmanager
+def timer(name: str, **labels: str) -> Iterator[None]:
+    """
+    Time the block into the named histogram, counting it as an error too if it raises.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        increment(f"{name}_errors_total", **labels)
+        raise
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+@contextmanager
+def trace(name: str, **attributes) -> Iterator[Trace]:
+    """
+    Trace everything counted and timed within the block, including by calls it hands to other
+    threads with the context copied, writing it out when the block ends if traces are enabled.
+    """
+    current = Trace(name, trace_path is not None, **attributes)
+    token = current_trace.set(current)
+    start = time.perf_counter()
+    try:
+        yield current
+    finally:
+        current_trace.reset(token)
+        current.duration = time.perf_counter() - start
+        if trace_path is not None:
+            write_trace(current)
+
+
+def write_trace(current: Trace):
+    try:
+        with trace_lock, open(trace_path, "a") as traces:
+            traces.write(json.dumps(current.to_dict(), default=str))
+            traces.write("\n")
+    except OSError as e:
+        logger.warning("Unable to write trace: %s", e)
+
+
+def enable_traces(path: Optional[str]):
+    """
+    Append a JSON line to the file for every finished trace, or stop if the path is None.
+    """
+    global trace_path
+    trace_path = path
@@ -1,22 +1,75 @@
+import functools
 import logging
-import re
 from abc import ABC, abstractmethod
-from typing import Dict, List
+from typing import Dict, Iterator, List, Optional
 
+from .aio import run_sync
+from .albums import FIRST, TOP, AlbumMode
+from .auth import TokenManager
+from .cache import MISSING, TTLCache
+from .errors import get_http_status
+from .matching import best_match
+from .metrics import increment, timer
+from .playlist_index import PlaylistIndex
+from .scheduler import PRIORITY_WRITE, SERVER_ERROR_STATUSES, get_scheduler, priority
 from .things import Playlist, Track
 
 logger = logging.getLogger(__name__)
 
+# How long to keep playlist metadata before looking it up again, in seconds
+PLAYLIST_CACHE_TTL = 60 * 60
+
+# Methods timed in the metrics, wherever a service defines them
+TIMED_METHODS = [
+    "lookup_service_track",
+    "lookup_service_tracks",
+    "lookup_service_album",
+    "lookup_service_albums",
+    "lookup_service_playlist",
+    "get_album_tracks",
+    "complete_album_tracks",
+    "get_playlist",
+    "get_playlist_track_ids",
+    "get_playlist_snapshot_id",
+    "add_to_playlist",
+    "add_tracks_to_playlist",
+    "search_track",
+    "search_track_by_isrc",
+    "search_track_candidates",
+    "convert_tracks",
+]
+
+
+def timed_method(name: str, method):
+    @functools.wraps(method)
+    def timed(self, *args, **kwargs):
+        with timer("music_service_method_seconds", service=self.id, method=name):
+            return method(self, *args, **kwargs)
+
+    return timed
+
 
 class MusicService(ABC):
-    def __init__(self):
-        self.refresh_auth()
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        for name in TIMED_METHODS:
+            if name in cls.__dict__:
+                setattr(cls, name, timed_method(name, cls.__dict__[name]))
 
-    def find_album_ids(self, message: str) -> List:
-        return re.findall(self.album_regex, message)
+    def __init__(self):
+        self.playlist_index = PlaylistIndex(self)
+        self.playlist_cache = TTLCache(max_size=256, ttl=PLAYLIST_CACHE_TTL, name="playlist")
+        self.scheduler = get_scheduler(self.id, self.name, self.requests_per_second, self.request_burst)
+        self.token_manager = TokenManager(self.name, self.refresh_auth)
+        self.token_manager.refresh()
+        self.token_manager.start()
 
-    def find_track_ids(self, message: str) -> List:
-        return re.findall(self.track_regex, message)
+    def close(self):
+        """
+        Stop the instance's background work, once it is no longer needed.
+        """
+        self.token_manager.stop()
+        self.playlist_index.stop_reconciling()
 
     def name(self) -> str:
         pass
@@ -27,11 +80,61 @@ class MusicService(ABC):
     def album_regex(self):
         pass
 
+    def max_playlist_batch(self) -> int:
+        pass
+
+    def requests_per_second(self) -> float:
+        pass
+
+    def request_burst(self) -> int:
+        pass
+
+    def request(self, fn, *args, **kwargs):
+        """
+        Make a request to the service, paced by the scheduler and with a fresh access token.
+        """
+        method = getattr(fn, "__name__", "request")
+        increment("music_service_requests_total", service=self.id, method=method)
+        with timer("music_service_request_seconds", service=self.id, method=method):
+            return self.scheduler.call(self.token_manager.call, fn, *args, **kwargs)
+
+    def request_write(self, fn, *args, **kwargs):
+        """
+        Make a request that changes something, which isn't repeated if the service fails part way, see `request`.
+        """
+        method = getattr(fn, "__name__", "request")
+        increment("music_service_requests_total", service=self.id, method=method)
+        with timer("music_service_request_seconds", service=self.id, method=method):
+            return self.scheduler.call_write(self.token_manager.call, fn, *args, **kwargs)
+
     def track_regex(self):
         pass
 
+    def link_markers(self) -> List[str]:
+        """
+        Substrings that appear in every link to this service, used to skip messages cheaply.
+        """
+        pass
+
+    def credential_names(self) -> List[str]:
+        """
+        Names of the credentials a tenant must provide for this service, in the order they are given.
+        """
+        pass
+
+    @classmethod
+    def env_credentials(cls) -> Optional[Dict[str, str]]:
+        """
+        Credentials for the admin user set in the environment, if any.
+        """
+        return None
+
     @abstractmethod
-    def refresh_auth(self):
+    def refresh_auth(self) -> float:
+        """
+        Refresh the access token, returning its expiry as a UNIX timestamp or None if unknown.
+        Called by the token manager, which should be used instead of calling this directly.
+        """
         pass
 
     @abstractmethod
@@ -42,10 +145,69 @@ class MusicService(ABC):
     def lookup_service_album(self, album_id: str) -> Dict:
         pass
 
+    def get_album_tracks(self, service_album, mode: AlbumMode) -> List:
+        """
+        Get the service tracks of the album that the mode adds, in the order they should be added.
+        """
+        if mode.kind == FIRST:
+            service_track = self.get_service_track_from_album(service_album)
+            return [service_track] if service_track is not None else []
+
+        service_tracks = self.complete_album_tracks([t for page in self.iter_album_pages(service_album) for t in page])
+        if mode.kind == TOP:
+            # Sorting is stable, so equally popular tracks stay in album order
+            return sorted(service_tracks, key=self.get_track_popularity, reverse=True)[: mode.count]
+        return service_tracks
+
+    @abstractmethod
+    def iter_album_pages(self, service_album) -> Iterator[List]:
+        """
+        Fetch the album's service tracks a page at a time, in album order.
+        """
+        pass
+
+    def complete_album_tracks(self, service_tracks: List) -> List:
+        """
+        Fill in anything album tracklists leave out that matching and ranking use, e.g. ISRCs.
+        Services whose tracklists have everything needn't override this.
+        """
+        return service_tracks
+
+    def get_track_popularity(self, service_track) -> float:
+        return 0
+
     @abstractmethod
     def lookup_service_track(self, track_id: str) -> Dict:
         pass
 
+    def lookup_service_tracks(self, track_ids: List[str]) -> List[Dict]:
+        """
+        Look up many tracks at once, giving None for any that can't be found.
+        Services with a bulk endpoint should override this.
+        """
+        return [self.lookup_service_track(track_id) for track_id in track_ids]
+
+    def lookup_service_albums(self, album_ids: List[str]) -> List[Dict]:
+        """
+        Look up many albums at once, giving None for any that can't be found.
+        Services with a bulk endpoint should override this.
+        """
+        return [self.lookup_service_album(album_id) for album_id in album_ids]
+
+    def get_playlist(self, playlist_id: str):
+        """
+        Get the service playlist, from the cache if it has been looked up recently.
+        Adding tracks doesn't change anything we read from the playlist, so only changes
+        made outside the bot, or a new playlist being set, invalidate the cache.
+        """
+        service_playlist = self.playlist_cache.get(playlist_id)
+        if service_playlist is MISSING:
+            service_playlist = self.lookup_service_playlist(playlist_id)
+            if service_playlist is not None:
+                self.playlist_cache.set(playlist_id, service_playlist)
+
+        return service_playlist
+
     @abstractmethod
     def lookup_service_playlist(self, playlist_id: str) -> Dict:
         pass
@@ -56,30 +218,134 @@ class MusicService(ABC):
         pass
 
     @abstractmethod
-    def convert_playlist(self, playlist: List[any]) -> List[Playlist]:
+    def convert_playlist(self, playlist: List[any]) -> Playlist:
+        """
+        Convert the service playlist, without fetching its tracks until they are iterated.
+        """
         pass
 
+    def add_to_playlist(self, playlist_id: str, track_ids: List[str]) -> List[str]:
+        """
+        Add any of the tracks not already in the playlist, in as few requests as the service allows.
+        Returns the IDs of the tracks that were added.
+        """
+        # Reserved in the shared database, so that other processes writing to the playlist don't add them too
+        new_track_ids = self.playlist_index.reserve(playlist_id, list(dict.fromkeys(track_ids)))
+
+        for i in range(0, len(new_track_ids), self.max_playlist_batch):
+            chunk = new_track_ids[i : i + self.max_playlist_batch]
+            logger.info("Adding %s tracks to %s playlist %s", len(chunk), self.name, playlist_id)
+            try:
+                with priority(PRIORITY_WRITE):
+                    snapshot_id = self.add_tracks_to_playlist(playlist_id, chunk)
+            except Exception as e:
+                self.playlist_index.release(playlist_id, new_track_ids[i + self.max_playlist_batch :])
+                # The tracks may have been added anyway, so check the playlist itself before adding them again,
+                # keeping them reserved until the reservation expires so that other processes don't add them either
+                if get_http_status(e) in SERVER_ERROR_STATUSES:
+                    self.playlist_index.invalidate(playlist_id)
+                else:
+                    self.playlist_index.release(playlist_id, chunk)
+                raise
+            self.playlist_index.record_add(playlist_id, chunk, snapshot_id)
+
+        return new_track_ids
+
     @abstractmethod
-    def add_to_playlist(self, playlist, service_track):
+    def add_tracks_to_playlist(self, playlist_id: str, track_ids: List[str]) -> str:
+        """
+        Add the tracks to the playlist in a single request, returning the playlist's new snapshot marker.
+        """
         pass
 
-    @abstractmethod
     def search_track(self, track: Track):
+        """
+        Find the service's version of a track from another service.
+        Tracks are found by ISRC where possible, otherwise the best scoring text search result is taken,
+        or None if no result is a confident enough match.
+        """
+        if track.isrc is not None:
+            service_track = self.search_track_by_isrc(track.isrc)
+            if service_track is not None:
+                return service_track
+
+        # Converting drops results that can't be matched, such as tracks without an artist, so each result
+        # is converted on its own to keep it alongside its conversion
+        candidates = [
+            (service_track, converted)
+            for service_track in self.search_track_candidates(track)
+            for converted in self.convert_tracks([service_track])
+        ]
+        best = best_match(track, [converted for _, converted in candidates])
+        if best is None:
+            logger.info("No %s search result matched %s - %s", self.name, track.name, track.artist_name)
+            return None
+
+        return candidates[best][0]
+
+    @abstractmethod
+    def search_track_by_isrc(self, isrc: str):
+        """
+        Look up the track with the given ISRC, or None if the service doesn't have it.
+        """
+        pass
+
+    @abstractmethod
+    def search_track_candidates(self, track: Track) -> List:
+        """
+        Search for tracks with the track's title and artist, most relevant first.
+        """
         pass
 
     @abstractmethod
-    def playlist_contains_track(self, playlist_id: str, service_track):
+    def get_service_track_id(self, service_track) -> str:
         pass
 
+    def iter_playlist_tracks(self, playlist_id: str) -> Iterator[Track]:
+        """
+        Stream the playlist's tracks, fetching each page only when the previous one has been iterated.
+        """
+        for page in self.iter_playlist_pages(playlist_id):
+            yield from self.convert_tracks(page)
 
-def get_music_service_by_id(services: List[MusicService], id: str) -> MusicService:
+    @abstractmethod
+    def iter_playlist_pages(self, playlist_id: str) -> Iterator[List]:
+        """
+        Fetch the playlist's service tracks a page at a time, with only the fields needed to convert them.
+        """
+        pass
+
+    @abstractmethod
+    def get_playlist_track_ids(self, playlist_id: str) -> List[str]:
+        """
+        Fetch the IDs of every track in the playlist, following pagination.
+        """
+        pass
+
+    @abstractmethod
+    def get_playlist_snapshot_id(self, playlist_id: str) -> str:
+        """
+        Fetch a marker that changes whenever the playlist contents change.
+        """
+        pass
+
+    # Async counterparts of the lookups made by the async runtime.
+    # These adapt the blocking clients by default; services with a native async client should override them.
+
+    async def lookup_service_tracks_async(self, track_ids: List[str]) -> List[Dict]:
+        return await run_sync(self.lookup_service_tracks, track_ids)
+
+    async def lookup_service_albums_async(self, album_ids: List[str]) -> List[Dict]:
+        return await run_sync(self.lookup_service_albums, album_ids)
+
+    async def get_album_tracks_async(self, service_album, mode: AlbumMode) -> List:
+        return await run_sync(self.get_album_tracks, service_album, mode)
 
-    matching_services = [s for s in services if s.id == id.lower()]
-    if len(matching_services) < 1:
-        logger.info(f"Invalid service {id}.")
-        return None
 
-    return matching_services[0]
+# The base class's own implementations are timed too, subclasses' overrides are wrapped as they are defined
+for name in TIMED_METHODS:
+    if name in MusicService.__dict__ and not getattr(MusicService.__dict__[name], "__isabstractmethod__", False):
+        setattr(MusicService, name, timed_method(name, MusicService.__dict__[name]))
 
 
 def get_all_music_services():
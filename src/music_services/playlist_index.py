@@ -0,0 +1,327 @@
+import logging
+import threading
+import time
+import uuid
+from typing import Dict, Iterable, List, Optional, Set
+
+from .database import Database, get_database
+from .scheduler import PRIORITY_BACKGROUND, priority
+
+logger = logging.getLogger(__name__)
+
+# How long a track reserved for adding to a playlist is held for the process that reserved it, in seconds.
+# Reservations of a process that died while adding expire, so the tracks are added when their jobs are retried
+RESERVATION_TTL = 5 * 60
+
+
+class PlaylistWritePendingError(Exception):
+    """
+    Raised for a track that another writer has reserved but not yet added, so it may not be added after all.
+    """
+
+    pass
+
+
+class PlaylistIndex:
+    """
+    Local record of which tracks are in each playlist a service writes to.
+
+    The index is seeded once per playlist with a full fetch of the playlist contents,
+    updated whenever the bot adds a track, and persisted so it survives restarts.
+    A snapshot marker (Spotify snapshot ID, Tidal last update) is stored alongside the
+    track IDs so that changes made outside the bot can be picked up by `reconcile`.
+
+    Processes sharing the database, e.g. the shards of the sharded runtime, may write to the same
+    playlist. Tracks are reserved in the database before they're written, see `reserve`, so that
+    only one process adds each track even when its in-memory index is out of date. Reservations
+    are kept apart from the tracks known to be in the playlist, and expire.
+
+    Each playlist has its own lock, held while it is seeded, so a slow fetch of one playlist
+    only holds up lookups and additions for that playlist. The shared lock only guards the maps.
+    """
+
+    def __init__(self, service, database: Database = None, reservation_ttl: float = RESERVATION_TTL):
+        self.service = service
+        self.reservation_ttl = reservation_ttl
+        # Identifies this index's reservations, which it can renew after a failed write
+        self.owner = uuid.uuid4().hex
+        self.database = database if database is not None else get_database()
+        self.playlists: Dict[str, Set[str]] = {}
+        self.snapshots: Dict[str, Optional[str]] = {}
+        self.playlist_locks: Dict[str, threading.RLock] = {}
+        self.lock = threading.Lock()
+        self.reconciler = None
+
+        with self.database.connection() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS playlist_tracks (
+                    service_id TEXT,
+                    playlist_id TEXT,
+                    track_id TEXT,
+                    PRIMARY KEY (service_id, playlist_id, track_id)
+                )
+            """
+            )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS playlist_reservations (
+                    service_id TEXT,
+                    playlist_id TEXT,
+                    track_id TEXT,
+                    owner TEXT,
+                    expires_at REAL,
+                    PRIMARY KEY (service_id, playlist_id, track_id)
+                )
+            """
+            )
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(playlist_reservations)")]
+            if "owner" not in columns:
+                conn.execute("ALTER TABLE playlist_reservations ADD COLUMN owner TEXT")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS playlist_snapshots (
+                    service_id TEXT,
+                    playlist_id TEXT,
+                    snapshot_id TEXT,
+                    PRIMARY KEY (service_id, playlist_id)
+                )
+            """
+            )
+
+    def contains(self, playlist_id: str, track_id: str) -> bool:
+        return track_id in self._get_track_ids(playlist_id)
+
+    def reserve(self, playlist_id: str, track_ids: List[str]) -> List[str]:
+        """
+        Claim the tracks that aren't in the playlist yet for this process to add, returning them.
+        Tracks another process has claimed or added since this one last looked are left out.
+        Claimed tracks must be recorded with `record_add` once added, or released if they couldn't be.
+        """
+        with self._playlist_lock(playlist_id):
+            indexed = self._get_track_ids(playlist_id)
+            with self.lock:
+                candidates = [track_id for track_id in track_ids if track_id not in indexed]
+
+            now = time.time()
+            reserved = []
+            added_elsewhere = []
+            with self.database.connection() as conn:
+                # Writing first takes the database's write lock, so no other process adds or reserves
+                # the tracks between checking and reserving them
+                conn.execute(
+                    "DELETE FROM playlist_reservations WHERE service_id = ? AND playlist_id = ? AND expires_at <= ?",
+                    (self.service.id, playlist_id, now),
+                )
+                for track_id in candidates:
+                    key = (self.service.id, playlist_id, track_id)
+                    rows = conn.execute(
+                        "SELECT 1 FROM playlist_tracks WHERE service_id = ? AND playlist_id = ? AND track_id = ?",
+                        key,
+                    ).fetchall()
+                    if len(rows) > 0:
+                        added_elsewhere.append(track_id)
+                        continue
+                    cursor = conn.execute(
+                        """
+                        INSERT OR IGNORE INTO playlist_reservations
+                            (service_id, playlist_id, track_id, owner, expires_at)
+                        VALUES (?, ?, ?, ?, ?)
+                        """,
+                        (*key, self.owner, now + self.reservation_ttl),
+                    )
+                    if cursor.rowcount < 1:
+                        # Tracks this index kept reserved after a failed write, which the playlist doesn't have
+                        cursor = conn.execute(
+                            """
+                            UPDATE playlist_reservations SET expires_at = ?
+                            WHERE service_id = ? AND playlist_id = ? AND track_id = ? AND owner = ?
+                            """,
+                            (now + self.reservation_ttl, *key, self.owner),
+                        )
+                    if cursor.rowcount > 0:
+                        reserved.append(track_id)
+
+            with self.lock:
+                indexed.update(added_elsewhere)
+        return reserved
+
+    def release(self, playlist_id: str, track_ids: List[str]):
+        """
+        Give up tracks claimed by `reserve` that weren't added after all.
+        """
+        if len(track_ids) < 1:
+            return
+        self.database.executemany(
+            "DELETE FROM playlist_reservations WHERE service_id = ? AND playlist_id = ? AND track_id = ?",
+            [(self.service.id, playlist_id, track_id) for track_id in track_ids],
+        )
+
+    def record_add(self, playlist_id: str, track_ids: Iterable[str], snapshot_id: Optional[str] = None):
+        """
+        Record tracks that were successfully added to a playlist by the bot, ending their reservations.
+        """
+        track_ids = list(track_ids)
+        with self._playlist_lock(playlist_id):
+            indexed = self._get_track_ids(playlist_id)
+            with self.lock:
+                indexed.update(track_ids)
+            with self.database.connection() as conn:
+                conn.executemany(
+                    """
+                    INSERT OR IGNORE INTO playlist_tracks (service_id, playlist_id, track_id)
+                    VALUES (?, ?, ?)
+                    """,
+                    [(self.service.id, playlist_id, track_id) for track_id in track_ids],
+                )
+                conn.executemany(
+                    "DELETE FROM playlist_reservations WHERE service_id = ? AND playlist_id = ? AND track_id = ?",
+                    [(self.service.id, playlist_id, track_id) for track_id in track_ids],
+                )
+                if snapshot_id is not None:
+                    self._store_snapshot(conn, playlist_id, snapshot_id)
+
+    def invalidate(self, playlist_id: str):
+        """
+        Forget what is in the playlist, so that it is seeded again with a full fetch when next used.
+        """
+        with self._playlist_lock(playlist_id):
+            with self.lock:
+                self.playlists.pop(playlist_id, None)
+                self.snapshots.pop(playlist_id, None)
+            self.database.execute(
+                "DELETE FROM playlist_snapshots WHERE service_id = ? AND playlist_id = ?",
+                (self.service.id, playlist_id),
+            )
+
+    def reconcile(self, playlist_id: str):
+        """
+        Compare the stored snapshot marker with the service and re-seed the playlist if it has changed.
+        """
+        snapshot_id = self.service.get_playlist_snapshot_id(playlist_id)
+        with self._playlist_lock(playlist_id):
+            self._get_track_ids(playlist_id)
+            with self.lock:
+                unchanged = snapshot_id is not None and snapshot_id == self.snapshots.get(playlist_id)
+            if unchanged:
+                return
+            logger.info("%s playlist %s changed, re-seeding index", self.service.name, playlist_id)
+            self.service.playlist_cache.invalidate(playlist_id)
+            self._seed(playlist_id, snapshot_id)
+
+    def reconcile_all(self):
+        with self.lock:
+            playlist_ids = list(self.playlists)
+        for playlist_id in playlist_ids:
+            try:
+                self.reconcile(playlist_id)
+            except Exception as e:
+                logger.warning("Failed to reconcile %s playlist %s: %s", self.service.name, playlist_id, e)
+
+    def start_reconciling(self, interval: float):
+        """
+        Periodically reconcile every indexed playlist on a background thread.
+        """
+        if self.reconciler is not None:
+            return
+
+        stopped = threading.Event()
+
+        def run():
+            with priority(PRIORITY_BACKGROUND):
+                while not stopped.wait(interval):
+                    self.reconcile_all()
+
+        self.reconciler = threading.Thread(target=run, name=f"{self.service.id}-playlist-index", daemon=True)
+        self.reconciler.stop = stopped
+        self.reconciler.start()
+
+    def stop_reconciling(self):
+        if self.reconciler is not None:
+            self.reconciler.stop.set()
+            self.reconciler = None
+
+    def _playlist_lock(self, playlist_id: str) -> threading.RLock:
+        with self.lock:
+            return self.playlist_locks.setdefault(playlist_id, threading.RLock())
+
+    def _get_track_ids(self, playlist_id: str) -> Set[str]:
+        with self.lock:
+            track_ids = self.playlists.get(playlist_id)
+        if track_ids is not None:
+            return track_ids
+
+        # Only one thread loads or seeds each playlist, the others wait for it
+        with self._playlist_lock(playlist_id):
+            with self.lock:
+                track_ids = self.playlists.get(playlist_id)
+            if track_ids is not None:
+                return track_ids
+
+            track_ids = self._load(playlist_id)
+            if track_ids is not None:
+                return track_ids
+
+            return self._seed(playlist_id)
+
+    def _load(self, playlist_id: str) -> Optional[Set[str]]:
+        snapshots = self.database.execute(
+            """
+            SELECT snapshot_id FROM playlist_snapshots WHERE service_id = ? AND playlist_id = ?
+            """,
+            (self.service.id, playlist_id),
+        )
+        if len(snapshots) < 1:
+            return None
+
+        rows = self.database.execute(
+            """
+            SELECT track_id FROM playlist_tracks WHERE service_id = ? AND playlist_id = ?
+            """,
+            (self.service.id, playlist_id),
+        )
+        track_ids = {row[0] for row in rows}
+
+        with self.lock:
+            self.playlists[playlist_id] = track_ids
+            self.snapshots[playlist_id] = snapshots[0][0]
+        return track_ids
+
+    def _seed(self, playlist_id: str, snapshot_id: Optional[str] = None) -> Set[str]:
+        logger.info("Seeding index for %s playlist %s", self.service.name, playlist_id)
+        if snapshot_id is None:
+            snapshot_id = self.service.get_playlist_snapshot_id(playlist_id)
+        track_ids = set(self.service.get_playlist_track_ids(playlist_id))
+
+        with self.database.connection() as conn:
+            conn.execute(
+                """
+                DELETE FROM playlist_tracks WHERE service_id = ? AND playlist_id = ?
+                """,
+                (self.service.id, playlist_id),
+            )
+            conn.executemany(
+                """
+                INSERT OR IGNORE INTO playlist_tracks (service_id, playlist_id, track_id)
+                VALUES (?, ?, ?)
+                """,
+                [(self.service.id, playlist_id, track_id) for track_id in track_ids],
+            )
+            self._store_snapshot(conn, playlist_id, snapshot_id)
+
+        with self.lock:
+            self.playlists[playlist_id] = track_ids
+
+        logger.info("Indexed %s tracks in %s playlist %s", len(track_ids), self.service.name, playlist_id)
+        return track_ids
+
+    def _store_snapshot(self, conn, playlist_id: str, snapshot_id: Optional[str]):
+        conn.execute(
+            """
+            INSERT OR REPLACE INTO playlist_snapshots (service_id, playlist_id, snapshot_id)
+            VALUES (?, ?, ?)
+            """,
+            (self.service.id, playlist_id, snapshot_id),
+        )
+        with self.lock:
+            self.snapshots[playlist_id] = snapshot_id
@@ -0,0 +1,236 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .cache import MISSING, TTLCache
+from .credentials import CredentialStore
+from .music_service import MusicService
+
+logger = logging.getLogger(__name__)
+
+# How long to wait before trying to create a tenant's service again after it failed, in seconds
+FAILED_SERVICE_TTL = 60
+
+# How often to check whether a tenant's credentials were changed, e.g. by another process, in seconds
+CREDENTIAL_CHECK_INTERVAL = 60
+
+
+class ServiceRegistry:
+    """
+    Music service instances for every tenant, created on first use from their stored credentials.
+
+    At most `max_size` instances are kept, the least recently used being closed to make room,
+    and instances not used for `idle_timeout` seconds are closed as well.
+    Instances are recreated when the tenant's stored credentials change.
+    `factories` create a service instance from a tenant's credentials, by service ID.
+    """
+
+    def __init__(
+        self,
+        credentials: CredentialStore,
+        factories: Dict[str, Callable[[Dict[str, str]], MusicService]],
+        max_size: int = 64,
+        idle_timeout: float = 60 * 60,
+        on_create: Optional[Callable[[MusicService], None]] = None,
+    ):
+        self.credentials = credentials
+        self.factories = factories
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.on_create = on_create
+        self.services: "OrderedDict[Tuple[str, str], Tuple[MusicService, float]]" = OrderedDict()
+        self.creating: Dict[Tuple[str, str], threading.Lock] = {}
+        # When each instance's credentials were stored, and when that was last checked
+        self.versions: Dict[Tuple[str, str], Tuple[float, float]] = {}
+        self.failed = TTLCache(ttl=FAILED_SERVICE_TTL)
+        self.lock = threading.Lock()
+
+        self.created = 0
+        self.evicted = 0
+
+    def get(self, tenant_id: str, service_id: str) -> Optional[MusicService]:
+        """
+        Get the tenant's instance of the service, or None if they have no working credentials for it.
+        """
+        key = (tenant_id, service_id)
+        service = self._touch(key)
+        if service is not None and not self._credentials_changed(key):
+            return service
+        if service_id not in self.factories or self.failed.get(key) is not MISSING:
+            return None
+
+        with self.lock:
+            creating = self.creating.setdefault(key, threading.Lock())
+
+        # Only one thread creates each instance, the others wait for it
+        with creating:
+            service = self._touch(key)
+            if service is None:
+                service = self._create(key)
+
+        with self.lock:
+            self.creating.pop(key, None)
+        return service
+
+    def get_services(self, tenant_id: str) -> List[MusicService]:
+        """
+        Get the tenant's instances of every service they have credentials for.
+        """
+        services = [self.get(tenant_id, service_id) for service_id in self.credentials.service_ids(tenant_id)]
+        return [service for service in services if service is not None]
+
+    def check(self, service_id: str, credentials: Dict[str, str]) -> bool:
+        """
+        Check whether the credentials work for the service, by creating an instance from them and closing it again.
+        """
+        try:
+            service = self.factories[service_id](credentials)
+        except Exception as e:
+            logger.info("Credentials for %s service don't work: %s", service_id, e)
+            return False
+        service.close()
+        return True
+
+    def warm(self, tenant_id: str, on_ready: Optional[Callable[[List[MusicService]], None]] = None):
+        """
+        Create the tenant's instances of every service they have credentials for in the background, all at once,
+        so that they are ready before they are first used without holding up whatever is starting.
+        `on_ready` is given the instances that could be created.
+        """
+        service_ids = self.credentials.service_ids(tenant_id)
+
+        def run():
+            with ThreadPoolExecutor(max(len(service_ids), 1), thread_name_prefix=f"warm-{tenant_id}") as executor:
+                services = list(executor.map(lambda service_id: self.get(tenant_id, service_id), service_ids))
+            if on_ready is not None:
+                on_ready([service for service in services if service is not None])
+
+        threading.Thread(target=run, name=f"warm-{tenant_id}", daemon=True).start()
+
+    def invalidate(self, tenant_id: str, service_id: str):
+        """
+        Close the tenant's instance of the service, e.g. because their credentials changed.
+        """
+        key = (tenant_id, service_id)
+        self.failed.invalidate(key)
+        with self.lock:
+            entry = self.services.pop(key, None)
+            self.versions.pop(key, None)
+        if entry is not None:
+            self._close(key, entry[0])
+
+    def close(self):
+        with self.lock:
+            entries = list(self.services.items())
+            self.services.clear()
+            self.versions.clear()
+        for key, (service, _) in entries:
+            self._close(key, service)
+
+    def stats(self) -> Dict[str, int]:
+        return {"services": len(self.services), "created": self.created, "evicted": self.evicted}
+
+    def token_stats(self) -> Dict[str, Dict[str, float]]:
+        """
+        Token refresh stats of the live instances by service ID: counts and times summed, the slowest last
+        refresh and the soonest expiry.
+        """
+        with self.lock:
+            services = [service for service, _ in self.services.values()]
+
+        totals: Dict[str, Dict[str, float]] = {}
+        for service in services:
+            stats = service.token_manager.stats()
+            total = totals.get(service.id)
+            if total is None:
+                totals[service.id] = stats
+                continue
+            for name in ["refreshes", "failures", "refresh_seconds"]:
+                total[name] += stats[name]
+            total["last_refresh_seconds"] = max(total["last_refresh_seconds"], stats["last_refresh_seconds"])
+            total["expires_in"] = min(total["expires_in"], stats["expires_in"])
+        return totals
+
+    def _touch(self, key: Tuple[str, str]) -> Optional[MusicService]:
+        now = time.monotonic()
+        with self.lock:
+            evicted = self._pop_idle(now)
+            entry = self.services.get(key)
+            if entry is not None:
+                self.services[key] = (entry[0], now)
+                self.services.move_to_end(key)
+
+        for evicted_key, service in evicted:
+            self._close(evicted_key, service)
+        return entry[0] if entry is not None else None
+
+    def _credentials_changed(self, key: Tuple[str, str]) -> bool:
+        now = time.monotonic()
+        with self.lock:
+            updated_at, checked_at = self.versions.get(key, (None, now))
+        if now - checked_at < CREDENTIAL_CHECK_INTERVAL:
+            return False
+
+        if self.credentials.updated_at(*key) == updated_at:
+            with self.lock:
+                self.versions[key] = (updated_at, now)
+            return False
+
+        logger.info("Credentials for %s service for tenant %s changed", key[1], key[0])
+        self.invalidate(*key)
+        return True
+
+    def _create(self, key: Tuple[str, str]) -> Optional[MusicService]:
+        tenant_id, service_id = key
+        credentials = self.credentials.get(tenant_id, service_id)
+        updated_at = self.credentials.updated_at(tenant_id, service_id)
+        if credentials is None:
+            return None
+
+        logger.info("Creating %s service for tenant %s", service_id, tenant_id)
+        try:
+            service = self.factories[service_id](credentials)
+            if self.on_create is not None:
+                self.on_create(service)
+        except Exception as e:
+            logger.warning("Unable to create %s service for tenant %s: %s", service_id, tenant_id, e)
+            self.failed.set(key, True)
+            return None
+
+        with self.lock:
+            self.services[key] = (service, time.monotonic())
+            self.versions[key] = (updated_at, time.monotonic())
+            self.created += 1
+            evicted = []
+            while len(self.services) > self.max_size:
+                evicted.append(self._pop_oldest())
+
+        for evicted_key, evicted_service in evicted:
+            self._close(evicted_key, evicted_service)
+        return service
+
+    def _pop_idle(self, now: float) -> List[Tuple[Tuple[str, str], MusicService]]:
+        # Entries are kept in order of use, so the idle ones are all at the front
+        evicted = []
+        while len(self.services) > 0:
+            _, (_, last_used) = next(iter(self.services.items()))
+            if now - last_used < self.idle_timeout:
+                break
+            evicted.append(self._pop_oldest())
+        return evicted
+
+    def _pop_oldest(self) -> Tuple[Tuple[str, str], MusicService]:
+        key, (service, _) = self.services.popitem(last=False)
+        self.versions.pop(key, None)
+        self.evicted += 1
+        return key, service
+
+    def _close(self, key: Tuple[str, str], service: MusicService):
+        logger.info("Closing %s service for tenant %s", key[1], key[0])
+        try:
+            service.close()
+        except Exception as e:
+            logger.warning("Failed to close %s service for tenant %s: %s", key[1], key[0], e)
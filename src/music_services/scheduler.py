@@ -0,0 +1,186 @@
+import contextvars
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Set
+
+from .errors import get_http_status, get_retry_after
+
+logger = logging.getLogger(__name__)
+
+# Priority lanes, lower goes first
+PRIORITY_WRITE = 0
+PRIORITY_INTERACTIVE = 1
+PRIORITY_BACKGROUND = 2
+PRIORITIES = [PRIORITY_WRITE, PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND]
+
+# Priority of requests made from the current thread or task, unless given explicitly
+current_priority = contextvars.ContextVar("current_priority", default=PRIORITY_INTERACTIVE)
+
+# Statuses worth retrying, anything else is the caller's problem. A request refused with a 429 wasn't
+# carried out, but one failing with a server error may have been, so only requests that are safe to
+# repeat are retried after those.
+RATE_LIMITED_STATUS = 429
+SERVER_ERROR_STATUSES = {500, 502, 503, 504}
+
+
+class RateLimitedError(Exception):
+    """
+    Raised when a service is still rate limiting requests after every retry, or asks to wait too long.
+    """
+
+    pass
+
+
+@contextmanager
+def priority(level: int):
+    """
+    Make requests within the block at the given priority.
+    """
+    token = current_priority.set(level)
+    try:
+        yield
+    finally:
+        current_priority.reset(token)
+
+
+class RequestScheduler:
+    """
+    Paces requests to a single music service.
+
+    Requests spend tokens from a bucket refilled at `rate` per second, holding up to `burst`.
+    When tokens are short, waiting requests are served by priority, so playlist writes go
+    ahead of interactive lookups, which go ahead of background work.
+    A 429 pauses every request to the service for as long as its Retry-After asks, up to
+    `max_delay`, and throttled or failed requests are retried with exponential backoff and jitter.
+    Writes, made with `call_write`, are only retried when throttled.
+    Requests still throttled after every retry raise `RateLimitedError`, other failures raise the service's error.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        rate: float,
+        burst: int,
+        max_retries: int = 5,
+        base_delay: float = 0.5,
+        max_delay: float = 60,
+    ):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self.tokens = float(burst)
+        self.refilled_at = time.monotonic()
+        self.paused_until = 0.0
+        self.waiting: Dict[int, int] = {p: 0 for p in PRIORITIES}
+        self.condition = threading.Condition()
+
+        self.requests = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.throttled_seconds = 0.0
+
+    def call(self, fn: Callable, *args, **kwargs):
+        return self._call(fn, args, kwargs, SERVER_ERROR_STATUSES | {RATE_LIMITED_STATUS})
+
+    def call_write(self, fn: Callable, *args, **kwargs):
+        """
+        Make a request that mustn't be repeated once the service may have carried it out, e.g. adding to a playlist.
+        """
+        return self._call(fn, args, kwargs, {RATE_LIMITED_STATUS})
+
+    def _call(self, fn: Callable, args, kwargs, retry_statuses: Set[int]):
+        level = current_priority.get()
+        for attempt in range(self.max_retries + 1):
+            self._acquire(level)
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                status = get_http_status(e)
+                if status not in retry_statuses:
+                    raise
+                error = e
+
+            delay = min(self.base_delay * 2**attempt, self.max_delay) * random.uniform(0.5, 1.5)
+            if status == RATE_LIMITED_STATUS:
+                self.rate_limited += 1
+                retry_after = get_retry_after(error)
+                if retry_after is not None and retry_after > self.max_delay:
+                    # Don't hold every request for that long, fail this one and let it be retried later
+                    self._pause(self.max_delay)
+                    raise RateLimitedError(f"{self.name} asked to wait {retry_after:.0f}s before retrying: {error}")
+                if retry_after is not None:
+                    delay = retry_after
+                self._pause(delay)
+            logger.info("%s returned %s, retrying in %.1fs", self.name, status, delay)
+
+            self.retries += 1
+            self._wait(delay)
+
+        if status != RATE_LIMITED_STATUS:
+            # The service is failing rather than throttling us, raise its error so it's reported as such
+            raise error
+        raise RateLimitedError(f"{self.name} still rate limiting after {self.max_retries} retries: {error}")
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "requests": self.requests,
+            "retries": self.retries,
+            "rate_limited": self.rate_limited,
+            "throttled_seconds": self.throttled_seconds,
+        }
+
+    def _acquire(self, level: int):
+        start = time.monotonic()
+        with self.condition:
+            self.waiting[level] += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    ahead = any(self.waiting[p] > 0 for p in PRIORITIES if p < level)
+                    if now >= self.paused_until and self.tokens >= 1 and not ahead:
+                        self.tokens -= 1
+                        self.requests += 1
+                        break
+
+                    wait = max(self.paused_until - now, (1 - self.tokens) / self.rate, 0.01)
+                    self.condition.wait(wait)
+            finally:
+                self.waiting[level] -= 1
+                self.condition.notify_all()
+                self.throttled_seconds += time.monotonic() - start
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.refilled_at) * self.rate)
+        self.refilled_at = now
+
+    def _pause(self, delay: float):
+        with self.condition:
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+
+    def _wait(self, delay: float):
+        time.sleep(delay)
+        with self.condition:
+            self.throttled_seconds += delay
+
+
+schedulers: Dict[str, RequestScheduler] = {}
+schedulers_lock = threading.Lock()
+
+
+def get_scheduler(service_id: str, name: str, rate: float, burst: int) -> RequestScheduler:
+    """
+    Get the scheduler shared by every instance of a service, creating it on first use.
+    Rate limits apply to the whole app rather than to each user, so all tenants share one bucket.
+    """
+    with schedulers_lock:
+        if service_id not in schedulers:
+            schedulers[service_id] = RequestScheduler(name, rate, burst)
+        return schedulers[service_id]
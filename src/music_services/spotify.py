@@ -1,14 +1,12 @@
 import logging
 import os
-import re
-import urllib.parse
-from typing import Dict, List
-
-import spotipy
-from spotipy.oauth2 import SpotifyClientCredentials, SpotifyOAuth
+from functools import partial
+from typing import Dict, Iterator, List, Optional
 
+from music_services.errors import is_not_found
+from music_services.http import get_http_session
 from music_services.music_service import MusicService
-from music_services.things import Playlist, Track
+from music_services.things import Playlist, Track, normalize
 
 logger = logging.getLogger(__name__)
 
@@ -16,130 +14,252 @@ SPOTELEGRAMIFY_CLIENT_ID = os.getenv("SPOTELEGRAMIFY_CLIENT_ID")
 SPOTELEGRAMIFY_CLIENT_SECRET = os.getenv("SPOTELEGRAMIFY_CLIENT_SECRET")
 SPOTIFY_REFRESH_TOKEN = os.getenv("SPOTIFY_REFRESH_TOKEN")
 
+# Matches web links, including localised (/intl-xx/) and share (?si=) links, and spotify: URIs
+SPOTIFY_TRACK_REGEX = r"(?:spotify\.com/(?:intl-[\w-]+/)?track/|spotify:track:)([a-zA-Z0-9]{22})"
+SPOTIFY_ALBUM_REGEX = r"(?:spotify\.com/(?:intl-[\w-]+/)?album/|spotify:album:)([a-zA-Z0-9]{22})"
+SPOTIFY_LINK_MARKERS = ["spotify"]
+
+# Limits on the number of IDs accepted by the bulk lookup endpoints
+SPOTIFY_MAX_TRACKS_PER_REQUEST = 50
+SPOTIFY_MAX_ALBUMS_PER_REQUEST = 20
+SPOTIFY_MAX_TRACKS_PER_PLAYLIST_ADD = 100
+SPOTIFY_MAX_PLAYLIST_ITEMS_PER_REQUEST = 100
+
+# Number of search results to consider when matching a track
+SPOTIFY_SEARCH_CANDIDATES = 10
+
+# Only the playlist fields we use, so that the first page of tracks isn't fetched along with it
+SPOTIFY_PLAYLIST_FIELDS = "id,name,external_urls(spotify)"
+SPOTIFY_PLAYLIST_TRACK_FIELDS = "items(is_local,track(type,id,name,artists(name),external_ids(isrc),duration_ms)),next"
+
+# Spotify doesn't publish its rate limit, this stays comfortably below the point it starts returning 429s
+SPOTIFY_REQUESTS_PER_SECOND = 10
+SPOTIFY_REQUEST_BURST = 20
+
+
+def is_playlist_track(item: Dict) -> bool:
+    """
+    Whether a playlist item is a Spotify track, rather than a track that has been removed from Spotify (None),
+    a podcast episode or a local file, none of which can be found on other services.
+    """
+    track = item["track"]
+    if track is None or item.get("is_local"):
+        return False
+    return track.get("type", "track") == "track" and track.get("id") is not None
+
 
 class SpotifyMusicService(MusicService):
-    def __init__(self):
-        self.name = "Spotify"
-        self.id = "spotify"
-        self.track_regex = r"spotify\.com/track/([a-zA-Z0-9]{22})"
-        self.album_regex = r"spotify\.com/album/([a-zA-Z0-9]{22})"
+    name = "Spotify"
+    id = "spotify"
+    track_regex = SPOTIFY_TRACK_REGEX
+    album_regex = SPOTIFY_ALBUM_REGEX
+    link_markers = SPOTIFY_LINK_MARKERS
+    max_playlist_batch = SPOTIFY_MAX_TRACKS_PER_PLAYLIST_ADD
+    requests_per_second = SPOTIFY_REQUESTS_PER_SECOND
+    request_burst = SPOTIFY_REQUEST_BURST
+    credential_names = ["refresh_token"]
+
+    def __init__(self, credentials: Dict[str, str]):
+        # spotipy is imported once a service is first created rather than when the bot starts
+        import spotipy
+        from spotipy.cache_handler import MemoryCacheHandler
+        from spotipy.oauth2 import SpotifyClientCredentials, SpotifyOAuth
+
+        self.credentials = credentials
         client_credentials_manager = SpotifyClientCredentials(
-            client_id=SPOTELEGRAMIFY_CLIENT_ID, client_secret=SPOTELEGRAMIFY_CLIENT_SECRET
+            client_id=SPOTELEGRAMIFY_CLIENT_ID,
+            client_secret=SPOTELEGRAMIFY_CLIENT_SECRET,
+            requests_session=get_http_session(),
+        )
+        # Retries are left to our request scheduler, so that 429s are seen and paced across all calls
+        self.session = spotipy.Spotify(
+            client_credentials_manager=client_credentials_manager,
+            requests_session=get_http_session(),
+            retries=0,
+            status_retries=0,
         )
-        self.session = spotipy.Spotify(client_credentials_manager=client_credentials_manager)
+        # Tokens are kept in memory, so that tenants don't share spotipy's token cache file
         self.oauth = SpotifyOAuth(
             client_id=SPOTELEGRAMIFY_CLIENT_ID,
             client_secret=SPOTELEGRAMIFY_CLIENT_SECRET,
             scope="playlist-modify-private,playlist-modify-public",
             redirect_uri="https://localhost:8888",
+            cache_handler=MemoryCacheHandler(),
+            requests_session=get_http_session(),
         )
         super().__init__()
 
-    def refresh_auth(self):
-        logger.info(f"Refreshing {self.name} access token")
-        self.oauth.refresh_access_token(refresh_token=SPOTIFY_REFRESH_TOKEN)["access_token"]
-        logger.info(f"Refreshed {self.name} access token")
+    @classmethod
+    def env_credentials(cls) -> Optional[Dict[str, str]]:
+        if SPOTIFY_REFRESH_TOKEN is None:
+            return None
+        return {"refresh_token": SPOTIFY_REFRESH_TOKEN}
+
+    def refresh_auth(self) -> float:
+        logger.info("Refreshing %s access token", self.name)
+        token = self.oauth.refresh_access_token(refresh_token=self.credentials["refresh_token"])
+        # Act as the tenant, so that their playlists can be changed
+        self.session.set_auth(token["access_token"])
+        return token["expires_at"]
 
     def lookup_service_playlist(self, playlist_id) -> Dict:
-        logger.info(f"Looking up playlist with ID '{playlist_id}' on {self.name}")
-        playlist = None
+        logger.debug("Looking up playlist with ID '%s' on %s", playlist_id, self.name)
         try:
-            playlist = self.session.playlist(playlist_id)
-        except Exception:
-            logger.info(f"No {self.name} playlist exists with ID {playlist_id}")
-            pass
+            playlist = self.request(self.session.playlist, playlist_id, fields=SPOTIFY_PLAYLIST_FIELDS)
+        except Exception as e:
+            if not is_not_found(e):
+                raise
+            logger.info("No %s playlist exists with ID %s", self.name, playlist_id)
+            return None
 
         playlist_name = playlist["name"]
-        logger.info(f"Found playlist '{playlist_name}' on {self.name}")
+        logger.debug("Found playlist '%s' on %s", playlist_name, self.name)
         return playlist
 
     def lookup_service_album(self, album_id) -> Dict:
-        logging.info(f"Searching for album with ID '{album_id}' on {self.name}")
+        logger.debug("Searching for album with ID '%s' on %s", album_id, self.name)
         try:
-            album = self.session.album(album_id)
+            album = self.request(self.session.album, album_id)
             album_name = album["name"]
-            logging.info(f"Found album '{album_name}' on {self.name}")
+            logger.debug("Found album '%s' on %s", album_name, self.name)
             return album
         except Exception as e:
-            logging.info(e)
-            logging.info(f"No album with ID {album_id} on {self.name}")
+            if not is_not_found(e):
+                raise
+            logger.info("No album with ID %s on %s: %s", album_id, self.name, e)
             return None
 
     def get_service_track_from_album(self, service_album: Dict) -> Dict:
         album_name = service_album["name"]
-        logging.info(f"Looking for top track from album '{album_name}' on {self.name}")
+        logger.debug("Looking for top track from album '%s' on %s", album_name, self.name)
         album_tracks = service_album["tracks"]["items"]
         if len(album_tracks) > 0:
-            service_track_id = album_tracks[0]["id"]
-            service_track_name = album_tracks[0]["name"]
-            logging.info(
-                f"Found track {service_track_name} for album {album_name}, fetching full track details on {self.name}"
-            )
-            service_track = self.lookup_service_track(service_track_id)
-
-            logging.info(f"Returning track {service_track_name} for album '{album_name}' on {self.name}")
+            # The album payload's simplified track has everything we convert, so no need to fetch it again
+            service_track = album_tracks[0]
+            service_track_name = service_track["name"]
+            logger.debug("Returning track %s for album '%s' on %s", service_track_name, album_name, self.name)
             return service_track
         else:
-            logging.warning(f"No tracks in album '{album_name}' on {self.name}")
+            logger.warning("No tracks in album '%s' on %s", album_name, self.name)
             return None
 
+    def iter_album_pages(self, service_album: Dict) -> Iterator[List[Dict]]:
+        # The album payload has the first page of its tracklist, later pages are fetched as they're needed
+        page = service_album["tracks"]
+        while page is not None:
+            yield page["items"]
+            page = self.request(self.session.next, page) if page["next"] else None
+
+    def complete_album_tracks(self, service_tracks: List[Dict]) -> List[Dict]:
+        # Album tracklists leave out ISRCs and popularity, which the bulk track lookup has
+        full_tracks = self.lookup_service_tracks([track["id"] for track in service_tracks])
+        return [full or simplified for full, simplified in zip(full_tracks, service_tracks)]
+
+    def get_track_popularity(self, service_track: Dict) -> float:
+        return service_track.get("popularity", 0)
+
     def lookup_service_track(self, track_id) -> Dict:
-        logging.info(f"Searching for track with ID '{track_id}' on {self.name}")
+        logger.debug("Searching for track with ID '%s' on %s", track_id, self.name)
         try:
-            track = self.session.track(track_id)
+            track = self.request(self.session.track, track_id)
             track_name = track["name"]
-            logging.info(f"Found track '{track_name}' on {self.name}")
+            logger.debug("Found track '%s' on %s", track_name, self.name)
             return track
         except Exception as e:
-            logging.info(e)
-            logging.info(f"No track with ID {track_id} on {self.name}")
+            if not is_not_found(e):
+                raise
+            logger.info("No track with ID %s on %s: %s", track_id, self.name, e)
+            return None
+
+    def lookup_service_tracks(self, track_ids: List[str]) -> List[Dict]:
+        logger.debug("Searching for %s tracks on %s", len(track_ids), self.name)
+        return self._lookup_many(self.session.tracks, "tracks", track_ids, SPOTIFY_MAX_TRACKS_PER_REQUEST)
+
+    def lookup_service_albums(self, album_ids: List[str]) -> List[Dict]:
+        logger.debug("Searching for %s albums on %s", len(album_ids), self.name)
+        return self._lookup_many(self.session.albums, "albums", album_ids, SPOTIFY_MAX_ALBUMS_PER_REQUEST)
+
+    def _lookup_many(self, lookup, key: str, ids: List[str], chunk_size: int) -> List[Dict]:
+        results = []
+        for i in range(0, len(ids), chunk_size):
+            chunk = ids[i : i + chunk_size]
+            try:
+                # Spotify gives None in place of any ID it doesn't recognise
+                results += self.request(lookup, chunk)[key]
+            except Exception as e:
+                if not is_not_found(e):
+                    raise
+                logger.info("Failed to look up %s %s on %s: %s", key, chunk, self.name, e)
+                results += [None] * len(chunk)
+
+        return results
+
+    def search_track_by_isrc(self, isrc: str) -> Optional[Dict]:
+        logger.debug("Searching %s for ISRC %s", self.name, isrc)
+        track_results = self.request(self.session.search, f"isrc:{isrc}", type="track", limit=1)["tracks"]
+        if track_results is None or len(track_results["items"]) < 1:
             return None
 
-    def search_track(self, track: Track):
+        return track_results["items"][0]
+
+    def search_track_candidates(self, track: Track) -> List[Dict]:
         # Spotify search API returns garbage if you include special chars
-        # Remove anything but alphanumeric and spaces, and lowercase the whole thing
-        simplified_track_name = re.sub("[^\w\s]", "", track.name).lower()
-        simplified_artist_name = re.sub("[^\w\s]", "", track.artist_name).lower()
-        logger.info(f"Searching {self.name} for {simplified_track_name} - {simplified_artist_name}")
+        simplified_track_name = normalize(track.name)
+        simplified_artist_name = normalize(track.artist_name)
+        logger.debug("Searching %s for %s - %s", self.name, simplified_track_name, simplified_artist_name)
         query = f"track:{simplified_track_name} artist:{simplified_artist_name}"
-        results = self.session.search(query, type="track")
+        results = self.request(self.session.search, query, type="track", limit=SPOTIFY_SEARCH_CANDIDATES)
         track_results = results["tracks"]
 
         # Validate results
-        if track_results is None:
-            logger.warning(f"Could not find track {track.name} - {track.artist_name} on {self.name}")
-            return None
+        if track_results is None or len(track_results["items"]) < 1:
+            logger.warning("Could not find track %s - %s on %s", track.name, track.artist_name, self.name)
+            return []
 
-        if track_results["total"] < 1:
-            logger.error(f"{self.name} returned empty tracks result for {track.name} - {track.artist_name}!")
-            return None
+        return track_results["items"]
 
-        return track_results["items"][0]
+    def get_service_track_id(self, service_track: Dict) -> str:
+        return service_track["id"]
 
-    def playlist_contains_track(self, playlist_id: str, service_track: Dict):
-        track_id = service_track["id"]
-        playlist_items = self.session.playlist_items(playlist_id)["items"]
+    def iter_playlist_pages(self, playlist_id: str) -> Iterator[List[Dict]]:
+        return self._iter_playlist_pages(playlist_id, SPOTIFY_PLAYLIST_TRACK_FIELDS)
 
-        return len([t for t in playlist_items if t["track"]["id"] == track_id]) > 0
+    def get_playlist_track_ids(self, playlist_id: str) -> List[str]:
+        pages = self._iter_playlist_pages(playlist_id, "items(is_local,track(type,id)),next")
+        return [track["id"] for page in pages for track in page]
 
-    def add_to_playlist(self, playlist: Dict, service_track: Dict):
-        track_name = service_track["name"]
-        playlist_name = playlist["name"]
-        track_id = service_track["id"]
-        self.refresh_auth()
-        if self.playlist_contains_track(playlist["id"], service_track):
-            logger.info(f"Track '{track_name}' is already in {self.name} playlist '{playlist_name}'")
-            return
-        logger.info(f"Adding track '{track_name}' to {self.name} playlist '{playlist_name}'")
-        self.session.playlist_add_items(playlist["id"], [track_id])
+    def _iter_playlist_pages(self, playlist_id: str, fields: str) -> Iterator[List[Dict]]:
+        page = self.request(
+            self.session.playlist_items, playlist_id, fields=fields, limit=SPOTIFY_MAX_PLAYLIST_ITEMS_PER_REQUEST
+        )
+        while page is not None:
+            yield [item["track"] for item in page["items"] if is_playlist_track(item)]
+            page = self.request(self.session.next, page) if page["next"] else None
+
+    def get_playlist_snapshot_id(self, playlist_id: str) -> str:
+        return self.request(self.session.playlist, playlist_id, fields="snapshot_id")["snapshot_id"]
+
+    def add_tracks_to_playlist(self, playlist_id: str, track_ids: List[str]) -> str:
+        return self.request_write(self.session.playlist_add_items, playlist_id, track_ids)["snapshot_id"]
 
     def convert_tracks(self, tracks: List[Dict]) -> List[Track]:
-        logging.info(f"Converting {len(tracks)} tracks from {self.name}")
-        return [Track(track["name"], track["artists"][0]["name"]) for track in tracks]
+        logger.debug("Converting %s tracks from %s", len(tracks), self.name)
+        return [
+            Track(
+                track["name"],
+                track["artists"][0]["name"],
+                service_id=self.id,
+                id=track["id"],
+                isrc=track.get("external_ids", {}).get("isrc"),
+                duration_ms=track.get("duration_ms"),
+            )
+            for track in tracks
+            # Local files can have no artist
+            if track.get("artists")
+        ]
 
-    def convert_playlist(self, playlist: List[any]) -> List[Playlist]:
+    def convert_playlist(self, playlist: Dict) -> Playlist:
         playlist_name = playlist["name"]
-        logging.info(f"Converting playlist {playlist_name} from {self.name}")
-        service_tracks = [t["track"] for t in self.session.playlist_items(playlist["id"])["items"]]
-        tracks = self.convert_tracks(service_tracks)
-        return Playlist(playlist_name, tracks, playlist["external_urls"]["spotify"], playlist["id"])
+        logger.debug("Converting playlist %s from %s", playlist_name, self.name)
+        tracks = partial(self.iter_playlist_tracks, playlist["id"])
+        return Playlist(playlist_name, tracks, playlist["external_urls"]["spotify"], playlist["id"], service_id=self.id)
@@ -1,33 +1,83 @@
-from typing import List
+import re
+import sys
+from typing import Callable, Iterable, Iterator, Union
+
+
+def normalize(text: str) -> str:
+    """
+    Remove anything but alphanumeric and spaces, and lowercase the whole thing.
+    """
+    return re.sub(r"[^\w\s]", "", text).lower()
 
 
 class Track:
-    def __init__(self, name, artist_name) -> None:
-        self.name = name
-        self.artist_name = artist_name
+    """
+    A track on a music service.
+
+    Tracks are immutable and slotted, so that the many held by caches and indexes stay small.
+    Artist names are interned, since the same artists come up again and again.
+    Tracks are equal if they are the same track on the same service, or, for tracks without an ID,
+    if their names and artists match.
+    """
+
+    __slots__ = ("name", "artist_name", "service_id", "id", "isrc", "duration_ms", "match_key", "_identity", "_hash")
+
+    def __init__(self, name, artist_name, service_id=None, id=None, isrc=None, duration_ms=None) -> None:
+        artist_name = sys.intern(artist_name)
+        match_key = f"{normalize(name)}|{normalize(artist_name)}"
+        identity = (service_id, id) if id is not None else (None, match_key)
+        for field, value in [
+            ("name", name),
+            ("artist_name", artist_name),
+            ("service_id", service_id),
+            ("id", id),
+            ("isrc", isrc),
+            ("duration_ms", duration_ms),
+            ("match_key", match_key),
+            ("_identity", identity),
+            ("_hash", hash(identity)),
+        ]:
+            object.__setattr__(self, field, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"Track is immutable, can't set {name}")
 
-    def name() -> str:
-        pass
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, Track):
+            return NotImplemented
+        return self._hash == other._hash and self._identity == other._identity
 
-    def artist_name() -> str:
-        pass
+    def __hash__(self) -> int:
+        return self._hash
+
+    def __repr__(self) -> str:
+        return f"Track({self.name!r}, {self.artist_name!r}, service_id={self.service_id!r}, id={self.id!r})"
 
 
 class Playlist:
-    def __init__(self, name, tracks, link, id) -> None:
-        self.name = name
-        self.tracks = tracks
-        self.link = link
-        self.id = id
+    """
+    A playlist on a music service.
 
-    def name() -> str:
-        pass
+    `tracks` is either the tracks themselves, or a function streaming them, which is only
+    called if the playlist's tracks are iterated.
+    """
 
-    def tracks() -> List[Track]:
-        pass
+    __slots__ = ("name", "load_tracks", "link", "id", "service_id")
 
-    def link() -> str:
-        pass
+    def __init__(
+        self,
+        name,
+        tracks: Union[Iterable[Track], Callable[[], Iterator[Track]]],
+        link,
+        id,
+        service_id=None,
+    ) -> None:
+        self.name = name
+        self.load_tracks = tracks if callable(tracks) else lambda: iter(tracks)
+        self.link = link
+        self.id = id
+        self.service_id = service_id
 
-    def id() -> str:
-        pass
+    @property
+    def tracks(self) -> Iterator[Track]:
+        return self.load_tracks()
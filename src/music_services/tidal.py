@@ -1,9 +1,10 @@
 import logging
 import os
-from typing import Dict, List
-
-import tidalapi
+from functools import partial
+from typing import Dict, Iterator, List, Optional
 
+from music_services.errors import is_not_found
+from music_services.http import get_http_session
 from music_services.music_service import MusicService
 from music_services.things import Playlist, Track
 
@@ -13,82 +14,194 @@ logger = logging.getLogger(__name__)
 TIDAL_ACCESS_TOKEN = os.getenv("TIDAL_ACCESS_TOKEN")
 TIDAL_REFRESH_TOKEN = os.getenv("TIDAL_REFRESH_TOKEN")
 
+# Matches links with any path before the track or album, e.g. tidal.com/browse/track/1
+TIDAL_TRACK_REGEX = r"tidal\.com/(?:[\w-]+/)*?track/(\d+)"
+TIDAL_ALBUM_REGEX = r"tidal\.com/(?:[\w-]+/)*?album/(\d+)"
+TIDAL_LINK_MARKERS = ["tidal"]
+
+TIDAL_MAX_TRACKS_PER_PLAYLIST_ADD = 50
+TIDAL_MAX_PLAYLIST_TRACKS_PER_REQUEST = 100
+TIDAL_MAX_ALBUM_TRACKS_PER_REQUEST = 100
+
+# Number of search results to consider when matching a track
+TIDAL_SEARCH_CANDIDATES = 10
+
+TIDAL_REQUESTS_PER_SECOND = 5
+TIDAL_REQUEST_BURST = 10
+
 
 class TidalMusicService(MusicService):
-    def __init__(self):
-        self.name = "Tidal"
-        self.id = "tidal"
-        self.album_regex = r"tidal\.com/(?:.*/)?album/(\d+)/?[^\?]*"
-        self.track_regex = r"tidal\.com/(?:.*/)?track/(\d+)/?[^\?]*"
+    name = "Tidal"
+    id = "tidal"
+    album_regex = TIDAL_ALBUM_REGEX
+    track_regex = TIDAL_TRACK_REGEX
+    link_markers = TIDAL_LINK_MARKERS
+    max_playlist_batch = TIDAL_MAX_TRACKS_PER_PLAYLIST_ADD
+    requests_per_second = TIDAL_REQUESTS_PER_SECOND
+    request_burst = TIDAL_REQUEST_BURST
+    credential_names = ["access_token", "refresh_token"]
+
+    def __init__(self, credentials: Dict[str, str]):
+        # tidalapi is imported once a service is first created rather than when the bot starts
+        import tidalapi
+
+        self.credentials = credentials
         self.session = tidalapi.Session()
+        self.session.request_session = get_http_session()
         super().__init__()
 
-    def refresh_auth(self):
-        logger.info(f"Refreshing {self.name} access token")
-        self.session.load_oauth_session("Bearer", TIDAL_ACCESS_TOKEN, TIDAL_REFRESH_TOKEN)
-        logger.info(f"Refreshed {self.name} access token")
+    @classmethod
+    def env_credentials(cls) -> Optional[Dict[str, str]]:
+        if TIDAL_ACCESS_TOKEN is None or TIDAL_REFRESH_TOKEN is None:
+            return None
+        return {"access_token": TIDAL_ACCESS_TOKEN, "refresh_token": TIDAL_REFRESH_TOKEN}
+
+    def refresh_auth(self) -> float:
+        logger.info("Refreshing %s access token", self.name)
+        access_token, refresh_token = self.credentials["access_token"], self.credentials["refresh_token"]
+        if self.session.access_token is None:
+            self.session.load_oauth_session("Bearer", access_token, refresh_token)
+        else:
+            self.session.token_refresh(refresh_token)
+
+        return self.session.expiry_time.timestamp() if self.session.expiry_time is not None else None
 
     def lookup_service_playlist(self, playlist_id) -> Dict:
-        logger.info(f"Looking up playlist with ID '{playlist_id}' on {self.name}")
+        import tidalapi
+
+        logger.debug("Looking up playlist with ID '%s' on %s", playlist_id, self.name)
         playlist = None
         try:
-            playlist = tidalapi.playlist.UserPlaylist(self.session, playlist_id)
-            logger.info(f"Found playlist '{playlist.name}' on {self.name}")
+            playlist = self.request(tidalapi.playlist.UserPlaylist, self.session, playlist_id)
+            logger.debug("Found playlist '%s' on %s", playlist.name, self.name)
             return playlist
-        except Exception:
-            logger.info(f"No {self.name} playlist exists with ID {playlist_id}")
+        except Exception as e:
+            if not is_not_found(e):
+                raise
+            logger.info("No %s playlist exists with ID %s", self.name, playlist_id)
             return None
 
-    def lookup_service_album(self, album_id: str) -> Dict:
-        logging.warn(f"Album support currently not available for {self.name}")
-        return None
+    def lookup_service_album(self, album_id: str):
+        logger.debug("Searching for album with ID '%s' on %s", album_id, self.name)
+        try:
+            album = self.request(self.session.album, album_id)
+            logger.debug("Found album '%s' on %s", album.name, self.name)
+            return album
+        except Exception as e:
+            if not is_not_found(e):
+                raise
+            logger.info("No album with ID %s on %s: %s", album_id, self.name, e)
+            return None
 
-    def get_service_track_from_album(self, service_album: Dict) -> Dict:
-        logging.warn(f"Album support currently not available for {self.name}")
-        return None
+    def get_service_track_from_album(self, service_album):
+        logger.debug("Looking for top track from album '%s' on %s", service_album.name, self.name)
+        album_tracks = self.request(service_album.tracks, limit=1)
+        if len(album_tracks) > 0:
+            return album_tracks[0]
+        else:
+            logger.warning("No tracks in album '%s' on %s", service_album.name, self.name)
+            return None
+
+    def iter_album_pages(self, service_album) -> Iterator[List]:
+        offset = 0
+        while True:
+            page = self.request(service_album.tracks, limit=TIDAL_MAX_ALBUM_TRACKS_PER_REQUEST, offset=offset)
+            yield page
+            offset += len(page)
+            if len(page) < TIDAL_MAX_ALBUM_TRACKS_PER_REQUEST:
+                return
+
+    def get_track_popularity(self, service_track) -> float:
+        return service_track.popularity or 0
 
     def lookup_service_track(self, track_id) -> Dict:
-        logging.info(f"Searching for track with ID '{track_id}' on {self.name}")
+        logger.debug("Searching for track with ID '%s' on %s", track_id, self.name)
         try:
-            track = self.session.track(track_id)
-            logging.info(f"Found track '{track.name}' on {self.name}")
+            track = self.request(self.session.track, track_id)
+            logger.debug("Found track '%s' on %s", track.name, self.name)
             return track
         except Exception as e:
-            logging.info(e)
-            logging.info(f"No track with ID {track_id} on {self.name}")
+            if not is_not_found(e):
+                raise
+            logger.info("No track with ID %s on %s: %s", track_id, self.name, e)
             return None
 
-    def search_track(self, track: Track):
-        logger.info(f"Searching {self.name} for {track.name} - {track.artist_name}")
-        query = f"{track.name} {track.artist_name}"
-        results = self.session.search(query, models=[tidalapi.Track])
+    def search_track_by_isrc(self, isrc: str):
+        logger.debug("Searching %s for ISRC %s", self.name, isrc)
+        try:
+            tracks = self.request(self.session.get_tracks_by_isrc, isrc)
+        except Exception as e:
+            if not is_not_found(e):
+                raise
+            # Tidal responds with an error rather than an empty list when it has no track with the ISRC
+            logger.info("No track with ISRC %s on %s: %s", isrc, self.name, e)
+            return None
 
-        tidal_track_result = results["top_hit"]
+        return tracks[0] if len(tracks) > 0 else None
 
-        if tidal_track_result is None:
-            logger.warning(f"Could not find track {track.track_name} - {track.artist_name} on {self.name}")
-            return None
+    def search_track_candidates(self, track: Track) -> List:
+        logger.debug("Searching %s for %s - %s", self.name, track.name, track.artist_name)
+        tidal_track_results = self.search_tracks(f"{track.name} {track.artist_name}")
+        if len(tidal_track_results) < 1:
+            logger.warning("Could not find track %s - %s on %s", track.name, track.artist_name, self.name)
 
-        return tidal_track_result
+        return tidal_track_results
 
-    def playlist_contains_track(self, playlist_id: str, service_track):
-        track_id = service_track.id
-        playlist = self.session.playlist(playlist_id)
-        tracks = playlist.tracks()
-        return len([t for t in tracks if t.id == track_id]) > 0
+    def search_tracks(self, query: str) -> List:
+        import tidalapi
 
-    def add_to_playlist(self, playlist, service_track):
-        logger.info(f"Adding track '{service_track.name}' to {self.name} playlist '{playlist.name}'")
-        playlist.add([service_track.id])
+        results = self.request(self.session.search, query, models=[tidalapi.Track], limit=TIDAL_SEARCH_CANDIDATES)
+        return results["tracks"]
 
-    def convert_tracks(self, tracks: List[any]) -> List[Track]:
-        logging.info(f"Converting {len(tracks)} tracks from {self.name}")
-        return [Track(track.name, track.artists[0].name) for track in tracks]
+    def get_service_track_id(self, service_track) -> str:
+        return str(service_track.id)
 
-    def convert_playlist(self, playlist) -> List[Playlist]:
-        logging.info(f"Converting playlist {playlist.name} from {self.name}")
-        service_tracks = playlist.tracks()
-        tracks = self.convert_tracks(service_tracks)
+    def iter_playlist_pages(self, playlist_id: str) -> Iterator[List]:
+        playlist = self.request(self.session.playlist, playlist_id)
+        offset = 0
+        while True:
+            page = self.request(playlist.tracks, limit=TIDAL_MAX_PLAYLIST_TRACKS_PER_REQUEST, offset=offset)
+            yield page
+            offset += len(page)
+            if len(page) < TIDAL_MAX_PLAYLIST_TRACKS_PER_REQUEST:
+                return
+
+    def get_playlist_track_ids(self, playlist_id: str) -> List[str]:
+        return [str(track.id) for page in self.iter_playlist_pages(playlist_id) for track in page]
+
+    def get_playlist_snapshot_id(self, playlist_id: str) -> str:
+        playlist = self.request(self.session.playlist, playlist_id)
+        return self._snapshot_id(playlist)
+
+    def add_tracks_to_playlist(self, playlist_id: str, track_ids: List[str]) -> str:
+        playlist = self.get_playlist(playlist_id)
+        if playlist is None:
+            raise ValueError(f"No {self.name} playlist exists with ID {playlist_id}")
+        self.request_write(playlist.add, track_ids)
+        return self._snapshot_id(playlist)
+
+    def _snapshot_id(self, playlist) -> str:
+        # Tidal has no snapshot ID, but the playlist's last update time and size change on every edit
+        return f"{playlist.last_updated}:{playlist.num_tracks}"
+
+    def convert_tracks(self, tracks: List[any]) -> List[Track]:
+        logger.debug("Converting %s tracks from %s", len(tracks), self.name)
+        return [
+            Track(
+                track.name,
+                track.artists[0].name,
+                service_id=self.id,
+                id=str(track.id),
+                isrc=track.isrc,
+                duration_ms=track.duration * 1000 if track.duration is not None else None,
+            )
+            for track in tracks
+            if track.artists
+        ]
+
+    def convert_playlist(self, playlist) -> Playlist:
+        logger.debug("Converting playlist %s from %s", playlist.name, self.name)
+        tracks = partial(self.iter_playlist_tracks, playlist.id)
         playlist_link = f"https://tidal.com/playlist/{playlist.id}"
-        playlist = Playlist(playlist.name, tracks, playlist_link, playlist.id)
+        playlist = Playlist(playlist.name, tracks, playlist_link, playlist.id, service_id=self.id)
         return playlist
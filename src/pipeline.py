@@ -0,0 +1,40 @@
+import contextvars
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict
+
+
+class Pipeline:
+    """
+    Execution engine for link handling.
+
+    Service calls are fanned out on a pool of threads per service, its size capping how many calls
+    may be in flight against that service at a time, so a slow service can't hold up the others.
+    """
+
+    def __init__(self, per_service_limit: int = 4):
+        self.per_service_limit = per_service_limit
+        self.executors: Dict[str, ThreadPoolExecutor] = {}
+        self.lock = threading.Lock()
+
+    def call(self, service, fn: Callable, *args) -> Future:
+        """
+        Run a call against `service` on its pool, respecting the per-service concurrency limit.
+        The caller's context is carried over, so the call is part of the caller's trace.
+        """
+        context = contextvars.copy_context()
+        return self._executor(service.id).submit(context.run, fn, *args)
+
+    def shutdown(self):
+        with self.lock:
+            executors = list(self.executors.values())
+        for executor in executors:
+            executor.shutdown(wait=True)
+
+    def _executor(self, service_id: str) -> ThreadPoolExecutor:
+        with self.lock:
+            if service_id not in self.executors:
+                self.executors[service_id] = ThreadPoolExecutor(
+                    max_workers=self.per_service_limit, thread_name_prefix=f"{service_id}-call"
+                )
+            return self.executors[service_id]
@@ -0,0 +1,119 @@
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from music_services.albums import AlbumMode, parse_album_mode
+from music_services.cache import MISSING, TTLCache
+from music_services.database import Database
+
+logger = logging.getLogger(__name__)
+
+# Services with a playlist column in the chats table
+SERVICE_IDS = ["spotify", "tidal"]
+
+
+class ChatRepository:
+    """
+    Stores the playlist associated with each Telegram chat, for each music service,
+    the tenant whose playlists they are, and which tracks of shared albums are added.
+
+    A chat's settings are read in a single query and cached in memory until
+    the chat is changed through this repository.
+    """
+
+    def __init__(self, database: Database, service_ids: List[str] = SERVICE_IDS):
+        self.database = database
+        self.service_ids = service_ids
+        self.cache = TTLCache(max_size=4096, name="chat")
+
+    def configure(self):
+        self.database.execute(
+            """
+            CREATE TABLE IF NOT EXISTS chats (
+                chat_id TEXT PRIMARY KEY,
+                spotify_playlist_id TEXT,
+                tidal_playlist_id TEXT,
+                tenant_id TEXT,
+                album_mode TEXT
+            )
+        """
+        )
+        # Chats created before tenants existed belong to the default tenant until a playlist is set again
+        columns = [row[1] for row in self.database.execute("PRAGMA table_info(chats)")]
+        if "tenant_id" not in columns:
+            self.database.execute("ALTER TABLE chats ADD COLUMN tenant_id TEXT")
+        if "album_mode" not in columns:
+            self.database.execute("ALTER TABLE chats ADD COLUMN album_mode TEXT")
+
+    def initialise_chat(self, chat_id: str, tenant_id: Optional[str] = None):
+        """
+        Clear the chat's settings. A chat keeps its tenant, one without a tenant becomes the given tenant's.
+        """
+        self.database.execute(
+            """
+            INSERT OR REPLACE INTO chats (chat_id, tenant_id)
+            VALUES (?, COALESCE((SELECT tenant_id FROM chats WHERE chat_id = ?), ?))
+            """,
+            (chat_id, chat_id, tenant_id),
+        )
+        self.cache.invalidate(chat_id)
+
+    def set_playlist_id(self, chat_id: str, service_id: str, playlist_id: str, tenant_id: str):
+        """
+        Set the chat's playlist for the service, making the chat the given tenant's.
+        """
+        if service_id not in self.service_ids:
+            raise ValueError(f"Unknown music service '{service_id}'")
+
+        self.database.execute(
+            f"""
+            UPDATE chats
+            SET {service_id}_playlist_id = ?, tenant_id = ?
+            WHERE chat_id = ?
+            """,
+            (playlist_id, tenant_id, chat_id),
+        )
+        self.cache.invalidate(chat_id)
+
+    def set_album_mode(self, chat_id: str, album_mode: AlbumMode):
+        self.database.execute("UPDATE chats SET album_mode = ? WHERE chat_id = ?", (str(album_mode), chat_id))
+        self.cache.invalidate(chat_id)
+
+    def get_playlist_ids(self, chat_id: str) -> Dict[str, Optional[str]]:
+        """
+        Get the playlist ID for every service in the given chat, None where it isn't set.
+        """
+        return self._get_chat(chat_id)[2]
+
+    def get_album_mode(self, chat_id: str) -> AlbumMode:
+        """
+        Get which tracks of albums shared in the chat are added, the default mode if it hasn't been set.
+        """
+        return self._get_chat(chat_id)[1]
+
+    def get_tenant_id(self, chat_id: str) -> Optional[str]:
+        """
+        Get the tenant whose playlists the chat adds to, None if it hasn't been set, i.e. it is the default tenant's.
+        """
+        return self._get_chat(chat_id)[0]
+
+    def get_mirrored_chat_ids(self) -> List[str]:
+        """
+        Get the chats with a playlist on more than one service.
+        """
+        playlists_set = " + ".join(f"({service_id}_playlist_id IS NOT NULL)" for service_id in self.service_ids)
+        rows = self.database.execute(f"SELECT chat_id FROM chats WHERE {playlists_set} > 1")
+        return [row[0] for row in rows]
+
+    def _get_chat(self, chat_id: str) -> Tuple[Optional[str], AlbumMode, Dict[str, Optional[str]]]:
+        chat = self.cache.get(chat_id)
+        if chat is not MISSING:
+            return chat
+
+        playlist_columns = [f"{service_id}_playlist_id" for service_id in self.service_ids]
+        columns = ", ".join(["tenant_id", "album_mode"] + playlist_columns)
+        rows = self.database.execute(f"SELECT {columns} FROM chats WHERE chat_id = ?", (chat_id,))
+        values = rows[0] if len(rows) > 0 else [None] * (len(self.service_ids) + 2)
+        chat = (values[0], parse_album_mode(values[1]), dict(zip(self.service_ids, values[2:])))
+
+        self.cache.set(chat_id, chat)
+        return chat
@@ -0,0 +1,157 @@
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import signal
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Points each shard has on the hash ring, more spreads chats more evenly
+RING_REPLICAS = 100
+
+# How often to check for worker processes that have exited, in seconds
+SUPERVISE_INTERVAL = 1.0
+
+# How long to wait for a worker process to finish its queue when stopping, in seconds
+STOP_TIMEOUT = 30
+
+
+def hash_key(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+def get_chat_id(update: Dict) -> Optional[str]:
+    """
+    Get the ID of the chat a raw Telegram update belongs to, if any.
+    """
+    message = update.get("message") or update.get("edited_message") or update.get("channel_post") or {}
+    chat_id = message.get("chat", {}).get("id")
+    return str(chat_id) if chat_id is not None else None
+
+
+class HashRing:
+    """
+    Consistent hash of keys onto shards.
+
+    Changing the number of shards only moves the keys of the shards added or removed,
+    rather than nearly every key as hashing modulo the number of shards would.
+    """
+
+    def __init__(self, shards: int, replicas: int = RING_REPLICAS):
+        points = sorted((hash_key(f"{shard}:{i}"), shard) for shard in range(shards) for i in range(replicas))
+        self.hashes = [h for h, _ in points]
+        self.shards = [shard for _, shard in points]
+
+    def shard_for(self, key: str) -> int:
+        i = bisect.bisect(self.hashes, hash_key(key)) % len(self.hashes)
+        return self.shards[i]
+
+
+class ShardedRuntime:
+    """
+    Routes Telegram updates to worker processes by chat.
+
+    A chat's updates always go to the same worker, chosen by consistent hash of the chat ID, and
+    each worker handles its updates one at a time, so they are handled in the order they arrived.
+    `target(shard, updates)` runs in each worker process and should handle updates from the queue
+    until it gives None, e.g. with `serve_shard`.
+    Workers that exit are restarted on the same queue, losing only the update they were handling.
+    """
+
+    def __init__(self, shards: int, target: Callable, queue_size: int = 1024):
+        self.ring = HashRing(shards)
+        self.target = target
+        # Spawn rather than fork, so workers don't inherit the ingress process's threads and connections
+        self.context = multiprocessing.get_context("spawn")
+        self.queues = [self.context.Queue(maxsize=queue_size) for _ in range(shards)]
+        self.processes: List[multiprocessing.Process] = [None] * shards
+        self.stopped = threading.Event()
+        self.abandoned = threading.Event()
+        self.supervisor = None
+
+        self.routed = 0
+        self.restarts = 0
+
+    def start(self):
+        for shard in range(len(self.queues)):
+            self._start_worker(shard)
+        self.supervisor = threading.Thread(target=self._supervise, name="shard-supervisor", daemon=True)
+        self.supervisor.start()
+
+    def route(self, update: Dict):
+        """
+        Queue a raw update for the worker handling its chat, waiting if that worker is behind.
+        """
+        chat_id = get_chat_id(update)
+        key = chat_id if chat_id is not None else str(update.get("update_id"))
+        self.queues[self.ring.shard_for(key)].put(update)
+        self.routed += 1
+
+    def stop(self):
+        """
+        Stop the workers once they have handled everything already routed to them.
+        """
+        for updates in self.queues:
+            updates.put(None)
+        self.stopped.set()
+        self.supervisor.join(STOP_TIMEOUT)
+        if not self.supervisor.is_alive():
+            return
+
+        self.abandoned.set()
+        self.supervisor.join()
+        for shard, process in enumerate(self.processes):
+            if process.is_alive():
+                logger.warning("Shard %s didn't stop in time, terminating it", shard)
+                process.terminate()
+            # Don't wait to deliver updates nobody will read
+            self.queues[shard].cancel_join_thread()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "routed": self.routed,
+            "restarts": self.restarts,
+            "queued": sum(updates.qsize() for updates in self.queues),
+        }
+
+    def _start_worker(self, shard: int):
+        process = self.context.Process(
+            target=self.target, args=(shard, self.queues[shard]), name=f"shard-{shard}", daemon=True
+        )
+        process.start()
+        self.processes[shard] = process
+        logger.info("Started shard %s in process %s", shard, process.pid)
+
+    def _supervise(self):
+        # Workers only exit cleanly once stopped, so keep restarting any others until they all have
+        while not self.abandoned.is_set():
+            stopped = self.stopped.is_set()
+            for shard, process in enumerate(self.processes):
+                if process.exitcode is not None and (process.exitcode != 0 or not stopped):
+                    logger.warning("Shard %s exited with code %s, restarting it", shard, process.exitcode)
+                    self.restarts += 1
+                    self._start_worker(shard)
+
+            if stopped and all(process.exitcode == 0 for process in self.processes):
+                return
+            time.sleep(SUPERVISE_INTERVAL)
+
+
+def serve_shard(shard: int, updates, handle: Callable[[Dict], None]):
+    """
+    Handle updates from the queue in order until it gives None.
+    """
+    # The ingress process decides when workers stop, so they shouldn't be interrupted along with it
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logger.info("Shard %s ready", shard)
+    while True:
+        update = updates.get()
+        if update is None:
+            return
+        try:
+            handle(update)
+        except Exception:
+            logger.exception("Shard %s failed to handle update %s", shard, update.get("update_id"))
@@ -0,0 +1,151 @@
+import hmac
+import json
+import logging
+import queue
+import threading
+import zlib
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List
+
+from sharding import get_chat_id
+
+logger = logging.getLogger(__name__)
+
+# How many recent update IDs to remember when dropping updates Telegram delivers twice
+RECENT_UPDATE_IDS = 10000
+
+# Header Telegram sends the webhook's secret token in
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookServer:
+    """
+    Receives Telegram updates over HTTP.
+
+    Requests without the `secret_token` the webhook was set with are refused with a 403,
+    so that only Telegram can send updates.
+    Each update is acknowledged as soon as it is queued, then handled by a worker thread.
+    Updates are routed to workers by chat, so a chat's updates are handled in order.
+    When a worker's queue is full the update is refused with a 503, which Telegram retries later.
+    Updates already seen, by update ID, are acknowledged and dropped.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        path: str,
+        secret_token: str,
+        process: Callable[[Dict], None],
+        workers: int = 4,
+        queue_size: int = 256,
+    ):
+        self.path = path
+        self.secret_token = secret_token
+        self.process = process
+        self.queues: List[queue.Queue] = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.recent_update_ids: "OrderedDict[int, None]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.threads: List[threading.Thread] = []
+
+        self.received = 0
+        self.duplicates = 0
+        self.rejected = 0
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path != server.path:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                if not hmac.compare_digest(self.headers.get(SECRET_TOKEN_HEADER, ""), server.secret_token):
+                    self.send_response(403)
+                    self.end_headers()
+                    return
+
+                try:
+                    body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                    update = json.loads(body)
+                except (ValueError, TypeError):
+                    self.send_response(400)
+                    self.end_headers()
+                    return
+
+                self.send_response(200 if server.enqueue(update) else 503)
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+
+    @property
+    def port(self) -> int:
+        return self.httpd.server_address[1]
+
+    def enqueue(self, update: Dict) -> bool:
+        """
+        Queue the update for handling, returning False if there is no room for it.
+        """
+        update_id = update.get("update_id")
+        with self.lock:
+            self.received += 1
+            # Updates without an ID can't be told apart, so are never dropped
+            if update_id is not None:
+                if update_id in self.recent_update_ids:
+                    self.duplicates += 1
+                    return True
+                self.recent_update_ids[update_id] = None
+                if len(self.recent_update_ids) > RECENT_UPDATE_IDS:
+                    self.recent_update_ids.popitem(last=False)
+
+        try:
+            self.queues[self.worker_for(update)].put_nowait(update)
+        except queue.Full:
+            with self.lock:
+                self.rejected += 1
+                self.recent_update_ids.pop(update_id, None)
+            logger.warning("Update queue full, refusing update %s", update_id)
+            return False
+
+        return True
+
+    def worker_for(self, update: Dict) -> int:
+        chat_id = get_chat_id(update) or ""
+        return zlib.crc32(chat_id.encode()) % len(self.queues)
+
+    def start(self):
+        for i, updates in enumerate(self.queues):
+            thread = threading.Thread(target=self._work, args=(updates,), name=f"webhook-worker-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+        thread = threading.Thread(target=self.httpd.serve_forever, name="webhook-server", daemon=True)
+        thread.start()
+        self.threads.append(thread)
+        logger.info("Listening for updates on port %s", self.port)
+
+    def stop(self):
+        """
+        Stop accepting updates and wait for the queued ones to be handled.
+        """
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        for updates in self.queues:
+            updates.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def _work(self, updates: queue.Queue):
+        while True:
+            update = updates.get()
+            if update is None:
+                return
+            try:
+                self.process(update)
+            except Exception:
+                logger.exception("Failed to handle update %s", update.get("update_id"))
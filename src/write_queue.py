@@ -0,0 +1,108 @@
+import logging
+import threading
+from concurrent.futures import Future
+from typing import Dict, List, Tuple
+
+from music_services.music_service import MusicService
+from music_services.playlist_index import PlaylistWritePendingError
+
+logger = logging.getLogger(__name__)
+
+
+class PlaylistWriteQueue:
+    """
+    Write-behind queue for playlist additions.
+
+    Additions are held per (service, playlist) for a short window and then written in
+    a single request, or sooner if the batch reaches the maximum size.
+    Each addition is written with the service instance it was queued with, so tenants sharing
+    a playlist each write with their own credentials.
+    Each addition gets a future that resolves to True if the track was added,
+    False if it was already in the playlist, or raises if the write failed or another writer
+    has reserved the track and may not have added it yet, so that its job is retried.
+    """
+
+    def __init__(self, window: float = 1.0, max_batch: int = 100):
+        self.window = window
+        self.max_batch = max_batch
+        self.pending: Dict[Tuple[str, str], List[Tuple[MusicService, str, Future]]] = {}
+        self.timers: Dict[Tuple[str, str], threading.Timer] = {}
+        self.flush_locks: Dict[Tuple[str, str], threading.Lock] = {}
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def add(self, service: MusicService, playlist_id: str, track_id: str) -> Future:
+        future = Future()
+        key = (service.id, playlist_id)
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("Playlist write queue is closed")
+            self.flush_locks.setdefault(key, threading.Lock())
+            batch = self.pending.setdefault(key, [])
+            batch.append((service, track_id, future))
+            full = len(batch) >= min(self.max_batch, service.max_playlist_batch)
+            if not full and key not in self.timers:
+                timer = threading.Timer(self.window, self.flush, (key,))
+                timer.daemon = True
+                self.timers[key] = timer
+                timer.start()
+
+        if full:
+            self.flush(key)
+
+        return future
+
+    def flush(self, key: Tuple[str, str]):
+        # Flushes of the same playlist are serialised so tracks land in the order they were queued
+        with self.flush_locks[key]:
+            with self.lock:
+                timer = self.timers.pop(key, None)
+                batch = self.pending.pop(key, [])
+            if timer is not None:
+                timer.cancel()
+
+            # Usually every addition came from one instance, otherwise each instance writes its own
+            by_service: Dict[int, List[Tuple[MusicService, str, Future]]] = {}
+            for addition in batch:
+                by_service.setdefault(id(addition[0]), []).append(addition)
+            for additions in by_service.values():
+                self._write(key[1], additions)
+
+    def _write(self, playlist_id: str, additions: List[Tuple[MusicService, str, Future]]):
+        service = additions[0][0]
+        track_ids = [track_id for _, track_id, _ in additions]
+        try:
+            added = set(service.add_to_playlist(playlist_id, track_ids))
+        except Exception as e:
+            logger.warning(
+                "Failed to add %s tracks to %s playlist %s: %s", len(track_ids), service.name, playlist_id, e
+            )
+            for _, _, future in additions:
+                future.set_exception(e)
+            return
+
+        # The same track may be queued twice, only the first is reported as added
+        for _, track_id, future in additions:
+            if track_id in added:
+                future.set_result(True)
+                added.discard(track_id)
+            elif service.playlist_index.contains(playlist_id, track_id):
+                future.set_result(False)
+            else:
+                future.set_exception(
+                    PlaylistWritePendingError(f"{service.name} track {track_id} is being added by another writer")
+                )
+
+    def flush_all(self):
+        with self.lock:
+            keys = list(self.pending)
+        for key in keys:
+            self.flush(key)
+
+    def close(self):
+        """
+        Stop accepting additions and write everything still pending.
+        """
+        with self.lock:
+            self.closed = True
+        self.flush_all()
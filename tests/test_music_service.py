@@ -0,0 +1,28 @@
+from typing import Dict, List
+
+from music_services.spotify import SpotifyMusicService
+from music_services.things import Track
+
+
+class SearchResultsSpotify(SpotifyMusicService):
+    """
+    The Spotify music service, with canned search results and no session.
+    """
+
+    def __init__(self, results: List[Dict]):
+        self.results = results
+
+    def search_track_candidates(self, track: Track) -> List[Dict]:
+        return self.results
+
+
+def spotify_track(track_id: str, name: str, artists: List[str]) -> Dict:
+    return {"id": track_id, "name": name, "artists": [{"name": artist} for artist in artists], "duration_ms": 200000}
+
+
+def test_search_track_skips_results_without_artists():
+    local_file = spotify_track("local", "Paper", [])
+    match = spotify_track("match", "Paper", ["Stone"])
+    service = SearchResultsSpotify([local_file, match])
+
+    assert service.search_track(Track("Paper", "Stone", duration_ms=200000)) is match
@@ -0,0 +1,54 @@
+import time
+from types import SimpleNamespace
+
+from music_services.database import Database
+from music_services.playlist_index import PlaylistIndex
+
+
+def fake_service(playlist):
+    return SimpleNamespace(
+        id="fake",
+        name="Fake",
+        get_playlist_snapshot_id=lambda playlist_id: str(len(playlist)),
+        get_playlist_track_ids=lambda playlist_id: list(playlist),
+    )
+
+
+def test_reservations_of_a_process_that_died_expire(tmp_path):
+    database = Database(str(tmp_path / "db.sqlite"))
+    service = fake_service([])
+    died = PlaylistIndex(service, database, reservation_ttl=0.1)
+    assert died.reserve("playlist", ["a", "b"]) == ["a", "b"]
+
+    # The job is retried by another process, which can't add the tracks until the reservations expire
+    retried = PlaylistIndex(service, database, reservation_ttl=0.1)
+    assert retried.reserve("playlist", ["a"]) == []
+    assert not retried.contains("playlist", "a")
+    time.sleep(0.2)
+    assert retried.reserve("playlist", ["a"]) == ["a"]
+
+
+def test_tracks_added_by_another_process_are_not_reserved(tmp_path):
+    database = Database(str(tmp_path / "db.sqlite"))
+    service = fake_service([])
+    adder = PlaylistIndex(service, database)
+    other = PlaylistIndex(service, database)
+    other.contains("playlist", "a")
+
+    assert adder.reserve("playlist", ["a"]) == ["a"]
+    adder.record_add("playlist", ["a"], "1")
+    assert other.reserve("playlist", ["a"]) == []
+    assert other.contains("playlist", "a")
+
+
+def test_tracks_kept_reserved_after_a_failed_write_can_be_retried(tmp_path):
+    database = Database(str(tmp_path / "db.sqlite"))
+    service = fake_service([])
+    index = PlaylistIndex(service, database)
+    other = PlaylistIndex(service, database)
+
+    assert index.reserve("playlist", ["a"]) == ["a"]
+    # The write failed with a server error, so the playlist is checked again before retrying
+    index.invalidate("playlist")
+    assert other.reserve("playlist", ["a"]) == []
+    assert index.reserve("playlist", ["a"]) == ["a"]